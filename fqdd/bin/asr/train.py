@@ -10,22 +10,36 @@ sys.path.insert(0, "./")
 
 from tqdm import tqdm
 from torch.nn.utils import clip_grad_norm_
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.fsdp import FullyShardedDataParallel
+from torch.utils.data import IterableDataset
 from fqdd.utils.load_data import init_dataset_and_dataloader
-from fqdd.utils.train_utils import init_optimizer_and_scheduler, init_distributed
+from fqdd.utils.samplers import DynamicBucketBatchSampler
+from fqdd.utils.train_utils import init_optimizer_and_scheduler, init_distributed, fqdd_join, wrap_model, init_amp
 from fqdd.utils.argument import parse_arguments, reload_configs
 from fqdd.text.init_tokenizer import Tokenizers
 from fqdd.modules.model_utils import save_model
+from fqdd.modules.batch_augment import init_batch_augment
+from fqdd.utils.device_loader import init_device_loader
+from fqdd.utils.train_metrics import DeviceMetrics
+from fqdd.utils.checkpointer import init_checkpointer
+from fqdd.utils.ema import init_ema
+from fqdd.utils.telemetry import init_telemetry
 from fqdd.models.init_model import init_model
 from fqdd.utils.logger import init_logging
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0,1,2"
 
 
-def train(model, train_loader, dev_loader, optimizer, scheduler, configs, logger, rank, device):
-    if rank == 0:
+def train(model, train_loader, dev_loader, optimizer, scheduler, checkpointer, configs, logger, rank, device):
+    # shard mode streams data, the loader has no length and no sampler
+    streaming = isinstance(train_loader.dataset, IterableDataset)
+    if rank == 0 and not streaming:
         print("status: train\t train_load_size:{}".format(len(train_loader)))
 
     log_interval = configs["log_interval"]
+    # mid-epoch checkpoints every save_interval steps, 0 to only save at the end of an epoch
+    save_interval = configs.get("save_interval", 0)
     tag = configs["init_infos"].get("tag", "init")
     start_epoch = configs["init_infos"].get('epoch', 0) + int("epoch_" in tag)
     epoch_n = configs["max_epoch"]
@@ -33,36 +47,80 @@ def train(model, train_loader, dev_loader, optimizer, scheduler, configs, logger
     clip = configs["model"]["grad_clip"]
     accum_grad = configs["accumulation_steps"]
     train_engine = configs["dist_conf"]["train_engine"]
+    # noise/reverb/speed perturb on the whole batch, None unless augment.batch_augment
+    batch_augment = init_batch_augment(configs["data_conf"], device)
+    # model.dtype fp16/bf16: autocast forward, dynamic loss scaling for fp16
+    autocast, scaler = init_amp(configs, model, device)
+    checkpointer.track_scaler(scaler)
+    # averaged weights on the device, saved as ema.pt with every checkpoint, if configs.ema
+    ema = init_ema(configs, model)
+    checkpointer.track_ema(ema)
+    skipped_steps = 0
+    # data wait/forward/backward/optimizer times, throughput, stragglers, if configs.telemetry
+    telemetry = init_telemetry(configs, device)
+    # pinned, double buffered host->device copies one batch ahead, if data_conf.device_loader
+    device_loader = init_device_loader(train_loader, configs["data_conf"], device)
+    # built once, its pinned buffers are reused by every evaluation
+    dev_device_loader = init_device_loader(dev_loader, configs["data_conf"], device)
 
     if rank == 0:
         logger.info("init_lr:{}".format(optimizer.state_dict()['param_groups'][0]['lr']))
     final_epoch = None
 
+    # stateful sampler (see fqdd/utils/samplers.py), None in shard mode
+    sampler = None
+    if not streaming:
+        sampler = train_loader.batch_sampler if isinstance(train_loader.batch_sampler, DynamicBucketBatchSampler) \
+            else train_loader.sampler
+    # cursors of every rank, saved by a mid-epoch checkpoint
+    sampler_states = configs["init_infos"].get("sampler_states")
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if sampler_states is not None and (sampler is None or len(sampler_states) != world_size):
+        logger.warning("can't resume the data order of {} ranks with world_size {}{}, "
+                       "restarting epoch {}".format(len(sampler_states), world_size,
+                                                    " in shard mode" if streaming else "", start_epoch))
+        sampler_states = None
+
     for epoch in range(start_epoch, epoch_n):
 
         if rank == 0:
             logger.info("Epoch {}/{}".format(epoch, epoch_n))
             logger.info("-" * 50)
 
-        infos = {"loss": [],
-                 "ctc_loss": [],
-                 "att_loss": [],
-                 "th_acc": []
-                 }
+        # summed on the device, read back only at log_interval and at the end of the epoch
+        infos = DeviceMetrics(["loss", "ctc_loss", "att_loss", "th_acc"], device)
         # 每一次新的epoch，重新打乱数据
-        train_loader.sampler.set_epoch(epoch)
+        if streaming:
+            train_loader.dataset.set_epoch(epoch)
+        else:
+            sampler.set_epoch(epoch)
+        if sampler_states is not None and sampler_states[rank]["epoch"] == epoch:
+            # skip the batches consumed before the checkpoint, by index
+            sampler.load_state_dict(sampler_states[rank])
+            if rank == 0:
+                logger.info("resume epoch {} after {} consumed entries".format(epoch, sampler.cursor))
+        sampler_states = None
         dist.barrier()  # 同步训练进程:
         group_join = dist.new_group(
             backend="gloo", timeout=datetime.timedelta(seconds=30))
         model.train()
-
-        for idx, batch_data in enumerate(tqdm(train_loader)):
+        # eval and epoch setup are not part of the first interval
+        telemetry.reset()
+
+        for idx, batch_data in enumerate(tqdm(device_loader)):
+            telemetry.data_ready()
+            # ranks may hold different numbers of batches in shard mode
+            if streaming and fqdd_join(group_join, idx):
+                break
             # 只做推理，代码不会更新模型状态
+            # no-ops when the device loader already moved the batch
             keys, feats, wav_lengths, targets, target_lens = batch_data
             feats = feats.to(device)
             wav_lengths = wav_lengths.to(device)
             targets = targets.to(device)
             target_lens = target_lens.to(device)
+            if batch_augment is not None:
+                feats, wav_lengths = batch_augment(feats, wav_lengths)
 
             context = None
             # Disable gradient synchronizations across DDP processes.
@@ -75,63 +133,99 @@ def train(model, train_loader, dev_loader, optimizer, scheduler, configs, logger
             else:
                 context = nullcontext
             with context():
-                batch_infos = model(feats, wav_lengths, targets, target_lens)
+                with telemetry.stage("forward"), autocast():
+                    batch_infos = model(feats, wav_lengths, targets, target_lens)
 
                 assert train_engine in ["torch_ddp", "torch_fsdp"]
                 scaled_loss = batch_infos["loss"] / accum_grad
-                scaled_loss.backward()
+                with telemetry.stage("backward"):
+                    scaler.scale(scaled_loss).backward()
 
             if (idx + 1) % accum_grad == 0:
-                if train_engine == "torch_ddp":
-                    grad_norm = clip_grad_norm_((p for p in model.parameters()), max_norm=clip)
-                else:
-                    grad_norm = model.clip_grad_norm_(clip)
-                if torch.isfinite(grad_norm):
-                    optimizer.step()
-                optimizer.zero_grad()
-                scheduler.step()
-
-            infos["loss"].append(batch_infos["loss"].item())
-            infos["ctc_loss"].append(batch_infos["ctc_loss"].item())
-            infos["att_loss"].append(batch_infos["att_loss"].item())
-            infos["th_acc"].append(batch_infos["th_acc"].item())
+                with telemetry.stage("optimizer"):
+                    # clip the real gradients, not the scaled ones
+                    scaler.unscale_(optimizer)
+                    if train_engine == "torch_ddp":
+                        grad_norm = clip_grad_norm_((p for p in model.parameters()), max_norm=clip)
+                    else:
+                        grad_norm = model.clip_grad_norm_(clip)
+                    telemetry.grad_norm(grad_norm)
+                    if torch.isfinite(grad_norm):
+                        scaler.step(optimizer)
+                    else:
+                        skipped_steps += 1
+                    # lowers the scale after an overflow, raises it after growth_interval good steps
+                    scaler.update()
+                    optimizer.zero_grad()
+                    scheduler.step()
+                    if ema is not None:
+                        ema.update(scheduler.last_epoch)
+
+            if sampler is not None:
+                sampler.advance(len(keys))
+            telemetry.step_end(wav_lengths, target_lens)
+
+            infos.update(batch_infos)
+            if sampler is not None and save_interval > 0 and (idx + 1) % save_interval == 0 \
+                    and (idx + 1) % accum_grad == 0:
+                # all ranks have the same number of batches here, collect every cursor on rank 0
+                states = [None] * world_size
+                dist.all_gather_object(states, sampler.state_dict())
+                checkpointer.save({
+                    "epoch": epoch,
+                    "save_time": datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+                    # no "epoch_" in the tag, resume continues this epoch
+                    "tag": "step_{}".format(scheduler.last_epoch),
+                    "step": scheduler.last_epoch,
+                    "sampler_states": states,
+                    **configs
+                })
+            if (idx + 1) % log_interval == 0 and (idx + 1) % accum_grad == 0:
+                # gathers from all ranks
+                telemetry.log(epoch, scheduler.last_epoch, logger)
             if rank == 0 and (idx + 1) % log_interval == 0 and (idx + 1) % accum_grad == 0:
-                interval_loss = sum(infos["loss"][-log_interval:]) / log_interval
-                interval_ctc_loss = sum(infos["ctc_loss"][-log_interval:]) / log_interval
-                interval_att_loss = sum(infos["att_loss"][-log_interval:]) / log_interval
-                interval_th_acc = sum(infos["th_acc"][-log_interval:]) / log_interval
+                interval = infos.interval()
                 logger.info(
                     "Epoch:{}/{}\ttrain:\tloss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}\tlr:{:.6f}".format(
                         epoch,
                         idx + 1,
-                        interval_loss,
-                        interval_ctc_loss,
-                        interval_att_loss,
-                        interval_th_acc,
+                        interval["loss"],
+                        interval["ctc_loss"],
+                        interval["att_loss"],
+                        interval["th_acc"],
                         optimizer.param_groups[0]["lr"]))
-
+                if scaler.is_enabled() or skipped_steps > 0:
+                    logger.info("amp:\tscale:{:.1f}\tskipped_steps:{}".format(scaler.get_scale(), skipped_steps))
+                    skipped_steps = 0
+                if hasattr(train_loader, "metrics"):
+                    logger.info("prefetch:\tdepth:{depth}\toccupancy:{occupancy:.2f}\tmean_mb:{mean_mb:.1f}"
+                                "\tpeak_mb:{peak_mb:.1f}\tstalls:{stalls}\tstall_s:{stall_s:.3f}".format(
+                                    **train_loader.metrics()))
+
+        # mean over the batches of all ranks
+        epoch_infos = infos.reduce()
         if rank == 0:
-            train_loss = sum(infos["loss"]) / (idx + 1)
-            train_ctc_loss = sum(infos["ctc_loss"]) / (idx + 1)
-            train_att_loss = sum(infos["att_loss"]) / (idx + 1)
-            train_th_acc = sum(infos["th_acc"]) / (idx + 1)
             logger.info(
-                "Epoch:{}\ttrain:\tloss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(epoch,
-                                                                                                        train_loss,
-                                                                                                        train_ctc_loss,
-                                                                                                        train_att_loss,
-                                                                                                        train_th_acc)
+                "Epoch:{}\ttrain:\tloss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(
+                    epoch,
+                    epoch_infos["loss"],
+                    epoch_infos["ctc_loss"],
+                    epoch_infos["att_loss"],
+                    epoch_infos["th_acc"])
             )
 
         dist.destroy_process_group(group_join)
         dist.barrier()  # 同步测试进程
         with torch.no_grad():
-            loss, ctc_loss, att_loss, th_acc = evaluate(model, dev_loader, epoch, configs, logger, rank, device)
-            logger.info(
-                "Epoch:{}\tCV:loss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(epoch, loss,
-                                                                                                   ctc_loss, att_loss,
-                                                                                                   th_acc)
-            )
+            # reduced over all ranks, the same numbers everywhere
+            loss, ctc_loss, att_loss, th_acc = evaluate(model, dev_device_loader, epoch, configs, logger, rank, device)
+            if rank == 0:
+                logger.info(
+                    "Epoch:{}\tCV:loss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(epoch, loss,
+                                                                                                       ctc_loss,
+                                                                                                       att_loss,
+                                                                                                       th_acc)
+                )
         info_dict = {
             "epoch": epoch,
             "save_time": datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
@@ -145,26 +239,57 @@ def train(model, train_loader, dev_loader, optimizer, scheduler, configs, logger
             },
             **configs
         }
-        save_model(model, info_dict)
+        checkpointer.save(info_dict)
         final_epoch = epoch
 
+    # the last checkpoint is on disk before final.pt points to it
+    checkpointer.wait()
     if final_epoch is not None and rank == 0:
         final_model_path = os.path.join(configs["model_dir"], 'final.pt')
         os.remove(final_model_path) if os.path.exists(
             final_model_path) else None
-        os.symlink('{}.pt'.format(final_epoch), final_model_path)
+        os.symlink('epoch_{}.pt'.format(final_epoch), final_model_path)
 
 
 def evaluate(model, eval_loader, epoch, configs, logger, rank, device):
+    """ CV loss/accuracy, every rank scores its own shard of the dev set.
+
+        Losses are weighted by utterances and th_acc by tokens, then summed
+        over all ranks, so the result is the exact mean over the dev set.
+        FSDP forwards are collectives: a rank that ran out of batches repeats
+        its last one with weight 0 until all ranks are done. DDP is
+        unwrapped, its ranks run independently. With fewer dev shards than
+        ranks every rank scores the whole dev set (see
+        `init_dataset_and_dataloader`), which leaves the means unchanged.
+
+        eval_loader is the dev loader, wrapped by `init_device_loader`.
+    """
+    lockstep = isinstance(model, FullyShardedDataParallel) and dist.is_initialized()
+    autocast, _ = init_amp(configs, model, device)
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
     model.eval()
-    infos = {"loss": [],
-             "ctc_loss": [],
-             "att_loss": [],
-             "th_acc": []
-             }
+    infos = DeviceMetrics(["loss", "ctc_loss", "att_loss", "th_acc"], device)
 
     log_interval = configs["log_interval"]
-    for idx, batch_data in enumerate(tqdm(eval_loader)):
+    eval_loader = iter(tqdm(eval_loader))
+    idx, last_batch = -1, None
+    while True:
+        batch_data = next(eval_loader, None)
+        if lockstep:
+            pending = torch.tensor([int(batch_data is not None)], device=device)
+            dist.all_reduce(pending, op=dist.ReduceOp.MAX)
+            if pending.item() == 0:
+                break
+        elif batch_data is None:
+            break
+        weight = 1.0
+        if batch_data is None:
+            # uneven tail, keep the other ranks' forwards company
+            assert last_batch is not None, "fewer dev batches than ranks"
+            batch_data, weight = last_batch, 0.0
+        last_batch = batch_data
+        idx += 1
 
         keys, feats, wav_lengths, targets, target_lens = batch_data
         feats = feats.to(device)
@@ -172,28 +297,26 @@ def evaluate(model, eval_loader, epoch, configs, logger, rank, device):
         targets = targets.to(device)
         target_lens = target_lens.to(device)
         # print(feats.shape)
-        batch_infos = model(feats, wav_lengths, targets, target_lens)
-        infos["loss"].append(batch_infos["loss"].item())
-        infos["ctc_loss"].append(batch_infos["ctc_loss"].item())
-        infos["att_loss"].append(batch_infos["att_loss"].item())
-        infos["th_acc"].append(batch_infos["th_acc"].item())
+        with autocast():
+            batch_infos = model(feats, wav_lengths, targets, target_lens)
+        # python number, DeviceMetrics multiplies it in without a host->device copy
+        num_utts = len(keys) * weight
+        # th_acc is over the decoder targets, <eos> included
+        num_tokens = (target_lens + 1).sum() * weight
+        infos.update(batch_infos, {"loss": num_utts, "ctc_loss": num_utts, "att_loss": num_utts,
+                                   "th_acc": num_tokens})
         if rank == 0 and (idx + 1) % log_interval == 0:
-            interval_loss = sum(infos["loss"][-log_interval:]) / log_interval
-            interval_ctc_loss = sum(infos["ctc_loss"][-log_interval:]) / log_interval
-            interval_att_loss = sum(infos["att_loss"][-log_interval:]) / log_interval
-            interval_th_acc = sum(infos["th_acc"][-log_interval:]) / log_interval
+            interval = infos.interval()
             logger.info(
-                "Epoch:{}/{}\tCV:\tloss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(epoch, idx + 1,
-                                                                                                        interval_loss,
-                                                                                                        interval_ctc_loss,
-                                                                                                        interval_att_loss,
-                                                                                                        interval_th_acc)
+                "Epoch:{}/{}\tCV:\tloss:{:.4f}\tctc_loss:{:.4f}\tatt_loss:{:.4f}\tth_acc:{:.4f}".format(
+                    epoch, idx + 1,
+                    interval["loss"],
+                    interval["ctc_loss"],
+                    interval["att_loss"],
+                    interval["th_acc"])
             )
-    cv_loss = sum(infos["loss"]) / (idx + 1)
-    cv_ctc_loss = sum(infos["ctc_loss"]) / (idx + 1)
-    cv_att_loss = sum(infos["att_loss"]) / (idx + 1)
-    cv_th_acc = sum(infos["th_acc"]) / (idx + 1)
-    return cv_loss, cv_ctc_loss, cv_att_loss, cv_th_acc
+    cv_infos = infos.reduce()
+    return cv_infos["loss"], cv_infos["ctc_loss"], cv_infos["att_loss"], cv_infos["th_acc"]
 
 
 def main():
@@ -213,7 +336,13 @@ def main():
 
     configs["model"]["vocab_size"] = tokenizer.vocab_size()
     model, configs = init_model(args, configs)
+    # DDP/FSDP from dist_conf, before the optimizer sees the parameters
+    model = wrap_model(args, model, configs)
     model, optimizer, scheduler = init_optimizer_and_scheduler(configs, model)
+    # optimizer/scheduler/scaler state next to the model checkpoint, async step/epoch saves
+    checkpointer = init_checkpointer(configs, model, optimizer, scheduler)
+    if args.checkpoint is not None:
+        checkpointer.resume(args.checkpoint)
 
     if rank == 0:
         logger.info(model)
@@ -229,7 +358,6 @@ def main():
                })
 
     device = args.device
-    model.to(device)
 
     train_set, train_loader, train_sampler, dev_set, dev_loader = init_dataset_and_dataloader(args,
                                                                                               configs,
@@ -237,7 +365,7 @@ def main():
                                                                                               seed=configs["seed"]
                                                                                               )
 
-    train(model, train_loader, dev_loader, optimizer, scheduler, configs, logger, rank, device)
+    train(model, train_loader, dev_loader, optimizer, scheduler, checkpointer, configs, logger, rank, device)
     # Tear down the process group
     dist.destroy_process_group()
 
@@ -48,6 +48,30 @@ def get_args():
     return args
 
 
+def average_checkpoints(path_list):
+    """ Mean of the state dicts in path_list, streamed one tensor at a time.
+
+        The checkpoints are memory-mapped, not read, so only the pages of
+        the tensor being averaged are resident. Every tensor is summed in a
+        float64 accumulator and cast back to its dtype; integer tensors
+        (e.g. num_batches_tracked) are taken from the last checkpoint.
+    """
+    states = []
+    for path in path_list:
+        print('Processing {}'.format(path))
+        states.append(torch.load(path, map_location='cpu', mmap=True))
+    avg = {}
+    for k, v in states[-1].items():
+        if not torch.is_floating_point(v):
+            avg[k] = v.clone()
+            continue
+        acc = torch.zeros(v.shape, dtype=torch.float64)
+        for state in states:
+            acc += state[k]
+        avg[k] = (acc / len(states)).to(v.dtype)
+    return avg
+
+
 def main():
     args = get_args()
     checkpoints = []
@@ -62,36 +86,28 @@ def main():
                 tag = dic_json['tag']
                 if args.min_epoch <= epoch <= args.max_epoch:
                     val_scores += [[epoch, loss, tag]]
+        # lowest cv loss first
         sorted_val_scores = sorted(val_scores,
-                                   key=lambda x: x[2],
+                                   key=lambda x: x[1],
                                    reverse=False)
-        print("best val (epoch, step, loss, tag) = " +
+        print("best val (epoch, loss, tag) = " +
               str(sorted_val_scores[:args.num]))
         path_list = [
             args.src_path + '/{}.pt'.format(score[-1])
             for score in sorted_val_scores[:args.num]
         ]
     else:
-        path_list = glob.glob('{}/[!init]*.pt'.format(args.src_path))
+        # model checkpoints only: no init/final(symlink)/ema, no training state (*.state.pt)
+        path_list = [
+            path for path in glob.glob('{}/*.pt'.format(args.src_path))
+            if os.path.basename(path) not in ['init.pt', 'final.pt', 'ema.pt'] and not path.endswith('.state.pt')
+        ]
         path_list = sorted(path_list, key=os.path.getmtime)
         path_list = path_list[-args.num:]
     print(path_list)
-    avg = {}
     num = args.num
     assert num == len(path_list)
-    for path in path_list:
-        print('Processing {}'.format(path))
-        states = torch.load(path, map_location=torch.device('cpu'))
-        for k in states.keys():
-            if k not in avg.keys():
-                avg[k] = states[k].clone()
-            else:
-                avg[k] += states[k]
-    # average
-    for k in avg.keys():
-        if avg[k] is not None:
-            # pytorch 1.6 use true_divide instead of /=
-            avg[k] = torch.true_divide(avg[k], num)
+    avg = average_checkpoints(path_list)
     print('Saving to {}'.format(args.dst_model))
     torch.save(avg, args.dst_model)
 
@@ -0,0 +1,204 @@
+"""Measure the training input pipeline without a model.
+
+Drives `init_dataset_and_dataloader` for --num_batches batches under every
+combination of --num_workers and --prefetch and reports per setting:
+utterances/s, audio-seconds/s, p50/p95 latency of every Dataload stage
+(readwav, resample, add_noise, ..., compute_feat, spec_*, tokenize, collate),
+the time the consumer waits for a batch, worker RSS and padding waste.
+
+    python fqdd/bin/benchmark_data.py --train_config conf/conformer_conf.json \
+        --train_data data/train/data.list --num_workers 2,4,8 --prefetch 2,8 \
+        --output exp/benchmark_data.json
+"""
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, "./")
+
+from fqdd.text.init_tokenizer import Tokenizers
+from fqdd.utils.load_data import init_dataset_and_dataloader
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark the data loader')
+    parser.add_argument('--train_config', required=True, help='training config')
+    parser.add_argument('--train_data', required=True, help='data.list or shards.list')
+    parser.add_argument('--num_batches', type=int, default=200, help='measured batches per setting')
+    parser.add_argument('--warmup', type=int, default=10, help='batches skipped before measuring')
+    parser.add_argument('--num_workers', default='4', help='comma separated, e.g. 2,4,8')
+    parser.add_argument('--prefetch', default='2', help='comma separated prefetch factors')
+    parser.add_argument('--output', default=None, help='json result file, default stdout')
+    return parser.parse_args()
+
+
+class ProfiledCollate:
+    """ Wraps the loader's collate_fn (pack_collate_fn with data_conf.device_loader),
+        ships the worker's stage timings with the batch.
+    """
+
+    def __init__(self, timer, collate):
+        self.timer = timer
+        self.collate = collate
+
+    def __call__(self, data):
+        with self.timer.stage("collate"):
+            batch = self.collate(data)
+        return batch, self.timer.drain()
+
+
+def rss_mb(pid):
+    try:
+        with open("/proc/{}/statm".format(pid), 'r') as fin:
+            return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError):
+        return 0.0
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {"p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "mean_ms": float(values.mean()),
+            "count": int(values.size)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def frames_to_seconds(data_conf):
+    """ Seconds per unit of the lengths returned by collate_fn.
+    """
+    feat_type = data_conf.get("feat_type")
+    if feat_type in ["fbank", "mfcc"]:
+        return data_conf.get("{}_conf".format(feat_type), {}).get("frame_shift", 10) / 1000
+    return 1.0 / data_conf.get("sample_rate", 16000)
+
+
+def run(configs, args, tokenizer, num_workers, prefetch):
+    configs = copy.deepcopy(configs)
+    data_conf = configs["data_conf"]
+    data_conf["num_workers"] = num_workers
+    data_conf["prefetch"] = prefetch
+    loader_args = argparse.Namespace(train_data=args.train_data, dev_data=args.dev_data)
+    train_set, train_loader, _, _, _ = init_dataset_and_dataloader(loader_args, configs, tokenizer,
+                                                                   seed=configs.get("seed", 777))
+    # set before the workers fork, each worker gets an enabled copy
+    train_set.timer.enabled = True
+    # the DataLoader itself, below the AdaptivePrefetcher if there is one
+    data_loader = getattr(train_loader, "loader", train_loader)
+    data_loader.collate_fn = ProfiledCollate(train_set.timer, data_loader.collate_fn)
+    if hasattr(train_loader, "metrics"):
+        train_loader.metrics()
+    unit = frames_to_seconds(data_conf)
+
+    stages, waits, worker_rss = {}, [], []
+    num_utts, audio_seconds, real, padded = 0, 0.0, 0.0, 0.0
+    it = iter(train_loader)
+    seen, measured = 0, 0
+    start = None
+    while measured < args.num_batches:
+        t0 = time.perf_counter()
+        try:
+            batch, times = next(it)
+        except StopIteration:
+            # short list, start another pass
+            it = iter(train_loader)
+            continue
+        t1 = time.perf_counter()
+        seen += 1
+        if seen <= args.warmup:
+            continue
+        if start is None:
+            start = t0
+        measured += 1
+        waits.append(t1 - t0)
+        for name, values in times.items():
+            stages.setdefault(name, []).extend(values)
+
+        lens = batch[2].numpy()
+        num_utts += len(lens)
+        audio_seconds += float(lens.sum()) * unit
+        real += float(lens.sum())
+        padded += float(lens.max()) * len(lens)
+        if measured % 10 == 1:
+            worker_rss.append([rss_mb(p.pid) for p in multiprocessing.active_children()])
+    elapsed = time.perf_counter() - start
+
+    worker_rss = [x for sample in worker_rss for x in sample]
+    result = {
+        "num_workers": num_workers,
+        "prefetch": prefetch,
+        "batches": measured,
+        "utterances_per_s": num_utts / elapsed,
+        "audio_seconds_per_s": audio_seconds / elapsed,
+        "batch_wait": percentiles(waits),
+        "stages": {name: percentiles(values) for name, values in sorted(stages.items())},
+        "worker_rss_mb": {"max": max(worker_rss, default=0.0),
+                          "mean": float(np.mean(worker_rss)) if worker_rss else 0.0},
+        "main_rss_mb": rss_mb(os.getpid()),
+        "padding_waste": 1.0 - real / padded if padded > 0 else 0.0,
+    }
+    if hasattr(train_loader, "metrics"):
+        result["prefetcher"] = train_loader.metrics()
+    del it, train_loader, train_set
+    gc.collect()
+    return result
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    configs = json.load(open(args.train_config, 'r', encoding="utf-8"))
+    tokenizer = Tokenizers(configs)
+
+    # the dev loader is built too but never read: one entry of the train list, not all of it
+    tmp_dir = tempfile.TemporaryDirectory()
+    args.dev_data = os.path.join(tmp_dir.name, os.path.basename(args.train_data))
+    with open(args.train_data, 'r', encoding='utf8') as fin, open(args.dev_data, 'w', encoding='utf8') as fout:
+        fout.write(next(line for line in fin if line.strip()))
+
+    results = []
+    for num_workers in [int(x) for x in args.num_workers.split(',')]:
+        assert num_workers > 0, "the training loader uses persistent workers, num_workers must be > 0"
+        for prefetch in [int(x) for x in args.prefetch.split(',')]:
+            result = run(configs, args, tokenizer, num_workers, prefetch)
+            logging.info("num_workers {} prefetch {}: {:.1f} utts/s, {:.1f} audio s/s, "
+                         "wait p50 {:.1f}ms p95 {:.1f}ms, padding {:.3f}".format(
+                num_workers, prefetch, result["utterances_per_s"], result["audio_seconds_per_s"],
+                result["batch_wait"]["p50_ms"], result["batch_wait"]["p95_ms"], result["padding_waste"]))
+            results.append(result)
+
+    report = {
+        "train_config": args.train_config,
+        "train_data": args.train_data,
+        "commit": git_commit(),
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w', encoding='utf8') as fout:
+            json.dump(report, fout, indent=2)
+    tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Find the largest frames-per-batch budget that fits on this GPU.
+
+Builds the model of --train_config with `init_model` and runs training steps
+(forward, backward and optimizer step, under the configured model.dtype and
+gradient checkpointing) on synthetic batches of --utt_frames long
+utterances with --frames_per_token frames per label. The number of frames
+per batch is doubled from --min_frames until a step runs out of memory or
+its peak reserved memory exceeds the limit, then bisected down to
+--tolerance frames. The recommended data_conf.batch_conf.max_frames_in_batch
+is the largest fitting budget times --margin; --update_config writes it,
+with batch_type dynamic, into the config.
+
+    python fqdd/bin/find_batch_frames.py --train_config conf/conformer_conf.json \
+        --device cuda:0 --utt_frames 1000 --output exp/batch_frames.json
+"""
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, "./")
+
+from fqdd.models.init_model import init_model
+from fqdd.text.init_tokenizer import Tokenizers
+from fqdd.utils.device_loader import frame_elements
+from fqdd.utils.train_utils import init_amp, init_optimizer_and_scheduler
+
+# data_conf.feat_type of models that take the waveform, see fqdd/modules/frontend.py
+RAW_FEAT_TYPES = ["raw", "raw_int16"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='find the max frames per batch')
+    parser.add_argument('--train_config', required=True, help='training config')
+    parser.add_argument('--device', default='cuda:0', help='cuda device to measure')
+    parser.add_argument('--vocab_size', type=int, default=None, help='default: vocab size of the tokenizer')
+    parser.add_argument('--utt_frames', type=int, default=1000, help='frames(10ms) per synthetic utterance')
+    parser.add_argument('--frames_per_token', type=int, default=25, help='label length = utt_frames / this')
+    parser.add_argument('--min_frames', type=int, default=2000, help='first budget tried')
+    parser.add_argument('--max_frames', type=int, default=1000000, help='upper bound of the search')
+    parser.add_argument('--tolerance', type=int, default=500, help='stop bisecting below this many frames')
+    parser.add_argument('--memory_mb', type=float, default=None, help='memory limit, default: device total')
+    parser.add_argument('--repeats', type=int, default=2, help='training steps per budget')
+    parser.add_argument('--margin', type=float, default=0.9, help='recommended = largest fitting budget * margin')
+    parser.add_argument('--output', default=None, help='json result file, default stdout')
+    parser.add_argument('--update_config', action='store_true', help='write the budget into --train_config')
+    return parser.parse_args()
+
+
+def synthetic_batch(data_conf, vocab_size, num_frames, utt_frames, frames_per_token, device):
+    """ (feats, x_lens, targets, y_lens) with num_frames frames in utt_frames long utterances.
+    """
+    batch_size = max(1, num_frames // utt_frames)
+    elements = frame_elements(data_conf)
+    num_tokens = max(1, utt_frames // frames_per_token)
+    if data_conf.get("feat_type", "fbank") in RAW_FEAT_TYPES:
+        # (B, samples) waveform in int16 scale, featurized by the model's frontend
+        feats = torch.randn(batch_size, utt_frames * elements, device=device) * 3000
+        x_lens = torch.full((batch_size,), utt_frames * elements, dtype=torch.int32, device=device)
+    else:
+        feats = torch.randn(batch_size, utt_frames, elements, device=device)
+        x_lens = torch.full((batch_size,), utt_frames, dtype=torch.int32, device=device)
+    # no blank(0) and no sos/eos(vocab_size - 1)
+    targets = torch.randint(1, vocab_size - 1, (batch_size, num_tokens), device=device)
+    y_lens = torch.full((batch_size,), num_tokens, dtype=torch.int32, device=device)
+    return feats, x_lens, targets, y_lens
+
+
+class StepProbe:
+    """ Peak memory of training steps at a given frames-per-batch budget.
+    """
+
+    def __init__(self, configs, args):
+        self.configs = configs
+        self.args = args
+        self.device = torch.device(args.device)
+        model, configs = init_model(argparse.Namespace(checkpoint=None), configs)
+        model.to(self.device)
+        model.train()
+        # Adam moments count, they are allocated by the first step
+        self.model, self.optimizer, _ = init_optimizer_and_scheduler(configs, model)
+        self.autocast, self.scaler = init_amp(configs, model, self.device)
+
+    def step(self, batch):
+        with self.autocast():
+            loss = self.model(*batch)["loss"]
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def measure(self, num_frames):
+        """ Returns: (peak reserved MB, peak allocated MB), None on out of memory
+        """
+        args = self.args
+        result = None
+        try:
+            batch = synthetic_batch(self.configs["data_conf"], self.configs["model"]["vocab_size"], num_frames,
+                                    args.utt_frames, args.frames_per_token, self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            for _ in range(args.repeats):
+                self.step(batch)
+            torch.cuda.synchronize(self.device)
+            result = (torch.cuda.max_memory_reserved(self.device) / (1 << 20),
+                      torch.cuda.max_memory_allocated(self.device) / (1 << 20))
+        except torch.cuda.OutOfMemoryError:
+            pass
+        finally:
+            batch = None
+            self.optimizer.zero_grad(set_to_none=True)
+            gc.collect()
+            torch.cuda.empty_cache()
+        return result
+
+
+def search(fits, min_frames, max_frames, tolerance):
+    """ Largest budget in [min_frames, max_frames] with fits(budget), 0 if none.
+
+        Doubles until the first failure, then bisects; assumes memory grows
+        with the budget.
+    """
+    good, bad = 0, None
+    frames = min_frames
+    while bad is None:
+        if not fits(frames):
+            bad = frames
+        elif frames >= max_frames:
+            return frames
+        else:
+            good = frames
+            frames = min(frames * 2, max_frames)
+    if good == 0:
+        # not even min_frames
+        return 0
+    while bad - good > tolerance:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    return good
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    assert torch.cuda.is_available() and "cuda" in args.device, "peak memory is measured on a cuda device"
+    configs = json.load(open(args.train_config, 'r', encoding="utf-8"))
+    measured = copy.deepcopy(configs)
+    measured["init_infos"] = {}
+    measured["model"]["vocab_size"] = args.vocab_size or Tokenizers(measured).vocab_size()
+
+    device = torch.device(args.device)
+    limit_mb = args.memory_mb or torch.cuda.get_device_properties(device).total_memory / (1 << 20)
+    probe = StepProbe(measured, args)
+    points = []
+
+    def fits(num_frames):
+        start = time.perf_counter()
+        peak = probe.measure(num_frames)
+        ok = peak is not None and peak[0] <= limit_mb
+        points.append({"frames": num_frames, "fits": ok,
+                       "peak_reserved_mb": peak[0] if peak else None,
+                       "peak_allocated_mb": peak[1] if peak else None,
+                       "step_s": (time.perf_counter() - start) / args.repeats})
+        logging.info("{} frames: {}".format(num_frames, "peak {:.0f}MB reserved, {:.0f}MB allocated".format(*peak)
+                                            if peak else "out of memory"))
+        return ok
+
+    largest = search(fits, args.min_frames, args.max_frames, args.tolerance)
+    recommended = int(largest * args.margin)
+    logging.info("largest fitting budget {} frames, recommended max_frames_in_batch {}".format(largest, recommended))
+
+    report = {
+        "train_config": args.train_config,
+        "device": torch.cuda.get_device_name(device),
+        "memory_limit_mb": limit_mb,
+        "dtype": measured["model"].get("dtype", "fp32"),
+        "utt_frames": args.utt_frames,
+        "frames_per_token": args.frames_per_token,
+        "largest_frames": largest,
+        "margin": args.margin,
+        "max_frames_in_batch": recommended,
+        "points": sorted(points, key=lambda x: x["frames"]),
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w', encoding='utf8') as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.update_config and recommended > 0:
+        batch_conf = configs["data_conf"].setdefault("batch_conf", {})
+        batch_conf["batch_type"] = "dynamic"
+        batch_conf["max_frames_in_batch"] = recommended
+        with open(args.train_config, 'w', encoding='utf8') as fout:
+            json.dump(configs, fout, indent=2, ensure_ascii=False)
+        logging.info("{}: batch_conf {}".format(args.train_config, batch_conf))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,8 @@ class Conformer(nn.Module):
         self.ctc_weight = model_conf["ctc_weight"]
 
         self.reverse_weight = 0.0
+        # print ctc argmax/lengths of every batch, syncs the device
+        self.debug = model_conf.get("debug", False)
 
         self.length_normalized_loss = model_conf["length_normalized_loss"]
         self.sos = (self.vocab_size - 1 if self.special_tokens is None else
@@ -41,7 +43,8 @@ class Conformer(nn.Module):
                     self.special_tokens.get("<eos>", self.vocab_size - 1))
         # print(self.sos, self.eos)
 
-        self.encoder = ConformerEncoder(encoder_conf, use_cmvn, cmvn_file)
+        self.encoder = ConformerEncoder(encoder_conf, use_cmvn, cmvn_file,
+                                        frontend_conf=model_conf.get("frontend_conf", None))
         self.decoder = TransformerDecoder(self.vocab_size, decoder_conf)
 
         ctc_conf = model_conf.get("ctc_conf", None)
@@ -61,7 +64,8 @@ class Conformer(nn.Module):
 
         ctcloss, y_hats = self.ctcloss(encoder_out, encoder_out_lens, padding_ys, ys_lens)
 
-        print("output:{}\nencoder_out_lens:{}".format(torch.argmax(y_hats, dim=2), encoder_out_lens))
+        if self.debug:
+            print("output:{}\nencoder_out_lens:{}".format(torch.argmax(y_hats, dim=2), encoder_out_lens))
 
         ys_in_pad, ys_out_pad = add_sos_eos(padding_ys, self.sos, self.eos, self.ignore_id)
         ys_in_lens = ys_lens + 1
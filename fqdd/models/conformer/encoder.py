@@ -5,9 +5,11 @@ import torch.nn
 import torch
 
 from fqdd.models.conformer.encoder_layer import ConformerEncoderLayer
-from fqdd.modules.model_utils import FQDD_MLPS, FQDD_SUBSAMPLES, FQDD_EMBEDDINGS, FQDD_ATTENTIONS
+from fqdd.modules.model_utils import FQDD_MLPS, FQDD_SUBSAMPLES, FQDD_EMBEDDINGS, FQDD_ATTENTIONS, \
+    LayerDropModuleList, layer_drop_rates, forward_layers_checkpointed
 from fqdd.nnets.CNN import ConvolutionModule
 from fqdd.nnets.base_utils import FQDD_ACTIVATIONS, FQDD_NORMALIZES
+from fqdd.modules.frontend import FbankFrontend
 from fqdd.utils.common import load_json_cmvn, GlobalCMVN
 from fqdd.utils.mask import make_pad_mask
 
@@ -19,7 +21,8 @@ class ConformerEncoder(torch.nn.Module):
             self,
             encoder_conf,
             use_cmvn: bool = False,
-            cmvn_file: str = None
+            cmvn_file: str = None,
+            frontend_conf=None
     ):
         """Construct ConformerEncoder
 
@@ -66,6 +69,13 @@ class ConformerEncoder(torch.nn.Module):
         conv_bias = encoder_conf.get("conv_bias", True)
         layer_norm_type = encoder_conf.get("layer_norm_type", "layer_norm")
         norm_eps: float = encoder_conf.get("norm_eps", 1e-5)
+        # recompute the activations of every checkpoint_every-th layer in backward
+        self.gradient_checkpointing = encoder_conf.get("gradient_checkpointing", False)
+        self.checkpoint_every = encoder_conf.get("checkpoint_every", 1)
+        # LayerDrop, skip whole layers in training, same layers on every rank
+        layer_drop_rate = encoder_conf.get("layer_drop_rate", 0.0)
+        layer_drop_schedule = encoder_conf.get("layer_drop_schedule", "linear")
+        layer_drop_seed = encoder_conf.get("layer_drop_seed", 4233)
         n_kv_head = encoder_conf.get("n_kv_head", None)
         head_dim = encoder_conf.get("head_dim", None)
         mlp_type = encoder_conf.get("mlp_type", "position_wise_feed_forward")
@@ -77,6 +87,11 @@ class ConformerEncoder(torch.nn.Module):
 
         self._output_size = output_size
 
+        # on-device fbank/mfcc + spec augment, input is then (B, T) int16 scale waveform
+        self.frontend = None
+        if frontend_conf is not None:
+            self.frontend = FbankFrontend(frontend_conf)
+
         self.global_cmvn = None
         if use_cmvn:
             mean, std = load_json_cmvn(cmvn_file)
@@ -121,21 +136,24 @@ class ConformerEncoder(torch.nn.Module):
                                   cnn_module_norm, causal, conv_bias)
 
         mlp_class = FQDD_MLPS[mlp_type]
-        self.encoders = torch.nn.ModuleList([
-            ConformerEncoderLayer(
-                output_size,
-                FQDD_ATTENTIONS[selfattention_layer_type](
-                    *encoder_selfattn_layer_args),
-                mlp_class(*positionwise_layer_args),
-                mlp_class(*positionwise_layer_args) if macaron_style else None,
-                ConvolutionModule(
-                    *convolution_layer_args) if use_cnn_module else None,
-                dropout_rate,
-                normalize_before,
-                layer_norm_type=layer_norm_type,
-                norm_eps=norm_eps,
-            ) for _ in range(num_blocks)
-        ])
+        self.encoders = LayerDropModuleList(
+            p=layer_drop_rates(layer_drop_rate, num_blocks, layer_drop_schedule),
+            seed=layer_drop_seed,
+            modules=[
+                ConformerEncoderLayer(
+                    output_size,
+                    FQDD_ATTENTIONS[selfattention_layer_type](
+                        *encoder_selfattn_layer_args),
+                    mlp_class(*positionwise_layer_args),
+                    mlp_class(*positionwise_layer_args) if macaron_style else None,
+                    ConvolutionModule(
+                        *convolution_layer_args) if use_cnn_module else None,
+                    dropout_rate,
+                    normalize_before,
+                    layer_norm_type=layer_norm_type,
+                    norm_eps=norm_eps,
+                ) for _ in range(num_blocks)
+            ])
 
     def output_size(self) -> int:
         return self._output_size
@@ -170,6 +188,8 @@ class ConformerEncoder(torch.nn.Module):
             checkpointing API because `__call__` attaches all the hooks of the module.
             https://discuss.pytorch.org/t/any-different-between-model-input-and-model-forward-input/3690/2
         """
+        if self.frontend is not None:
+            xs, xs_lens = self.frontend(xs, xs_lens)
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         if self.global_cmvn is not None:
@@ -178,7 +198,11 @@ class ConformerEncoder(torch.nn.Module):
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = masks
 
-        xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
+        if self.gradient_checkpointing and self.training:
+            xs = forward_layers_checkpointed(self.encoders, self.checkpoint_every, xs, chunk_masks, pos_emb,
+                                              mask_pad)
+        else:
+            xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
         if self.normalize_before:
             xs = self.after_norm(xs)
         # Here we assume the mask is not changed in encoder layers, so just
@@ -187,6 +187,3 @@ class CrdnnEncoder(nn.Module):
         for layer in self.dnn_block:
             x = layer(x)
         return x
-
-
-CrdnnEncoder()
\ No newline at end of file
@@ -3,7 +3,8 @@ from typing import Tuple
 import torch
 
 from fqdd.models.ebranchformer.decoder_layer import DecoderLayer
-from fqdd.modules.model_utils import FQDD_EMBEDDINGS, FQDD_MLPS, FQDD_ATTENTIONS
+from fqdd.modules.model_utils import FQDD_EMBEDDINGS, FQDD_MLPS, FQDD_ATTENTIONS, LayerDropModuleList, \
+    layer_drop_rates, forward_layers_checkpointed
 from fqdd.nnets.base_utils import FQDD_ACTIVATIONS, FQDD_NORMALIZES
 from fqdd.utils.mask import make_pad_mask, subsequent_mask
 
@@ -45,6 +46,10 @@ class TransformerDecoder(torch.nn.Module):
         encoder_output_size = decoder_conf.get("encoder_output_size", 256)
         linear_units = decoder_conf.get("linear_units", 2048)
         num_blocks = decoder_conf.get("num_blocks", 6)
+        # LayerDrop, skip whole layers in training, same layers on every rank
+        layer_drop_rate = decoder_conf.get("layer_drop_rate", 0.0)
+        layer_drop_schedule = decoder_conf.get("layer_drop_schedule", "linear")
+        layer_drop_seed = decoder_conf.get("layer_drop_seed", 4234)
         dropout_rate = decoder_conf.get("dropout_rate", 0.1)
         activation_type = decoder_conf.get("activation_type", "relu")
         normalize_before = decoder_conf.get("normalize_before", True)
@@ -66,6 +71,9 @@ class TransformerDecoder(torch.nn.Module):
         norm_eps: float = decoder_conf.get("norm_eps", 1e-5)
         input_layer = decoder_conf.get("input_layer", "embed")
         layer_norm_type = decoder_conf.get("layer_norm_type", "layer_norm")
+        # recompute the activations of every checkpoint_every-th layer in backward
+        self.gradient_checkpointing = decoder_conf.get("gradient_checkpointing", False)
+        self.checkpoint_every = decoder_conf.get("checkpoint_every", 1)
 
         attention_dim = encoder_output_size
         activation = FQDD_ACTIVATIONS[activation_type]()
@@ -86,29 +94,32 @@ class TransformerDecoder(torch.nn.Module):
         self.num_blocks = num_blocks
 
         mlp_class = FQDD_MLPS[mlp_type]
-        self.decoders = torch.nn.ModuleList([
-            DecoderLayer(
-                attention_dim,
-                FQDD_ATTENTIONS["selfattn"](
-                    attention_heads, attention_dim,
-                    self_attention_dropout_rate, query_bias, key_bias,
-                    value_bias, n_kv_head, head_dim),
-                FQDD_ATTENTIONS["crossattn"](
-                    attention_heads, attention_dim, src_attention_dropout_rate,
-                    query_bias, key_bias, value_bias, n_kv_head,
-                    head_dim) if src_attention else None,
-                mlp_class(attention_dim,
-                          linear_units,
-                          dropout_rate,
-                          activation,
-                          mlp_bias,
-                          n_expert=n_expert,
-                          n_expert_activated=n_expert_activated),
-                dropout_rate,
-                normalize_before,
-                norm_eps,
-            ) for _ in range(self.num_blocks)
-        ])
+        self.decoders = LayerDropModuleList(
+            p=layer_drop_rates(layer_drop_rate, self.num_blocks, layer_drop_schedule),
+            seed=layer_drop_seed,
+            modules=[
+                DecoderLayer(
+                    attention_dim,
+                    FQDD_ATTENTIONS["selfattn"](
+                        attention_heads, attention_dim,
+                        self_attention_dropout_rate, query_bias, key_bias,
+                        value_bias, n_kv_head, head_dim),
+                    FQDD_ATTENTIONS["crossattn"](
+                        attention_heads, attention_dim, src_attention_dropout_rate,
+                        query_bias, key_bias, value_bias, n_kv_head,
+                        head_dim) if src_attention else None,
+                    mlp_class(attention_dim,
+                              linear_units,
+                              dropout_rate,
+                              activation,
+                              mlp_bias,
+                              n_expert=n_expert,
+                              n_expert_activated=n_expert_activated),
+                    dropout_rate,
+                    normalize_before,
+                    norm_eps,
+                ) for _ in range(self.num_blocks)
+            ])
 
     def forward(
             self,
@@ -153,7 +164,11 @@ class TransformerDecoder(torch.nn.Module):
 
         x, _ = self.embed(tgt)
 
-        x = self.forward_layers(x, tgt_mask, memory, memory_mask)
+        if self.gradient_checkpointing and self.training:
+            x = forward_layers_checkpointed(self.decoders, self.checkpoint_every, x, tgt_mask, memory,
+                                             memory_mask)
+        else:
+            x = self.forward_layers(x, tgt_mask, memory, memory_mask)
         if self.normalize_before:
             x = self.after_norm(x)
         if self.use_output_layer:
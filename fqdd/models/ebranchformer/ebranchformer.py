@@ -45,7 +45,8 @@ class EBranchformer(nn.Module):
                     self.special_tokens.get("<eos>", self.vocab_size - 1))
         # print(self.sos, self.eos)
 
-        self.encoder = EBranchformerEncoder(encoder_conf, use_cmvn, cmvn_file)
+        self.encoder = EBranchformerEncoder(encoder_conf, use_cmvn, cmvn_file,
+                                            frontend_conf=model_conf.get("frontend_conf", None))
 
         self.decoder = TransformerDecoder(self.vocab_size, decoder_conf)
 
@@ -5,7 +5,9 @@ import torch.nn as nn
 
 from fqdd.nnets.base_utils import FQDD_NORMALIZES, FQDD_ACTIVATIONS
 from fqdd.models.ebranchformer.encoder_layer import ConvolutionalGatingMLP, EBranchformerEncoderLayer
-from fqdd.modules.model_utils import FQDD_MLPS, FQDD_EMBEDDINGS, FQDD_SUBSAMPLES, LayerDropModuleList, FQDD_ATTENTIONS
+from fqdd.modules.model_utils import FQDD_MLPS, FQDD_EMBEDDINGS, FQDD_SUBSAMPLES, LayerDropModuleList, FQDD_ATTENTIONS, \
+    forward_layers_checkpointed
+from fqdd.modules.frontend import FbankFrontend
 from fqdd.utils.common import load_json_cmvn, GlobalCMVN
 from fqdd.utils.mask import make_pad_mask
 
@@ -17,7 +19,8 @@ class EBranchformerEncoder(nn.Module):
             self,
             encoder_conf,
             use_cmvn: bool = False,
-            cmvn_file: str = None
+            cmvn_file: str = None,
+            frontend_conf=None
     ):
         super(EBranchformerEncoder, self).__init__()
         input_size = encoder_conf.get("input_size")
@@ -53,11 +56,19 @@ class EBranchformerEncoder(nn.Module):
         n_expert = encoder_conf.get("n_expert", 8)
         n_expert_activated = encoder_conf.get("n_expert_activated", 2)
         norm_eps: float = encoder_conf.get("norm_eps", 1e-5)
+        # recompute the activations of every checkpoint_every-th layer in backward
+        self.gradient_checkpointing = encoder_conf.get("gradient_checkpointing", False)
+        self.checkpoint_every = encoder_conf.get("checkpoint_every", 1)
         use_cmvn = use_cmvn
         cmvn_file = cmvn_file
 
         self._output_size = output_size
 
+        # on-device fbank/mfcc + spec augment, input is then (B, T) int16 scale waveform
+        self.frontend = None
+        if frontend_conf is not None:
+            self.frontend = FbankFrontend(frontend_conf)
+
         self.global_cmvn = None
         if use_cmvn:
             mean, std = load_json_cmvn(cmvn_file)
@@ -166,6 +177,8 @@ class EBranchformerEncoder(nn.Module):
             checkpointing API because `__call__` attaches all the hooks of the module.
             https://discuss.pytorch.org/t/any-different-between-model-input-and-model-forward-input/3690/2
         """
+        if self.frontend is not None:
+            xs, xs_lens = self.frontend(xs, xs_lens)
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         if self.global_cmvn is not None:
@@ -174,7 +187,11 @@ class EBranchformerEncoder(nn.Module):
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = mask_pad
 
-        xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
+        if self.gradient_checkpointing and self.training:
+            xs = forward_layers_checkpointed(self.encoders, self.checkpoint_every, xs, chunk_masks, pos_emb,
+                                              mask_pad)
+        else:
+            xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         if self.normalize_before:
             xs = self.after_norm(xs)
@@ -5,7 +5,8 @@ import torch.nn as nn
 
 from fqdd.nnets.base_utils import FQDD_NORMALIZES, FQDD_ACTIVATIONS
 from fqdd.models.ebranchformer_ehance.encoder_layer import ConvolutionalGatingMLP, EBranchformerEncoderLayer
-from fqdd.modules.model_utils import FQDD_MLPS, FQDD_EMBEDDINGS, FQDD_SUBSAMPLES, LayerDropModuleList, FQDD_ATTENTIONS
+from fqdd.modules.model_utils import FQDD_MLPS, FQDD_EMBEDDINGS, FQDD_SUBSAMPLES, LayerDropModuleList, FQDD_ATTENTIONS, \
+    forward_layers_checkpointed
 from fqdd.utils.common import load_json_cmvn, GlobalCMVN
 from fqdd.utils.mask import make_pad_mask
 
@@ -53,6 +54,9 @@ class EBranchformerEncoder(nn.Module):
         n_expert = encoder_conf.get("n_expert", 8)
         n_expert_activated = encoder_conf.get("n_expert_activated", 2)
         norm_eps: float = encoder_conf.get("norm_eps", 1e-5)
+        # recompute the activations of every checkpoint_every-th layer in backward
+        self.gradient_checkpointing = encoder_conf.get("gradient_checkpointing", False)
+        self.checkpoint_every = encoder_conf.get("checkpoint_every", 1)
         use_cmvn = use_cmvn
         cmvn_file = cmvn_file
 
@@ -174,7 +178,11 @@ class EBranchformerEncoder(nn.Module):
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = mask_pad
 
-        xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
+        if self.gradient_checkpointing and self.training:
+            xs = forward_layers_checkpointed(self.encoders, self.checkpoint_every, xs, chunk_masks, pos_emb,
+                                              mask_pad)
+        else:
+            xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         if self.normalize_before:
             xs = self.after_norm(xs)
@@ -3,8 +3,6 @@ import torch.nn as nn
 from fqdd.models.conformer.conformer import Conformer
 from fqdd.models.crdnn.crdnn import CRDNN
 from fqdd.models.ebranchformer_ehance.ebranchformer_ehance import EBranchformer_Ehance
-from fqdd.models.ebranchformer_ehance_v2.ebranchformer_ehance_v2 import EBranchformer_Ehance_V2
-from fqdd.models.ebranchformer_ehance_v3.ebranchformer_ehance_v3 import EBranchformer_Ehance_V3
 from fqdd.modules.model_utils import load_checkpoint
 from fqdd.models.ebranchformer.ebranchformer import EBranchformer
 
@@ -13,8 +11,6 @@ MODEL_LISTS = {
     "ebranchformer": EBranchformer,
     "crdnn": CRDNN,
     "ebranchformer_ehance": EBranchformer_Ehance,
-    "ebranchformer_ehance_v2": EBranchformer_Ehance_V2,
-    "ebranchformer_ehance_v3": EBranchformer_Ehance_V3,
 }
 
 
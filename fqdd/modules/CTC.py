@@ -93,7 +93,8 @@ class CTC(torch.nn.Module):
         ys_hat = self.ctc_lo(F.dropout(hs_pad, p=self.dropout_rate))
         # ys_hat: (B, L, D) -> (L, B, D)
         ys_hat = ys_hat.transpose(0, 1)
-        ys_hat = ys_hat.log_softmax(2)
+        # log_softmax and the CTC recursion in fp32 under autocast
+        ys_hat = ys_hat.float().log_softmax(2)
         loss = self.ctc_loss(ys_hat, ys_pad, hlens, ys_lens)
         # Batch-size average
         loss = loss / ys_hat.size(1)
@@ -108,7 +109,7 @@ class CTC(torch.nn.Module):
         Returns:
             torch.Tensor: log softmax applied 3d tensor (B, Tmax, odim)
         """
-        return F.log_softmax(self.ctc_lo(hs_pad), dim=2)
+        return F.log_softmax(self.ctc_lo(hs_pad).float(), dim=2)
 
     def argmax(self, hs_pad: torch.Tensor) -> torch.Tensor:
         """argmax of frame activations
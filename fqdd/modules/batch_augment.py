@@ -0,0 +1,183 @@
+import random
+from typing import Tuple
+
+import torch
+import torchaudio
+
+from fqdd.utils.audio_bank import AudioBank, RirBank
+
+
+class BatchWavAugment(torch.nn.Module):
+    """ Noise, reverb and speed perturb on a padded waveform batch.
+
+        The per-utterance versions in `Dataload` run in the data workers,
+        speed perturb goes through sox for every utterance. Here the same
+        augments work on the whole (B, T) batch on the training device:
+
+            add_noise: one clip per utterance from the noise bank, mixed at
+                a snr_db picked from add_noise_conf.snr_db with the formula
+                of `Dataload.add_noise`
+            add_reverb: batched fft convolution with one rir per utterance,
+                normalized by its peak like `RirBank.reverb`
+            speed_perturb: polyphase resampling from sr * speed to sr, one
+                cached Resample kernel per speed factor
+
+        Every augment draws its own `rate < uniform` decision per utterance,
+        lengths are updated for speed perturb and everything past the new
+        lengths is zeroed. The lengths stay on the device, nothing waits for
+        the GPU; after speed perturb the batch keeps the width of the
+        longest resampled row, possibly a little more than max(wav_lens).
+        Enabled by data_conf.augment.batch_augment, then Dataload skips
+        these three augments and the training loop calls this module on the
+        raw (feat_type raw/raw_int16) batch.
+
+        wav_distortion stays in the data workers, so with batch_augment it
+        runs before noise and reverb instead of after them: it is a per
+        sample non-linearity on the clean signal then, noise and reverb are
+        added undistorted.
+
+        Args:
+            augment_conf: data_conf["augment"]
+            sample_rate: data_conf["sample_rate"]
+            scale: amplitude of full scale in the input, 1 << 15 as returned
+                by `Dataload.compute_feat`
+    """
+
+    def __init__(self, augment_conf, sample_rate=16000, scale=1 << 15):
+        super().__init__()
+        self.conf = augment_conf
+        self.sample_rate = sample_rate
+        self.scale = scale
+
+        self.noise_bank = None
+        self.rir_bank = None
+        if augment_conf.get("add_noise", False):
+            add_noise_conf = augment_conf["add_noise_conf"]
+            self.noise_bank = AudioBank(add_noise_conf["noise_lists"], sample_rate,
+                                        add_noise_conf.get("cache_dir", None))
+        if augment_conf.get("add_reverb", False):
+            add_reverb_conf = augment_conf["add_reverb_conf"]
+            self.rir_bank = RirBank(add_reverb_conf["reverb_lists"], sample_rate,
+                                    add_reverb_conf.get("cache_dir", None))
+
+        self.speeds = []
+        self.resamplers = torch.nn.ModuleList()
+        if augment_conf.get("speed_perturb", False):
+            self.speeds = augment_conf.get("speed_perturb_conf", {}).get("speeds", [0.9, 1.0, 1.1])
+            for speed in self.speeds:
+                # same as sox `speed` + `rate`: treat the audio as sampled at sr * speed
+                self.resamplers.append(torchaudio.transforms.Resample(orig_freq=int(sample_rate * speed),
+                                                                      new_freq=sample_rate))
+
+    @staticmethod
+    def length_mask(wavs, wav_lens):
+        return torch.arange(wavs.size(1), device=wavs.device).unsqueeze(0) < wav_lens.unsqueeze(1)
+
+    def select(self, wavs, rate):
+        return [i for i in range(wavs.size(0)) if rate < random.uniform(0, 1)]
+
+    def add_noise(self, wavs, wav_lens, add_noise_conf):
+        snr_dbs = add_noise_conf.get("snr_db", [5, 10, 15])
+        index = self.select(wavs, add_noise_conf.get("rate", 0.0))
+        if len(self.noise_bank) == 0 or not index:
+            return wavs
+
+        # noise clips for the padded length, cut to each utterance on the device
+        T = wavs.size(1)
+        noise = torch.zeros(len(index), T)
+        for j in range(len(index)):
+            clip = self.noise_bank.get(self.noise_bank.random_index())[0]
+            # 确保噪音长度至少和语音长度一样长
+            if clip.size(0) < T:
+                clip = clip.repeat(T // clip.size(0) + 1)
+            noise[j] = clip[:T]
+        # same full scale as the batch, the mix below is not scale invariant in the noise
+        noise = noise.to(wavs.device, non_blocking=True) * self.scale
+        noise = noise.masked_fill(~self.length_mask(noise, wav_lens[index]), 0.0)
+        snr = torch.tensor([10 ** (random.choice(snr_dbs) / 20) for _ in index], dtype=torch.float,
+                           device=wavs.device)
+
+        x = wavs[index]
+        # same mix as Dataload.add_noise: scale = snr * |noise| / |x|, (x + scale * noise) / 2
+        scale = snr * noise.norm(dim=1) / x.norm(dim=1).clamp(min=1e-10)
+        wavs = wavs.clone()
+        wavs[index] = (x + scale.unsqueeze(1) * noise) / 2
+        return wavs
+
+    def add_reverb(self, wavs, wav_lens, add_reverb_conf):
+        index = self.select(wavs, add_reverb_conf.get("rate", 0.0))
+        if len(self.rir_bank) == 0 or not index:
+            return wavs
+
+        rirs = [self.rir_bank.get(self.rir_bank.random_index())[0] for _ in index]
+        rirs = torch.nn.utils.rnn.pad_sequence(rirs, batch_first=True).to(wavs.device, non_blocking=True)
+        T = wavs.size(1)
+        # full linear convolution, no circular wrap
+        n_fft = 1 << (T + rirs.size(1) - 2).bit_length()
+        x = wavs[index]
+        y = torch.fft.irfft(torch.fft.rfft(x, n=n_fft) * torch.fft.rfft(rirs, n=n_fft), n=n_fft)
+        y = y[:, :T].masked_fill(~self.length_mask(x, wav_lens[index]), 0.0)
+        # 进行标准化以防止溢出, 峰值取自每条语音长度内的结果, like RirBank.reverb
+        peak = y.abs().amax(dim=1, keepdim=True).clamp(min=1e-10)
+        wavs = wavs.clone()
+        wavs[index] = y / peak * self.scale
+        return wavs
+
+    def speed_perturb(self, wavs, wav_lens):
+        choice = [random.randrange(len(self.speeds)) for _ in range(wavs.size(0))]
+        outs, out_lens = [None] * wavs.size(0), wav_lens.clone()
+        for k, speed in enumerate(self.speeds):
+            index = [i for i, c in enumerate(choice) if c == k]
+            if not index:
+                continue
+            if speed == 1.0:
+                y = wavs[index]
+            else:
+                resampler = self.resamplers[k]
+                y = resampler(wavs[index])
+                # ceil(len * new / orig), same as the resampler output length
+                out_lens[index] = torch.div(wav_lens[index] * resampler.new_freq + resampler.orig_freq - 1,
+                                            resampler.orig_freq, rounding_mode='floor')
+            for j, i in enumerate(index):
+                outs[i] = y[j]
+
+        max_len = max(y.size(0) for y in outs)
+        out = wavs.new_zeros(wavs.size(0), max_len)
+        for i, y in enumerate(outs):
+            out[i, :y.size(0)] = y
+        # the filter leaks a little past the end of shorter utterances
+        out = out.masked_fill(~self.length_mask(out, out_lens), 0.0)
+        # not cut to out_lens.max(), that would wait for the device
+        return out, out_lens
+
+    def forward(self, wavs: torch.Tensor, wav_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            wavs: (B, T) waveform batch, int16 or float
+            wav_lens: (B)
+        Returns:
+            wavs: (B, T') float, wav_lens: (B)
+        """
+        wavs = wavs.float()
+        wav_lens = wav_lens.to(wavs.device).long()
+        if not self.training:
+            return wavs, wav_lens
+        with torch.no_grad():
+            if self.noise_bank is not None:
+                wavs = self.add_noise(wavs, wav_lens, self.conf["add_noise_conf"])
+            if self.rir_bank is not None:
+                wavs = self.add_reverb(wavs, wav_lens, self.conf["add_reverb_conf"])
+            if self.speeds:
+                wavs, wav_lens = self.speed_perturb(wavs, wav_lens)
+        return wavs, wav_lens
+
+
+def init_batch_augment(data_conf, device):
+    """ BatchWavAugment on `device` if data_conf.augment.batch_augment is set, else None.
+    """
+    augment_conf = data_conf.get("augment", {})
+    if not augment_conf.get("batch_augment", False):
+        return None
+    assert data_conf.get("feat_type") in ["raw", "raw_int16"], \
+        "batch_augment needs waveform batches, set feat_type to raw or raw_int16 and use model.frontend_conf"
+    return BatchWavAugment(augment_conf, data_conf.get("sample_rate", 16000)).to(device)
@@ -0,0 +1,194 @@
+import math
+from typing import Tuple
+
+import torch
+import torchaudio.compliance.kaldi as kaldi
+
+
+class FbankFrontend(torch.nn.Module):
+    """ Batched Kaldi-compatible fbank/mfcc and SpecAugment on the training device.
+
+        Takes padded waveforms in int16 scale (data_conf.feat_type `raw` or
+        `raw_int16`) and returns padded features with their lengths. With
+        dither 0 the features match `torchaudio.compliance.kaldi.fbank/mfcc`
+        as called in `Dataload.compute_feat`.
+
+        spec_aug/spec_sub/spec_trim use the same configs and the same rate
+        semantics as the per-utterance versions in `Dataload`, but draw all
+        masks for the batch at once and respect every utterance's length.
+        Dither and augmentation only run in training mode.
+
+        Args:
+            frontend_conf: {
+                "feat_type": "fbank" | "mfcc",
+                "sample_rate": 16000,
+                "fbank_conf" / "mfcc_conf": same keys as data_conf,
+                "spec_aug": bool, "spec_aug_conf": {...},
+                "spec_sub": bool, "spec_sub_conf": {...},
+                "spec_trim": bool, "spec_trim_conf": {...}
+            }
+    """
+
+    def __init__(self, frontend_conf):
+        super().__init__()
+        self.conf = frontend_conf
+        self.feat_type = frontend_conf.get("feat_type", "fbank")
+        assert self.feat_type in ["fbank", "mfcc"]
+        sample_rate = frontend_conf.get("sample_rate", 16000)
+
+        if self.feat_type == "fbank":
+            feat_conf = frontend_conf.get("fbank_conf", {})
+            num_mel_bins = feat_conf.get("num_mel_bins", 80)
+            self.energy_floor = feat_conf.get("energy_floor", 0.0)
+            low_freq = feat_conf.get("low_freq", 20.0)
+            high_freq = feat_conf.get("high_freq", 0.0)
+        else:
+            feat_conf = frontend_conf.get("mfcc_conf", {})
+            num_mel_bins = feat_conf.get("num_mel_bins", 23)
+            # torchaudio mfcc defaults, c0 is replaced by the log energy only with use_energy
+            self.use_energy = feat_conf.get("use_energy", False)
+            self.energy_floor = feat_conf.get("energy_floor", 1.0)
+            low_freq = feat_conf.get("low_freq", 0.0)
+            high_freq = feat_conf.get("high_freq", 0.0)
+            num_ceps = feat_conf.get("num_ceps", 40)
+            self.register_buffer("dct", kaldi._get_dct_matrix(num_ceps, num_mel_bins), persistent=False)
+            self.register_buffer("lifter", kaldi._get_lifter_coeffs(num_ceps, feat_conf.get("cepstral_lifter", 22.0)),
+                                 persistent=False)
+
+        self.dither = feat_conf.get("dither", 0.0)
+        self.preemphasis = feat_conf.get("preemphasis_coefficient", 0.97)
+        self.window_size = int(sample_rate * feat_conf.get("frame_length", 25) * 0.001)
+        self.window_shift = int(sample_rate * feat_conf.get("frame_shift", 10) * 0.001)
+        self.padded_window_size = 1 << (self.window_size - 1).bit_length()
+
+        mel = kaldi.get_mel_banks(num_mel_bins, self.padded_window_size, float(sample_rate),
+                                  low_freq, high_freq, 100.0, -500.0, 1.0)[0]
+        # (num_mel_bins, padded_window_size // 2 + 1)
+        mel = torch.nn.functional.pad(mel, (0, 1), mode='constant', value=0)
+        self.register_buffer("mel", mel, persistent=False)
+        window = torch.hann_window(self.window_size, periodic=False, dtype=torch.float64).pow(0.85).float()
+        self.register_buffer("window", window, persistent=False)
+
+    def compute_feat(self, wavs: torch.Tensor, wav_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            wavs: (B, T) int16 scale
+            wav_lens: (B)
+        Returns:
+            feats: (B, T', D), feat_lens: (B)
+        """
+        wavs = wavs.float()
+        eps = torch.finfo(torch.float).eps
+        if wavs.size(1) < self.window_size:
+            wavs = torch.nn.functional.pad(wavs, (0, self.window_size - wavs.size(1)))
+        # snip_edges=True framing
+        frames = wavs.unfold(1, self.window_size, self.window_shift)  # (B, F, W)
+        feat_lens = torch.div(wav_lens - self.window_size, self.window_shift, rounding_mode='floor') + 1
+        feat_lens = feat_lens.clamp(min=0)
+
+        if self.training and self.dither != 0.0:
+            frames = frames + torch.randn_like(frames) * self.dither
+        frames = frames - frames.mean(dim=2, keepdim=True)
+
+        if self.feat_type == "mfcc" and self.use_energy:
+            log_energy = frames.pow(2).sum(2).clamp(min=eps).log()
+            if self.energy_floor > 0.0:
+                log_energy = log_energy.clamp(min=math.log(self.energy_floor))
+
+        if self.preemphasis != 0.0:
+            prev = torch.nn.functional.pad(frames, (1, 0), mode='replicate')[:, :, :-1]
+            frames = frames - self.preemphasis * prev
+        frames = frames * self.window
+        frames = torch.nn.functional.pad(frames, (0, self.padded_window_size - self.window_size))
+        power = torch.fft.rfft(frames).abs().pow(2)
+        feats = torch.matmul(power, self.mel.t()).clamp(min=eps).log()
+
+        if self.feat_type == "mfcc":
+            feats = torch.matmul(feats, self.dct) * self.lifter
+            if self.use_energy:
+                feats[:, :, 0] = log_energy
+
+        mask = torch.arange(feats.size(1), device=feats.device).unsqueeze(0) < feat_lens.unsqueeze(1)
+        feats = feats.masked_fill(~mask.unsqueeze(2), 0.0)
+        return feats, feat_lens
+
+    @staticmethod
+    def randint(low: torch.Tensor, high: torch.Tensor) -> torch.Tensor:
+        """ Uniform integers in [low, high] elementwise, same as random.randint.
+        """
+        return low + (torch.rand(low.shape, device=low.device) * (high - low + 1)).long()
+
+    def applied(self, feats: torch.Tensor, rate: float) -> torch.Tensor:
+        # Dataload applies an augment when `rate < random.uniform(0, 1)`
+        return torch.rand(feats.size(0), device=feats.device) > rate
+
+    def spec_aug(self, feats, feat_lens, spec_aug_conf):
+        num_t_mask = spec_aug_conf.get("num_t_mask", 2)
+        num_f_mask = spec_aug_conf.get("num_f_mask", 2)
+        max_t = spec_aug_conf.get("max_t", 50)
+        max_f = spec_aug_conf.get("max_f", 10)
+        rate = spec_aug_conf.get("rate", 0)
+
+        B, T, D = feats.shape
+        device = feats.device
+        lens = feat_lens.clamp(min=1).unsqueeze(1)  # (B, 1)
+        # time mask
+        start = self.randint(torch.zeros(B, num_t_mask, dtype=torch.long, device=device), lens - 1)
+        end = start + self.randint(torch.ones_like(start), torch.full_like(start, max_t))
+        t = torch.arange(T, device=device).view(1, 1, T)
+        t_mask = ((t >= start.unsqueeze(2)) & (t < end.unsqueeze(2))).any(1)  # (B, T)
+        # freq mask
+        start = self.randint(torch.zeros(B, num_f_mask, dtype=torch.long, device=device),
+                             torch.full((B, num_f_mask), D - 1, dtype=torch.long, device=device))
+        end = start + self.randint(torch.ones_like(start), torch.full_like(start, max_f))
+        f = torch.arange(D, device=device).view(1, 1, D)
+        f_mask = ((f >= start.unsqueeze(2)) & (f < end.unsqueeze(2))).any(1)  # (B, D)
+
+        mask = t_mask.unsqueeze(2) | f_mask.unsqueeze(1)
+        mask = mask & self.applied(feats, rate).view(B, 1, 1)
+        return feats.masked_fill(mask, 0.0)
+
+    def spec_sub(self, feats, feat_lens, spec_sub_conf):
+        max_t = spec_sub_conf.get("max_t", 20)
+        num_t_sub = spec_sub_conf.get("num_t_sub", 3)
+        rate = spec_sub_conf.get("rate", 0)
+
+        B, T, D = feats.shape
+        device = feats.device
+        lens = feat_lens.clamp(min=1).unsqueeze(1)
+        t = torch.arange(T, device=device).unsqueeze(0).expand(B, T)
+        applied = self.applied(feats, rate).unsqueeze(1)
+        # the source is always the original feature, so substitutions
+        # compose into a single gather index, later ones win
+        src = t
+        for _ in range(num_t_sub):
+            start = self.randint(torch.zeros(B, 1, dtype=torch.long, device=device), lens - 1)
+            end = torch.minimum(start + self.randint(torch.ones_like(start), torch.full_like(start, max_t)), lens)
+            pos = self.randint(torch.zeros_like(start), start)
+            sel = (t >= start) & (t < end) & applied
+            src = torch.where(sel, t - pos, src)
+        return torch.gather(feats, 1, src.unsqueeze(2).expand(B, T, D))
+
+    def spec_trim(self, feats, feat_lens, spec_trim_conf):
+        max_t = spec_trim_conf.get("max_t", 20)
+        rate = spec_trim_conf.get("rate", 0.0)
+
+        B, T, _ = feats.shape
+        length = self.randint(torch.ones_like(feat_lens), torch.full_like(feat_lens, max_t))
+        trim = self.applied(feats, rate) & (length < feat_lens / 2)
+        feat_lens = torch.where(trim, feat_lens - length, feat_lens)
+        mask = torch.arange(T, device=feats.device).unsqueeze(0) < feat_lens.unsqueeze(1)
+        return feats.masked_fill(~mask.unsqueeze(2), 0.0), feat_lens
+
+    def forward(self, wavs: torch.Tensor, wav_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # power spectra overflow fp16, features are always computed in fp32
+        with torch.no_grad(), torch.autocast(wavs.device.type, enabled=False):
+            feats, feat_lens = self.compute_feat(wavs, wav_lens)
+            if self.training:
+                if self.conf.get("spec_aug", False):
+                    feats = self.spec_aug(feats, feat_lens, self.conf["spec_aug_conf"])
+                if self.conf.get("spec_sub", False):
+                    feats = self.spec_sub(feats, feat_lens, self.conf["spec_sub_conf"])
+                if self.conf.get("spec_trim", False):
+                    feats, feat_lens = self.spec_trim(feats, feat_lens, self.conf["spec_trim_conf"])
+        return feats, feat_lens
@@ -1181,14 +1181,16 @@ class LabelSmoothingLoss(nn.Module):
         """
         assert x.size(2) == self.size
         batch_size = x.size(0)
-        x = x.view(-1, self.size)
+        # fp32 log_softmax/KL under autocast
+        x = x.view(-1, self.size).float()
         target = target.view(-1)
         # use zeros_like instead of torch.no_grad() for true_dist,
         # since no_grad() can not be exported by JIT
         true_dist = torch.zeros_like(x)
         true_dist.fill_(self.smoothing / (self.size - 1))
         ignore = target == self.padding_idx  # (B,)
-        total = len(target) - ignore.sum().item()
+        # stays on the device, no sync per batch
+        total = len(target) - ignore.sum()
         target = target.masked_fill(ignore, 0)  # avoid -1 index
         true_dist.scatter_(1, target.unsqueeze(1), self.confidence)
         kl = self.criterion(torch.log_softmax(x, dim=1), true_dist)
@@ -1,12 +1,14 @@
 from typing import List
 
 import torch
+import torch.utils.checkpoint as ckpt
 import os
 import logging
 import re
 import json
 import datetime
 
+from torch.distributed.fsdp import FullyShardedDataParallel, FullStateDictConfig, StateDictType
 from fqdd.modules.attentions import MultiHeadedCrossAttention, RelPositionMultiHeadedAttention, MultiHeadedAttention
 from fqdd.modules.embedings import PositionalEncoding, RelPositionalEncoding, NoPositionalEncoding, \
     WhisperPositionalEncoding, LearnablePositionalEncoding, ParaformerPositinoalEncoding, RopePositionalEncoding
@@ -72,26 +74,74 @@ class LayerDropModuleList(torch.nn.ModuleList):
     Args:
         p (float): probability of dropping out each layer
         modules (iterable, optional): an iterable of modules to add
+        seed (int, optional): draw the decisions from an own generator with
+            this seed instead of the global one. The same seed on every rank
+            drops the same layers on every rank at every step.
 
     Limitations:
-        1 can work with ddp when layer's gradient checkpoint disabled
-        2 can't work with ddp when layer's gradient checkpoint enables
-        3 can work with fsdp
+        1 ddp needs find_unused_parameters (set by `wrap_model`), no static_graph
+        2 can work with non-reentrant gradient checkpoint, a dropped layer
+          is neither run nor recomputed
+        3 fsdp needs a seed, every rank must gather the same layers
         4 can work with deepspeed
     """
 
-    def __init__(self, p: List[float], modules=None):
+    def __init__(self, p: List[float], modules=None, seed=None):
         super().__init__(modules)
         assert len(p) == len(self)
         self.p = p
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator().manual_seed(seed)
 
     def __iter__(self):
-        dropout_probs = torch.empty(len(self)).uniform_()
+        if not self.training or max(self.p, default=0) <= 0:
+            # no draw in eval or without LayerDrop, keeps the generators of all ranks in step
+            yield from super().__iter__()
+            return
+        dropout_probs = torch.empty(len(self)).uniform_(generator=self.generator)
         for i, m in enumerate(super().__iter__()):
-            if not self.training or (dropout_probs[i] > self.p[i]):
+            # uniform_ can return 0.0, a layer with p 0 is always kept
+            if dropout_probs[i] >= self.p[i]:
                 yield m
 
 
+def layer_drop_rates(rate, num_blocks, schedule="linear"):
+    """ Drop probability of every layer of a stack.
+
+        uniform: `rate` for every layer
+        linear: rate * (i + 1) / num_blocks, the first layers are rarely
+            dropped, the last one with `rate`
+        a list of rates is returned as is
+    """
+    if isinstance(rate, (list, tuple)):
+        rates = list(rate)
+    elif schedule == "uniform":
+        rates = [float(rate)] * num_blocks
+    elif schedule == "linear":
+        rates = [float(rate) * (i + 1) / num_blocks for i in range(num_blocks)]
+    else:
+        raise ValueError("unknown layer drop schedule: {}".format(schedule))
+    if len(rates) != num_blocks:
+        raise ValueError("{} layer drop rates for {} blocks".format(len(rates), num_blocks))
+    return rates
+
+
+def forward_layers_checkpointed(layers, checkpoint_every: int, xs: torch.Tensor, masks: torch.Tensor,
+                                *args) -> torch.Tensor:
+    """ Run xs through `layers`, every checkpoint_every-th one under activation checkpointing.
+
+        A layer takes (xs, masks, *args) and returns (xs, masks, ...), like
+        the encoder and decoder layers. Non-reentrant checkpoint: works with
+        DDP/FSDP hooks and with layers skipped by LayerDropModuleList.
+    """
+    for i, layer in enumerate(layers):
+        if i % checkpoint_every == 0:
+            xs, masks = ckpt.checkpoint(layer.__call__, xs, masks, *args, use_reentrant=False)[:2]
+        else:
+            xs, masks = layer(xs, masks, *args)[:2]
+    return xs
+
 def save_state_dict_and_infos(state_dict, path: str, infos=None):
     rank = int(os.environ.get('RANK', 0))
     logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(
@@ -106,6 +156,21 @@ def save_state_dict_and_infos(state_dict, path: str, infos=None):
         fout.write(data)
 
 
+def model_state_dict(model: torch.nn.Module):
+    '''
+    Full state dict without the DDP/FSDP wrapper prefixes.
+    FSDP gathers the shards onto rank 0 (cpu), so every rank must call this;
+    the other ranks get an empty dict.
+    '''
+    if isinstance(model, FullyShardedDataParallel):
+        with FullyShardedDataParallel.state_dict_type(model, StateDictType.FULL_STATE_DICT,
+                                                      FullStateDictConfig(offload_to_cpu=True, rank0_only=True)):
+            return model.state_dict()
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        return model.module.state_dict()
+    return model.state_dict()
+
+
 def save_checkpoint(model: torch.nn.Module, path: str, infos=None):
     '''
     Args:
@@ -117,24 +182,21 @@ def save_checkpoint(model: torch.nn.Module, path: str, infos=None):
     path
     model
     '''
-    if isinstance(model, torch.nn.DataParallel):
-        state_dict = model.module.state_dict()
-    elif isinstance(model, torch.nn.parallel.DistributedDataParallel):
-        state_dict = model.module.state_dict()
-    else:
-        state_dict = model.state_dict()
-    save_state_dict_and_infos(state_dict, path, infos)
+    save_state_dict_and_infos(model_state_dict(model), path, infos)
 
 
 def save_model(model: torch.nn.Module, info_dict=None):
+    '''
+    Call on every rank: FSDP gathers the full state dict collectively, rank 0 writes it.
+    '''
     rank = int(os.environ.get('RANK', 0))
     tag = info_dict["tag"]
     model_dir = info_dict["model_dir"]
     save_model_path = os.path.join(model_dir, '{}.pt'.format(tag))
+    state_dict = model_state_dict(model)
     # save ckpt
     if rank == 0:
-        # NOTE(xcsong): For torch_ddp, only rank-0 should call this.
-        save_checkpoint(model, save_model_path, info_dict)
+        save_state_dict_and_infos(state_dict, save_model_path, info_dict)
         # save yaml
         with open("{}/{}.json".format(model_dir, tag), 'w') as fout:
             data = json.dumps(info_dict, indent=4)
@@ -183,6 +245,8 @@ def load_checkpoint(model: torch.nn.Module, path: str) -> dict:
     logging.info('[Rank {}] Checkpoint: loading from checkpoint {}'.format(
         rank, path))
     checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    # older checkpoints saved from the DDP wrapper
+    checkpoint = {re.sub('^module\\.', '', k): v for k, v in checkpoint.items()}
     missing_keys, unexpected_keys = model.load_state_dict(checkpoint,
                                                           strict=False)
     if rank == 0:
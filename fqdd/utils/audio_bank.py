@@ -0,0 +1,159 @@
+import os
+import random
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+import torch
+import torchaudio
+
+from collections import OrderedDict
+
+
+class AudioBank:
+    """ All clips of a noise/rir list in one int16 memory-mapped array.
+
+        The list is decoded, down-mixed to mono and resampled once to
+        `sample_rate` (one cached Resample kernel per source rate), then
+        written next to the list as `<list>.<sr>.<md5>.int16` plus an
+        `.offsets.npy` index. Later runs and every DataLoader worker only
+        map that file, so the pages are shared through the page cache
+        instead of being copied per process.
+
+        Args:
+            list_path: one audio path per line
+            sample_rate: target sample rate
+            cache_dir: where to put the arena, default next to the list
+    """
+
+    def __init__(self, list_path, sample_rate=16000, cache_dir=None):
+        self.list_path = list_path
+        self.sample_rate = sample_rate
+
+        paths = [line.strip() for line in open(list_path, 'r').readlines() if line.strip()]
+        digest = hashlib.md5("\n".join(paths).encode('utf8')).hexdigest()[:8]
+        name = "{}.{}.{}".format(os.path.basename(list_path), sample_rate, digest)
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(list_path))
+        self.data_path = os.path.join(cache_dir, name + ".int16")
+        self.offsets_path = os.path.join(cache_dir, name + ".offsets.npy")
+
+        if not (os.path.exists(self.data_path) and os.path.exists(self.offsets_path)):
+            try:
+                self.build(paths)
+            except OSError:
+                # read-only data dir
+                self.data_path = os.path.join(tempfile.gettempdir(), name + ".int16")
+                self.offsets_path = os.path.join(tempfile.gettempdir(), name + ".offsets.npy")
+                if not (os.path.exists(self.data_path) and os.path.exists(self.offsets_path)):
+                    self.build(paths)
+
+        self.offsets = np.load(self.offsets_path)
+        self._data = None
+
+    def build(self, paths):
+        logging.info("building audio bank {} from {} files".format(self.data_path, len(paths)))
+        resamplers = {}
+        tmp_path = "{}.{}.tmp".format(self.data_path, os.getpid())
+        offsets = [0]
+        with open(tmp_path, 'wb') as fout:
+            for path in paths:
+                waveform, sr = torchaudio.load(path)
+                waveform = waveform.mean(dim=0, keepdim=True)
+                if sr != self.sample_rate:
+                    if sr not in resamplers:
+                        resamplers[sr] = torchaudio.transforms.Resample(orig_freq=sr, new_freq=self.sample_rate)
+                    waveform = resamplers[sr](waveform)
+                pcm = (waveform[0].clamp(-1, 1) * 32767).to(torch.int16).numpy()
+                fout.write(pcm.tobytes())
+                offsets.append(offsets[-1] + pcm.shape[0])
+        # atomic rename, several ranks may build the same bank at once
+        os.replace(tmp_path, self.data_path)
+        tmp_offsets = "{}.{}.tmp.npy".format(self.offsets_path[:-4], os.getpid())
+        np.save(tmp_offsets, np.array(offsets, dtype=np.int64))
+        os.replace(tmp_offsets, self.offsets_path)
+
+    @property
+    def data(self):
+        # opened lazily, so a pickled bank re-maps the file inside the worker
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.int16, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, index):
+        """ Returns: torch.FloatTensor, (1, t)
+        """
+        pcm = self.data[self.offsets[index]:self.offsets[index + 1]]
+        return torch.from_numpy(pcm.astype(np.float32) / 32768).unsqueeze(0)
+
+    def random_index(self):
+        return random.randint(0, len(self) - 1)
+
+
+class RirBank(AudioBank):
+    """ AudioBank for room impulse responses with cached spectra.
+
+        Reverb is an overlap-add fft convolution: the waveform is cut into
+        blocks of L = next_pow2(rir length) samples, every block is
+        multiplied with the rir spectrum at the fixed size 2L. So there is
+        one complex64 spectrum per rir whatever the utterance length, kept
+        in an LRU bounded by `max_cached_mb`.
+    """
+
+    def __init__(self, list_path, sample_rate=16000, cache_dir=None, max_cached_mb=64):
+        super().__init__(list_path, sample_rate, cache_dir)
+        self.max_cached_bytes = max_cached_mb * (1 << 20)
+        self.cached_bytes = 0
+        self.spectra = OrderedDict()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["spectra"] = OrderedDict()
+        state["cached_bytes"] = 0
+        return state
+
+    def block_size(self, index):
+        return 1 << (int(self.offsets[index + 1] - self.offsets[index]) - 1).bit_length()
+
+    def spectrum(self, index):
+        """ rfft of rir `index` at 2 * block_size(index), complex64.
+        """
+        if index in self.spectra:
+            self.spectra.move_to_end(index)
+            return self.spectra[index]
+        spec = torch.fft.rfft(self.get(index)[0], n=2 * self.block_size(index))
+        self.spectra[index] = spec
+        self.cached_bytes += spec.numel() * spec.element_size()
+        while len(self.spectra) > 1 and self.cached_bytes > self.max_cached_bytes:
+            _, old = self.spectra.popitem(last=False)
+            self.cached_bytes -= old.numel() * old.element_size()
+        return spec
+
+    def reverb(self, waveform, index):
+        """ Convolve a mono waveform (1, t) with rir `index`, the first t
+            samples of the linear convolution normalized by their peak.
+        """
+        n = waveform.size(1)
+        block = self.block_size(index)
+        num_blocks = -(-n // block)
+        x = torch.nn.functional.pad(waveform[0].float(), (0, num_blocks * block - n)).view(num_blocks, block)
+        # (num_blocks, 2 * block): every block convolved with the whole rir
+        y = torch.fft.irfft(torch.fft.rfft(x, n=2 * block) * self.spectrum(index), n=2 * block)
+        # overlap-add, the tail of a block goes onto the next one, the last tail is cut
+        out = y[:, :block].clone()
+        out[1:] += y[:-1, block:]
+        out = out.reshape(-1)[:n]
+        # 进行标准化以防止溢出, a silent rir gives silence
+        peak = out.abs().max()
+        if peak > 0:
+            out = out / peak
+        return out.unsqueeze(0).to(waveform.dtype)
@@ -0,0 +1,96 @@
+import logging
+
+import torch
+import torchaudio
+
+from collections import OrderedDict
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+    logging.warning("soundfile is not installed, segments are read with torchaudio.load")
+
+# formats soundfile can seek in without decoding from the start
+SEEKABLE_FORMAT_SETS = set(['wav', 'flac'])
+
+
+class SegmentReader:
+    """ Read Kaldi style segments (`start`/`end` in seconds) of long recordings.
+
+        Keeps a small LRU of recently used recordings per process:
+            wav/flac: one open soundfile handle, every segment is a
+                seek + partial read, the header is parsed only once
+            other formats: the decoded recording, compressed audio is
+                decoded once instead of once per segment
+
+        Pays off when consecutive reads of a worker hit the same recording,
+        e.g. the segments of one batch from `RecordingGroupedSampler` or of
+        one shard from tools/make_shard_list.py.
+
+        Args:
+            max_cached: max number of recordings kept open/decoded
+            max_cached_mb: max size of the decoded recordings in the LRU
+    """
+
+    def __init__(self, max_cached=4, max_cached_mb=256):
+        self.max_cached = max_cached
+        self.max_cached_bytes = max_cached_mb * (1 << 20)
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    def __getstate__(self):
+        # handles can't be pickled, each worker opens its own
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        state["cached_bytes"] = 0
+        return state
+
+    @staticmethod
+    def size(entry):
+        return entry[0].numel() * entry[0].element_size() if torch.is_tensor(entry[0]) else 0
+
+    def evict(self):
+        while self.cache and (len(self.cache) > self.max_cached or self.cached_bytes > self.max_cached_bytes):
+            _, entry = self.cache.popitem(last=False)
+            self.cached_bytes -= self.size(entry)
+            if not torch.is_tensor(entry[0]):
+                entry[0].close()
+
+    def open(self, wavfile):
+        """ Returns: (soundfile.SoundFile or decoded (C, t) tensor, sample_rate)
+        """
+        if wavfile in self.cache:
+            self.cache.move_to_end(wavfile)
+            return self.cache[wavfile]
+        if soundfile is not None and wavfile.split('.')[-1].lower() in SEEKABLE_FORMAT_SETS:
+            f = soundfile.SoundFile(wavfile)
+            entry = (f, f.samplerate)
+        else:
+            entry = torchaudio.load(wavfile)
+        self.cache[wavfile] = entry
+        self.cached_bytes += self.size(entry)
+        self.evict()
+        return entry
+
+    def read(self, wavfile, start=None, end=None):
+        """ Read a whole file, or the segment [start, end) seconds of it.
+
+            Returns:
+                waveform: torch.FloatTensor (C, t) in [-1, 1], as torchaudio.load
+                sample_rate
+        """
+        if start is None:
+            if soundfile is not None and wavfile.split('.')[-1].lower() in SEEKABLE_FORMAT_SETS:
+                data, sr = soundfile.read(wavfile, dtype='float32', always_2d=True)
+                return torch.from_numpy(data.T.copy()), sr
+            return torchaudio.load(wavfile)
+
+        audio, sr = self.open(wavfile)
+        start_frame = int(sr * start)
+        end_frame = int(sr * end)
+        if torch.is_tensor(audio):
+            return audio[:, start_frame:end_frame].clone(), sr
+        audio.seek(start_frame)
+        data = audio.read(end_frame - start_frame, dtype='float32', always_2d=True)
+        return torch.from_numpy(data.T.copy()), sr
@@ -0,0 +1,231 @@
+import os
+import re
+import glob
+import json
+import logging
+import datetime
+import threading
+
+import torch
+from torch.distributed.fsdp import FullyShardedDataParallel, FullStateDictConfig, FullOptimStateDictConfig, \
+    StateDictType
+
+from fqdd.modules.model_utils import model_state_dict
+
+# checkpoints that take part in the retention policy, init.pt is always kept
+RETAINED_TAG = re.compile(r"^(epoch|step)_\d+$")
+
+
+def cpu_snapshot(obj):
+    """ Copy every tensor of a (nested) state dict to the host.
+
+        The copy is what makes the write safe to run in the background:
+        training keeps updating the device parameters and optimizer moments.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """ torch.save to a temporary file, then rename: a crash never leaves a truncated checkpoint.
+    """
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_dump_json(infos, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fout:
+        fout.write(json.dumps(infos, indent=4))
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    """ Step/epoch checkpoints with the full training state, written in the background.
+
+        Every checkpoint `tag` is three files in model_dir:
+
+            {tag}.pt: model state dict, same as `save_model`, what decoding,
+                average_model and --checkpoint read
+            {tag}.state.pt: optimizer, scheduler, GradScaler and EMA state
+            {tag}.json: infos (epoch, step, sampler_states, result_dict, configs),
+                written last, a checkpoint without it is incomplete
+
+        `save` must run on every rank (FSDP gathers model and optimizer
+        collectively). Rank 0 copies the state to the host and hands it to a
+        writer thread, so the other ranks and the next training steps don't
+        wait for the disk. At most one write is in flight; a new `save`
+        first waits for the previous one. Files are renamed into place when
+        complete. With an EMA (`track_ema`) every save also refreshes
+        ema.pt, the averaged weights as a plain model checkpoint.
+
+        Retention, after every write: the `keep_last` newest epoch_/step_
+        checkpoints and the `keep_best` epoch checkpoints with the lowest
+        CV loss are kept, all other ones are removed. keep_last 0 keeps
+        everything.
+
+        Args:
+            model_dir: checkpoint directory
+            model, optimizer, scheduler: training objects, model may be DDP/FSDP
+            async_save: write in a background thread
+            keep_last / keep_best: retention policy
+    """
+
+    def __init__(self, model_dir, model, optimizer, scheduler, async_save=True, keep_last=0, keep_best=0):
+        self.model_dir = model_dir
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.scaler = None
+        self.scaler_state = None
+        self.ema = None
+        self.ema_state = None
+        self.async_save = async_save
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.rank = int(os.environ.get('RANK', 0))
+        self.thread = None
+        self.error = None
+
+    def track_scaler(self, scaler):
+        """ Save `scaler` with the training state, restore it if a resumed checkpoint had one.
+        """
+        self.scaler = scaler
+        if self.scaler_state is not None and scaler.is_enabled():
+            scaler.load_state_dict(self.scaler_state)
+        self.scaler_state = None
+
+    def track_ema(self, ema):
+        """ Save the ModelEMA `ema` (or None), restore it if a resumed checkpoint had one.
+
+            A collective under FSDP, call on every rank.
+        """
+        self.ema = ema
+        if self.ema_state is not None and ema is not None:
+            ema.load_state_dict(self.ema_state)
+        self.ema_state = None
+
+    def optimizer_state_dict(self):
+        if isinstance(self.model, FullyShardedDataParallel):
+            with FullyShardedDataParallel.state_dict_type(
+                    self.model, StateDictType.FULL_STATE_DICT,
+                    FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+                    FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True)):
+                return FullyShardedDataParallel.optim_state_dict(self.model, self.optimizer)
+        return self.optimizer.state_dict()
+
+    def load_optimizer_state_dict(self, state_dict):
+        if isinstance(self.model, FullyShardedDataParallel):
+            # every rank read the full state from disk, each one keeps its shard
+            with FullyShardedDataParallel.state_dict_type(
+                    self.model, StateDictType.FULL_STATE_DICT,
+                    FullStateDictConfig(rank0_only=False),
+                    FullOptimStateDictConfig(rank0_only=False)):
+                state_dict = FullyShardedDataParallel.optim_state_dict_to_load(self.model, self.optimizer,
+                                                                               state_dict)
+        self.optimizer.load_state_dict(state_dict)
+
+    def save(self, info_dict):
+        """ Checkpoint info_dict["tag"], call on every rank.
+        """
+        model_sd = model_state_dict(self.model)
+        optimizer_sd = self.optimizer_state_dict()
+        ema_sd = self.ema.state_dict() if self.ema is not None else None
+        if self.rank != 0:
+            return
+        train_state = {
+            "optimizer": optimizer_sd,
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": self.scaler.state_dict() if self.scaler is not None and self.scaler.is_enabled() else None,
+            "ema": ema_sd,
+        }
+        # previous write done before the host copies of this one are taken
+        self.wait()
+        args = (cpu_snapshot(model_sd), cpu_snapshot(train_state), info_dict)
+        if self.async_save:
+            self.thread = threading.Thread(target=self.write, args=args)
+            self.thread.start()
+        else:
+            self.write(*args)
+            self.raise_error()
+
+    def write(self, model_sd, train_state, info_dict):
+        try:
+            tag = info_dict["tag"]
+            path = os.path.join(self.model_dir, '{}.pt'.format(tag))
+            logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(self.rank, path))
+            atomic_save(train_state, re.sub('.pt$', '.state.pt', path))
+            atomic_save(model_sd, path)
+            if train_state["ema"] is not None:
+                atomic_save(train_state["ema"], os.path.join(self.model_dir, "ema.pt"))
+            info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            atomic_dump_json(info_dict, re.sub('.pt$', '.json', path))
+            self.prune()
+        except Exception as ex:
+            self.error = ex
+
+    def wait(self):
+        """ Block until the checkpoint in flight is on disk.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing checkpoint failed") from error
+
+    def prune(self):
+        if self.keep_last <= 0:
+            return
+        checkpoints = []
+        for info_path in glob.glob(os.path.join(self.model_dir, "*.json")):
+            tag = os.path.basename(info_path)[:-len(".json")]
+            if not RETAINED_TAG.match(tag):
+                continue
+            with open(info_path, 'r') as fin:
+                infos = json.load(fin)
+            checkpoints.append((tag, infos.get("step", -1), infos.get("result_dict", {}).get("loss")))
+        newest = sorted(checkpoints, key=lambda x: x[1], reverse=True)[:self.keep_last]
+        scored = [x for x in checkpoints if x[2] is not None]
+        best = sorted(scored, key=lambda x: x[2])[:self.keep_best]
+        keep = {x[0] for x in newest + best}
+        for tag, _, _ in checkpoints:
+            if tag in keep:
+                continue
+            logging.info("Checkpoint: remove {}".format(tag))
+            # json first, a half removed checkpoint is never picked up again
+            for suffix in [".json", ".pt", ".state.pt"]:
+                path = os.path.join(self.model_dir, tag + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def resume(self, path):
+        """ Restore optimizer/scheduler (and later the scaler) saved next to model checkpoint `path`.
+        """
+        state_path = re.sub('.pt$', '.state.pt', path)
+        if not os.path.exists(state_path):
+            logging.warning("no training state {}, optimizer and scheduler start fresh".format(state_path))
+            return
+        logging.info('[Rank {}] Checkpoint: loading training state {}'.format(self.rank, state_path))
+        train_state = torch.load(state_path, map_location='cpu')
+        self.load_optimizer_state_dict(train_state["optimizer"])
+        self.scheduler.load_state_dict(train_state["scheduler"])
+        self.scaler_state = train_state.get("scaler")
+        self.ema_state = train_state.get("ema")
+
+
+def init_checkpointer(configs, model, optimizer, scheduler):
+    checkpoint_conf = configs.get("checkpoint_conf", {})
+    return Checkpointer(configs["model_dir"], model, optimizer, scheduler,
+                        async_save=checkpoint_conf.get("async", True),
+                        keep_last=checkpoint_conf.get("keep_last", 0),
+                        keep_best=checkpoint_conf.get("keep_best", 0))
@@ -0,0 +1,167 @@
+import logging
+
+import torch
+
+# tensor fields of a packed batch, see `pack_collate_fn`
+PACKED_FIELDS = ["feats", "x_lens", "targets", "y_lens"]
+
+
+def frame_elements(data_conf):
+    """ Elements of one 10ms frame in the feats tensor of a batch.
+    """
+    feat_type = data_conf.get("feat_type", "fbank")
+    if feat_type == "fbank":
+        return data_conf.get("fbank_conf", {}).get("num_mel_bins", 80)
+    if feat_type == "mfcc":
+        return data_conf.get("mfcc_conf", {}).get("num_ceps", 40)
+    # raw/raw_int16 waveforms
+    return data_conf.get("sample_rate", 16000) // 100
+
+
+def frames_budget(data_conf):
+    """ Upper bound of the frames(10ms) in one batch.
+    """
+    batch_conf = data_conf.get("batch_conf", {})
+    if batch_conf.get("batch_type", "static") == "dynamic":
+        return batch_conf.get("max_frames_in_batch", 12000)
+    max_length = int(data_conf.get("filter_conf", {}).get("max_length", 4000))
+    return data_conf.get("batch_size", 1) * max_length
+
+
+def pad_packed(feats, x_lens, targets, y_lens, max_x, max_y):
+    """ Padded (B, max_x, ...) feats and (B, max_y) targets from packed batches.
+
+        Rows are scattered with `index_copy_`, no boolean masks, so on cuda
+        the whole padding runs without a host sync.
+    """
+    x = _scatter_rows(feats, x_lens, max_x, 0)
+    y = _scatter_rows(targets, y_lens, max_y, -1)
+    # float16 feature store views, converted once per batch
+    if x.dtype == torch.float16:
+        x = x.float()
+    return x, y
+
+
+def _scatter_rows(packed, lens, max_len, padding_value):
+    batch_size = lens.size(0)
+    out = packed.new_full((batch_size * max_len,) + tuple(packed.shape[1:]), padding_value)
+    lens = lens.long()
+    shift = torch.arange(batch_size, device=lens.device) * max_len - (torch.cumsum(lens, 0) - lens)
+    index = torch.arange(packed.size(0), device=lens.device) + \
+        torch.repeat_interleave(shift, lens, output_size=packed.size(0))
+    out.index_copy_(0, index, packed)
+    return out.view((batch_size, max_len) + tuple(packed.shape[1:]))
+
+
+class DeviceLoader:
+    """ Moves packed batches to the training device one batch ahead.
+
+        The data workers only concatenate the utterances of a batch
+        (`pack_collate_fn`), no padding, no per batch pinned allocation.
+        Here every packed batch is copied into one of `num_buffers` reusable
+        pinned host buffers, sent with non-blocking copies on a side cuda
+        stream and padded on the device. The copy of batch k+1 is issued
+        before batch k is handed out, so the transfer overlaps the compute
+        of step k; a host buffer is only rewritten after the event of its
+        last copy has fired.
+
+        The feats buffers are allocated for the batch-frame budget up front
+        and grow if a batch is larger. Without cuda the batch is padded on
+        the host and moved with a plain `.to(device)`.
+
+        Yields the same (keys, feats, x_lens, targets, y_lens) as `collate_fn`,
+        already on `device`. All other attributes are forwarded to the
+        wrapped loader.
+
+        Args:
+            loader: DataLoader (or AdaptivePrefetcher) with pack_collate_fn
+            device: training device
+            capacity: initial feats buffer size in elements
+            num_buffers: pinned host buffers in rotation
+    """
+
+    def __init__(self, loader, device, capacity=0, num_buffers=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.capacity = capacity
+        self.num_buffers = num_buffers
+        if self.cuda:
+            self.stream = torch.cuda.Stream(self.device)
+            self.buffers = [{} for _ in range(num_buffers)]
+            self.events = [None] * num_buffers
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the device loader
+        return getattr(self.__dict__["loader"], name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def host_buffer(self, slot, name, tensor):
+        buf = self.buffers[slot].get(name)
+        numel = tensor.numel()
+        if buf is None or buf.dtype != tensor.dtype or buf.numel() < numel:
+            size = max(numel, self.capacity if name == "feats" else 0)
+            if buf is not None and buf.dtype == tensor.dtype:
+                # grow geometrically, a few reallocations at most
+                size = max(size, 2 * buf.numel())
+                logging.debug("device loader: {} buffer grown to {} elements".format(name, size))
+            buf = torch.empty(size, dtype=tensor.dtype).pin_memory()
+            self.buffers[slot][name] = buf
+        return buf[:numel]
+
+    def stage(self, batch, slot):
+        """ Issue the host->device copy and padding of one packed batch on the side stream.
+        """
+        keys, tensors = batch[0], batch[1:]
+        max_x, max_y = int(batch[2].max()), int(batch[4].max())
+        if not self.cuda:
+            x, y = pad_packed(*tensors, max_x, max_y)
+            return [keys] + [t.to(self.device) for t in (x, batch[2], y, batch[4])]
+
+        if self.events[slot] is not None:
+            # the previous copy out of this buffer must be done
+            self.events[slot].synchronize()
+        pinned = []
+        for name, tensor in zip(PACKED_FIELDS, tensors):
+            buf = self.host_buffer(slot, name, tensor)
+            buf.copy_(tensor.reshape(-1))
+            pinned.append(buf.view(tensor.shape))
+        with torch.cuda.stream(self.stream):
+            feats, x_lens, targets, y_lens = [t.to(self.device, non_blocking=True) for t in pinned]
+            x, y = pad_packed(feats, x_lens, targets, y_lens, max_x, max_y)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+            self.events[slot] = event
+        return [keys, x, x_lens, y, y_lens]
+
+    def __iter__(self):
+        it = iter(self.loader)
+        slot = 0
+        batch = next(it, None)
+        staged = self.stage(batch, slot) if batch is not None else None
+        while staged is not None:
+            if self.cuda:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_stream(self.stream)
+                # allocated on the side stream, used on the compute stream
+                for t in staged[1:]:
+                    t.record_stream(stream)
+            current = staged
+            batch = next(it, None)
+            slot = (slot + 1) % self.num_buffers if self.cuda else slot
+            staged = self.stage(batch, slot) if batch is not None else None
+            yield tuple(current)
+
+
+def init_device_loader(loader, data_conf, device):
+    """ DeviceLoader around `loader` if data_conf.device_loader is set, else `loader`.
+    """
+    if not data_conf.get("device_loader", False):
+        return loader
+    device_loader_conf = data_conf.get("device_loader_conf", {})
+    capacity = frames_budget(data_conf) * frame_elements(data_conf)
+    return DeviceLoader(loader, device,
+                        capacity=capacity if device_loader_conf.get("preallocate", True) else 0,
+                        num_buffers=device_loader_conf.get("num_buffers", 2))
@@ -0,0 +1,106 @@
+import logging
+from contextlib import contextmanager
+
+import torch
+from torch.distributed.fsdp import FullyShardedDataParallel, FullStateDictConfig, StateDictType
+
+from fqdd.modules.model_utils import model_state_dict
+from fqdd.utils.checkpointer import cpu_snapshot
+
+
+class ModelEMA:
+    """ Exponential moving average of the model parameters, kept on the training device.
+
+        Every `update_interval` optimizer steps
+
+            shadow = d * shadow + (1 - d) * param,  d = decay ** update_interval
+
+        so the averaging horizon (about 1 / (1 - decay) steps) doesn't depend
+        on the interval. Before `start_step` the shadow just follows the
+        parameters. The update is two foreach kernels over the local
+        parameters, no host sync; under FSDP the shadow holds the local
+        shards only (use_orig_params views).
+
+        `state_dict` returns the full model state dict with the averaged
+        weights (buffers such as BatchNorm statistics are the live ones), a
+        drop-in model checkpoint for decoding. Like `model_state_dict` it is
+        a collective under FSDP.
+
+        Args:
+            model: training model, may be DDP/FSDP
+            decay: per step decay
+            update_interval: optimizer steps between two updates
+            start_step: first step that is averaged
+    """
+
+    def __init__(self, model, decay=0.9999, update_interval=1, start_step=0):
+        self.model = model
+        self.decay = decay
+        self.update_interval = update_interval
+        self.start_step = start_step
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
+
+    @torch.no_grad()
+    def update(self, step):
+        if step % self.update_interval != 0:
+            return
+        params = [p.detach() for p in self.params]
+        if step < self.start_step:
+            for s, p in zip(self.shadow, params):
+                s.copy_(p)
+            return
+        decay = self.decay ** self.update_interval
+        torch._foreach_mul_(self.shadow, decay)
+        torch._foreach_add_(self.shadow, params, alpha=1 - decay)
+
+    @contextmanager
+    @torch.no_grad()
+    def swapped(self):
+        """ Temporarily put the averaged weights into the model.
+        """
+        backup = [p.detach().clone() for p in self.params]
+        for p, s in zip(self.params, self.shadow):
+            p.detach().copy_(s)
+        try:
+            yield self.model
+        finally:
+            for p, b in zip(self.params, backup):
+                p.detach().copy_(b)
+
+    def state_dict(self):
+        with self.swapped():
+            # host copy before the live weights come back
+            return cpu_snapshot(model_state_dict(self.model))
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        """ Load a full EMA state dict (every rank reads it), keep the live weights.
+        """
+        backup = [p.detach().clone() for p in self.params]
+        model = self.model
+        if isinstance(model, FullyShardedDataParallel):
+            with FullyShardedDataParallel.state_dict_type(model, StateDictType.FULL_STATE_DICT,
+                                                          FullStateDictConfig(rank0_only=False)):
+                model.load_state_dict(state_dict)
+        else:
+            if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+                model = model.module
+            model.load_state_dict(state_dict)
+        for s, p, b in zip(self.shadow, self.params, backup):
+            s.copy_(p.detach())
+            p.detach().copy_(b)
+
+
+def init_ema(configs, model):
+    """ ModelEMA from configs["ema_conf"] if configs["ema"] is set, else None.
+    """
+    if not configs.get("ema", False):
+        return None
+    ema_conf = configs.get("ema_conf", {})
+    ema = ModelEMA(model,
+                   decay=ema_conf.get("decay", 0.9999),
+                   update_interval=ema_conf.get("update_interval", 1),
+                   start_step=ema_conf.get("start_step", 0))
+    logging.info("ema: decay {} every {} steps from step {}".format(ema.decay, ema.update_interval, ema.start_step))
+    return ema
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+FEAT_DEFAULTS = {
+    "fbank": {"num_mel_bins": 80, "frame_length": 25, "frame_shift": 10, "dither": 0.0, "energy_floor": 0.0},
+    "mfcc": {"num_mel_bins": 23, "frame_length": 25, "frame_shift": 10, "dither": 0.0, "num_ceps": 40,
+             "high_freq": 0.0, "low_freq": 0.0},
+}
+
+
+def feat_conf_hash(data_conf):
+    """ Short md5 over everything that changes the output of `Dataload.compute_feat`.
+    """
+    feat_type = data_conf.get("feat_type", "fbank")
+    assert feat_type in FEAT_DEFAULTS, "feature store only supports fbank/mfcc"
+    feat_conf = dict(FEAT_DEFAULTS[feat_type])
+    feat_conf.update(data_conf.get("{}_conf".format(feat_type)) or {})
+    conf = {"feat_type": feat_type, "sample_rate": data_conf.get("sample_rate", 16000), "feat_conf": feat_conf}
+    return hashlib.md5(json.dumps(conf, sort_keys=True).encode('utf8')).hexdigest()[:8], conf
+
+
+class FeatureStore:
+    """ Pre-computed features of a data list in one memory-mapped blob.
+
+        Files, for prefix `data/dev/data.list` and config hash `h`:
+
+            data.list.h.feats: all matrices back to back, float16 or float32
+            data.list.h.index: one `key num_frames offset` line per utterance,
+                offset counted in elements
+            data.list.h.json: dtype, feature dim and the hashed feature config
+
+        Features are looked up by utterance key, so a store stays valid when
+        the list is filtered or reordered. `get` returns a (num_frames, dim)
+        torch view of the mapped pages, nothing is copied until collate.
+
+        Args:
+            prefix: path prefix of the store files, usually the data list
+            data_conf: data_conf used to compute the features
+    """
+
+    def __init__(self, prefix, data_conf):
+        self.hash, self.conf = feat_conf_hash(data_conf)
+        base = "{}.{}".format(prefix, self.hash)
+        self.data_path = base + ".feats"
+        self.index_path = base + ".index"
+        self.meta_path = base + ".json"
+        self._data = None
+
+    def exists(self):
+        return all(os.path.exists(p) for p in [self.data_path, self.index_path, self.meta_path])
+
+    def load(self, keys):
+        """ Resolve `keys` against the index.
+
+            Returns:
+                number of keys found in the store
+        """
+        meta = json.load(open(self.meta_path, 'r', encoding='utf8'))
+        self.dtype = np.dtype(meta["dtype"])
+        self.dim = meta["dim"]
+        found = {}
+        with open(self.index_path, 'r', encoding='utf8') as fin:
+            for line in fin:
+                key, num_frames, offset = line.split()
+                found[key] = (int(num_frames), int(offset))
+        # numpy columns in list order, -1 for utterances that are not stored
+        self.num_frames = np.full(len(keys), -1, dtype=np.int64)
+        self.offsets = np.zeros(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            if key in found:
+                self.num_frames[i], self.offsets[i] = found[key]
+        del found
+        return int((self.num_frames >= 0).sum())
+
+    @property
+    def data(self):
+        # copy-on-write mapping: writable for torch.from_numpy, pages stay shared
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='c')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def get(self, index):
+        """ Returns: torch.Tensor (num_frames, dim) view or None if not stored
+        """
+        n = self.num_frames[index]
+        if n < 0:
+            return None
+        start = self.offsets[index]
+        return torch.from_numpy(self.data[start:start + n * self.dim].reshape(n, self.dim))
+
+    def write(self, items, dtype="float16"):
+        """ Write all (key, feat) pairs of `items` and publish the store atomically.
+        """
+        tmp = ".{}.tmp".format(os.getpid())
+        offset, dim, count = 0, None, 0
+        with open(self.data_path + tmp, 'wb') as fdata, \
+                open(self.index_path + tmp, 'w', encoding='utf8') as findex:
+            for key, feat in items:
+                mat = feat.numpy().astype(dtype)
+                if dim is None:
+                    dim = mat.shape[1]
+                fdata.write(mat.tobytes())
+                findex.write("{} {} {}\n".format(key, mat.shape[0], offset))
+                offset += mat.size
+                count += 1
+                if count % 10000 == 0:
+                    logging.info("feature store {}: {} utterances".format(self.data_path, count))
+        with open(self.meta_path + tmp, 'w', encoding='utf8') as fmeta:
+            json.dump({"dtype": dtype, "dim": dim, "conf": self.conf}, fmeta, ensure_ascii=False)
+        # meta last, exists() only sees a complete store
+        os.replace(self.data_path + tmp, self.data_path)
+        os.replace(self.index_path + tmp, self.index_path)
+        os.replace(self.meta_path + tmp, self.meta_path)
+        logging.info("feature store {} written, {} utterances".format(self.data_path, count))
@@ -1,17 +1,30 @@
 import copy
+import datetime
+import io
 import os
 import random
-import scipy
 import torch
 import json
 import math
 import logging
+import tarfile
 import torchaudio
 import numpy as np
 
 # sys.path.insert(0, "./")
+import torch.distributed as dist
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DistributedSampler, DataLoader
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from fqdd.utils.audio_bank import AudioBank, RirBank
+from fqdd.utils.audio_reader import SegmentReader
+from fqdd.utils.feature_store import FeatureStore
+from fqdd.utils.manifest import Manifest
+from fqdd.utils.prefetch import AdaptivePrefetcher
+from fqdd.utils.stage_timer import StageTimer
+from fqdd.utils.shm_cache import SharedWaveCache
+from fqdd.utils.samplers import DynamicBucketBatchSampler, RecordingGroupedSampler, ResumableDistributedSampler, \
+    ShardedEvalSampler
 
 # '''
 logging.basicConfig(level=logging.DEBUG,
@@ -20,6 +33,9 @@ logging.basicConfig(level=logging.DEBUG,
 
 # '''
 
+AUDIO_FORMAT_SETS = set(['flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'])
+
+
 class Dataload:
     def __init__(
             self,
@@ -32,6 +48,7 @@ class Dataload:
         self.files = [json.loads(line.strip()) for line in open(filelist, 'r').readlines()]
 
         self.tokenizer = tokenizer
+        self.load_index(conf.get("index_file", filelist + ".index"))
 
         if conf.get("filter", False):
             # logging.info("data_list_len_before:{}".format(len(self.files)))
@@ -41,6 +58,37 @@ class Dataload:
 
         # logging.info("data_list_len:{}".format(len(self.files)))
         self.conf = conf
+        # per-stage timings for fqdd/bin/benchmark_data.py, a no-op unless enabled
+        self.timer = StageTimer()
+        self.init_banks()
+        reader_conf = conf.get("reader_conf", {})
+        self.reader = SegmentReader(max_cached=reader_conf.get("max_cached", 4),
+                                    max_cached_mb=reader_conf.get("max_cached_mb", 256))
+
+        # only cheap durations here, durations() probes the rest on demand
+        for f in self.files:
+            if "duration" not in f:
+                duration = self.get_duration(f, probe=False)
+                if duration is not None:
+                    f["duration"] = duration
+        # numpy columns instead of dicts, forked workers share them copy-on-write
+        self.manifest = Manifest(self.files, tokenizer)
+        del self.files
+
+        # decoded audio shared by all ranks/workers of the node
+        self.wave_cache = None
+        if conf.get("shm_cache", False):
+            shm_cache_conf = conf.get("shm_cache_conf", {})
+            self.wave_cache = SharedWaveCache(filelist, len(self.manifest),
+                                              max_mb=shm_cache_conf.get("max_mb", 2048),
+                                              persist=shm_cache_conf.get("persist", False))
+            if not self.wave_cache.open():
+                # no room in /dev/shm
+                self.wave_cache = None
+
+        self.feat_store = None
+        if conf.get("feat_store", False):
+            self.init_feat_store(conf.get("feat_store_conf", {}))
 
 
     def speed_perturb(self, waveform, sr, speeds=None):
@@ -66,13 +114,24 @@ class Dataload:
         return waveform
 
     def wav_distortion(self, waveform, distort_conf, distort_types=None):
+        """ Apply a random sample point level distortion to the waveform.
+
+            Every distortion below is a piecewise function applied to the
+            whole array at once, a Bernoulli mask picks the sample points
+            that are distorted.
+
+            Args:
+                waveform: torch.FloatTensor, (1, t)
+                distort_conf: {'rate': float, 'gain_db': {...}, ...}
+                distort_types(List[str]): optional distortion types
+
+            Returns:
+                waveform: torch.FloatTensor
+        """
 
         def db2amp(db):
             return pow(10, db / 20)
 
-        def amp2db(amp):
-            return 20 * math.log10(amp)
-
         def make_poly_distortion(conf):
             """Generate a db-domain ploynomial distortion function
 
@@ -83,32 +142,23 @@ class Dataload:
 
             Returns:
                 The ploynomial function, which could be applied on
-                a float amplitude value
+                a float amplitude tensor
             """
             a = conf['a']
             m = conf['m']
             n = conf['n']
 
             def poly_distortion(x):
-                abs_x = abs(x)
-                if abs_x < 0.000001:
-                    x = x
-                else:
-                    db_norm = amp2db(abs_x) / 100 + 1
-                    if db_norm < 0:
-                        db_norm = 0
-                    db_norm = a * pow(db_norm, m) * pow((1 - db_norm), n) + db_norm
-                    if db_norm > 1:
-                        db_norm = 1
-                    db = (db_norm - 1) * 100
-                    amp = db2amp(db)
-                    if amp >= 0.9997:
-                        amp = 0.9997
-                    if x > 0:
-                        x = amp
-                    else:
-                        x = -amp
-                return x
+                abs_x = x.abs()
+                # keep log10 away from 0, those points are passed through below
+                db_norm = 20 * torch.log10(abs_x.clamp(min=0.000001)) / 100 + 1
+                db_norm = db_norm.clamp(min=0)
+                db_norm = a * torch.pow(db_norm, m) * torch.pow(1 - db_norm, n) + db_norm
+                db_norm = db_norm.clamp(max=1)
+                db = (db_norm - 1) * 100
+                amp = torch.pow(10, db / 20).clamp(max=0.9997)
+                y = torch.where(x > 0, amp, -amp)
+                return torch.where(abs_x < 0.000001, x, y)
 
             return poly_distortion
 
@@ -125,7 +175,7 @@ class Dataload:
 
             Returns:
                 The max function, which could be applied on
-                a float amplitude value
+                a float amplitude tensor
             """
             max_db = conf['max_db']
             if max_db:
@@ -134,13 +184,7 @@ class Dataload:
                 max_amp = 0.997
 
             def max_distortion(x):
-                if x > 0:
-                    x = max_amp
-                elif x < 0:
-                    x = -max_amp
-                else:
-                    x = 0.0
-                return x
+                return torch.sign(x) * max_amp
 
             return max_distortion
 
@@ -183,6 +227,14 @@ class Dataload:
                 m.append((l, r))
             return make_amp_mask(m)
 
+        def in_amp_mask(abs_x, amp_mask):
+            """Bool tensor, True where abs_x falls into any slot of amp_mask
+            """
+            is_in_mask = torch.zeros_like(abs_x, dtype=torch.bool)
+            for mask in amp_mask:
+                is_in_mask |= (abs_x >= mask[0]) & (abs_x <= mask[1])
+            return is_in_mask
+
         def make_fence_distortion(conf):
             """Generate a fence distortion function
 
@@ -197,7 +249,7 @@ class Dataload:
 
             Returns:
                 The fence function, which could be applied on
-                a float amplitude value
+                a float amplitude tensor
             """
             mask_number = conf['mask_number']
             max_db = conf['max_db']
@@ -210,23 +262,11 @@ class Dataload:
                 negative_mask = generate_amp_mask(mask_number)
 
             def fence_distortion(x):
-                is_in_mask = False
-                if x > 0:
-                    for mask in positive_mask:
-                        if x >= mask[0] and x <= mask[1]:
-                            is_in_mask = True
-                            return max_amp
-                    if not is_in_mask:
-                        return 0.0
-                elif x < 0:
-                    abs_x = abs(x)
-                    for mask in negative_mask:
-                        if abs_x >= mask[0] and abs_x <= mask[1]:
-                            is_in_mask = True
-                            return max_amp
-                    if not is_in_mask:
-                        return 0.0
-                return x
+                abs_x = x.abs()
+                fence = torch.full_like(x, max_amp)
+                zeros = torch.zeros_like(x)
+                y = torch.where(x > 0, torch.where(in_amp_mask(abs_x, positive_mask), fence, zeros), x)
+                return torch.where(x < 0, torch.where(in_amp_mask(abs_x, negative_mask), fence, zeros), y)
 
             return fence_distortion
 
@@ -244,7 +284,7 @@ class Dataload:
 
             Returns:
                 The jag function,which could be applied on
-                a float amplitude value
+                a float amplitude tensor
             """
             mask_number = conf['mask_number']
             if mask_number <= 0:
@@ -255,23 +295,10 @@ class Dataload:
                 negative_mask = generate_amp_mask(mask_number)
 
             def jag_distortion(x):
-                is_in_mask = False
-                if x > 0:
-                    for mask in positive_mask:
-                        if mask[0] <= x <= mask[1]:
-                            is_in_mask = True
-                            return x
-                    if not is_in_mask:
-                        return 0.0
-                elif x < 0:
-                    abs_x = abs(x)
-                    for mask in negative_mask:
-                        if mask[0] <= abs_x <= mask[1]:
-                            is_in_mask = True
-                            return x
-                    if not is_in_mask:
-                        return 0.0
-                return x
+                abs_x = x.abs()
+                zeros = torch.zeros_like(x)
+                y = torch.where(x > 0, torch.where(in_amp_mask(abs_x, positive_mask), x, zeros), x)
+                return torch.where(x < 0, torch.where(in_amp_mask(abs_x, negative_mask), x, zeros), y)
 
             return jag_distortion
 
@@ -286,12 +313,12 @@ class Dataload:
 
             Returns:
                 The db gain function, which could be applied on
-                a float amplitude value
+                a float amplitude tensor
             """
             db = conf['db']
 
             def gain_db(x):
-                return min(0.997, x * pow(10, db / 20))
+                return (x * pow(10, db / 20)).clamp(max=0.997)
 
             return gain_db
 
@@ -306,16 +333,13 @@ class Dataload:
             Returns:
                 the distorted waveform
             """
-            for i in range(0, x.shape[1]):
-                a = random.uniform(0, 1)
-                if a < rate:
-                    x[0][i] = func(float(x[0][i]))
-            # logging.info("distort_after:{}".format(type(x)))
+            # torch RNG is reseeded per DataLoader worker, numpy's global one is not
+            mask = torch.rand(x.shape[1]) < rate
+            x0 = x[0].double()
+            x[0] = torch.where(mask, func(x0), x0).to(x.dtype)
             return x
 
-        # x is numpy
-
-        waveform = waveform.detach().numpy()
+        waveform = waveform.detach().clone()
         rate = distort_conf["rate"]
 
         if distort_types is None:
@@ -346,49 +370,47 @@ class Dataload:
         else:
             logging.info('unsupport type')
 
-        '''
-        if type(waveform) != np.ndarray:
-            logging.info("***************************************\ndistort_type:{}".format(distort_type))
-            logging.info(waveform)
-        '''
-        return torch.from_numpy(waveform)
-
-    def readwav(self, wavfile, start: float = 0.0, end: float = 0.0):
-
-        sr = torchaudio.info(wavfile).sample_rate
-        if start != 0.0:
-            assert end != 0.0
-            start_frame = int(sr * start)
-            end_frame = int(sr * end)
+        return waveform
 
-            waveform, _ = torchaudio.load(
-                wavfile,
-                num_frames=end_frame - start_frame,
-                frame_offset=start_frame
-            )
-        else:
-            waveform, _ = torchaudio.load(wavfile)
+    def readwav(self, wavfile, start=None, end=None):
+        """ Whole file, or the segment [start, end) seconds through the recording LRU.
+        """
+        waveform, sr = self.reader.read(wavfile, start, end)
         return waveform, sr  # size = (1, t), 16000
 
+    def init_banks(self):
+        """ Load noise/rir lists once, before DataLoader workers fork.
+        """
+        sample_rate = self.conf.get("sample_rate", 16000)
+        augment = self.conf.get("augment", {})
+        self.noise_bank = None
+        self.rir_bank = None
+        if augment.get("batch_augment", False):
+            # noise/reverb/speed run on the training device, see fqdd.modules.batch_augment
+            return
+        if augment.get("add_noise", False):
+            add_noise_conf = augment["add_noise_conf"]
+            self.noise_bank = AudioBank(add_noise_conf["noise_lists"], sample_rate,
+                                        add_noise_conf.get("cache_dir", None))
+        if augment.get("add_reverb", False):
+            add_reverb_conf = augment["add_reverb_conf"]
+            self.rir_bank = RirBank(add_reverb_conf["reverb_lists"], sample_rate,
+                                    add_reverb_conf.get("cache_dir", None),
+                                    max_cached_mb=add_reverb_conf.get("max_cached_mb", 64))
+
     def add_noise(self, waveform, add_noise_conf, resample_rate=16000):
 
-        noise_lists = add_noise_conf.get("noise_lists", None)
         snr_dbs = add_noise_conf.get("snr_db", [5, 10, 15])
         rate = add_noise_conf.get("rate", 0.0)
 
-        noise_paths = [line.strip() for line in open(noise_lists, 'r').readlines()]
-
-        if len(noise_paths) > 0 and rate < random.uniform(0, 1):
+        if len(self.noise_bank) > 0 and rate < random.uniform(0, 1):
             snr_db = random.choice(snr_dbs)
-            n_waveform, n_sr = torchaudio.load(random.choice(noise_paths))
-            n_waveform = torchaudio.transforms.Resample(
-                orig_freq=n_sr,
-                new_freq=resample_rate
-            )(n_waveform)
+            # already resampled to resample_rate in the bank
+            n_waveform = self.noise_bank.get(self.noise_bank.random_index())
 
             # 确保噪音长度至少和语音长度一样长
             if n_waveform.size(1) < waveform.size(1):
-                n_waveform = torch.cat([n_waveform] * (waveform.size(1) // n_waveform.size(1) + 1), dim=1)
+                n_waveform = n_waveform.repeat(1, waveform.size(1) // n_waveform.size(1) + 1)
             n_waveform = n_waveform[:, :waveform.size(1)]
 
             audio_power = waveform.norm(p=2)
@@ -400,42 +422,21 @@ class Dataload:
 
     def add_reverb(self, waveform, add_reverb_conf, resample_rate=16000):
 
-        reverb_lists = add_reverb_conf.get("reverb_lists", None)
         rate = add_reverb_conf.get("rate", 0.0)
 
-        reverb_paths = [line.strip() for line in open(reverb_lists, 'r').readlines()]
-
-        if len(reverb_paths) > 0 and rate < random.uniform(0, 1):
-
-            r_waveform, r_sr = torchaudio.load(random.choice(reverb_paths))
-            r_waveform = torchaudio.transforms.Resample(
-                orig_freq=r_sr,
-                new_freq=resample_rate
-            )(r_waveform)
-            # 确保音频和脉冲响应是单声道
+        if len(self.rir_bank) > 0 and rate < random.uniform(0, 1):
+            # 确保音频和脉冲响应是单声道, rir在bank中已经是单声道
             if waveform.size(0) > 1:
                 waveform = waveform.mean(dim=0).unsqueeze(0)
-            if r_waveform.size(0) > 1:
-                r_waveform = r_waveform.mean(dim=0).unsqueeze(0)
 
             '''
-            使用 scipy 的 fftconvolve 进行卷积
+            用缓存的rir频谱做fft乘法, 等价于 scipy.signal.fftconvolve(mode='full')
             full: 默认模式。
                 计算输入信号和卷积核的完全卷积，输出的大小为 𝑁+𝑀−1,其中 N 是输入信号的长度，M 是卷积核的长度。
                 包含所有部分重叠和边缘效应。
-
-            valid: 只保留完全重叠部分，忽略边缘效应。
-                输出的大小为 𝑁−𝑀+1（假设 𝑁≥𝑀。仅在输入信号完全包含卷积核的范围内计算结果。
-
-            same:输出大小与输入信号相同。
-                在中心部分进行完全重叠卷积，并根据需要用零填充边缘来匹配输入信号的大小。输入和输出信号长度相同
+            结果按峰值标准化以防止溢出, 并截取为输入信号的长度
             '''
-            reverb_waveform = scipy.signal.fftconvolve(waveform.numpy(), r_waveform.numpy(), mode='full')
-            # 进行标准化以防止溢出
-            reverb_waveform = reverb_waveform / np.max(np.abs(reverb_waveform))
-            waveform = reverb_waveform[:, :waveform.shape[1]]
-            waveform = torch.from_numpy(waveform)
-            # logging.info(waveform.shape)
+            waveform = self.rir_bank.reverb(waveform, self.rir_bank.random_index())
         return waveform
 
     def compute_feat(self, waveform):
@@ -446,6 +447,10 @@ class Dataload:
 
         if self.conf.get("feat_type") == "raw":
             mat = waveform
+        elif self.conf.get("feat_type") == "raw_int16":
+            # half the bytes through the worker queues, features are computed
+            # on the training device by fqdd.modules.frontend.FbankFrontend
+            mat = waveform.round().clamp(-32768, 32767).to(torch.int16)
         elif self.conf.get("feat_type") == "fbank":
             feat_conf = self.conf.get("fbank_conf")
             mat = torchaudio.compliance.kaldi.fbank(
@@ -603,50 +608,150 @@ class Dataload:
                 bool: True to keep, False to filter
         """
 
-        max_length = filter_conf.get("max_length", '4000')
-        # print("************max_length****************:{}".format(max_length))
-        min_length = filter_conf.get('min_length', 10)
-        token_max_length = filter_conf.get('token_max_length', 200)
-        token_min_length = filter_conf.get('token_min_length', 1)
-        min_output_input_ratio = filter_conf.get("min_output_input_ratio", 0.0005)
-        max_output_input_ratio = filter_conf.get("max_output_input_ratio", 1)
-
         t_filelist = []
         for i, f in enumerate(self.files):
-            if "start" in f and "end" in f:
-                # sample['wav'] is torch.Tensor, we have 100 frames every second
-                duration = (f["end"] - f["start"]) * 100  # 10 ms
-
-            else:
-                wav_info = torchaudio.info(f["wav"])
-                duration = wav_info.num_frames / wav_info.sample_rate * 100
+            duration = self.get_duration(f)
             # print("key:{} duration:{}".format(f["key"], duration))
-            if duration < min_length:
-                continue
-            if duration > max_length:
-                # print(f['wav'])
-                continue
-
-            txt = f["txt"]
-            txt_len = len(txt)
-
-            if txt_len < token_min_length:
-                continue
-            if txt_len > token_max_length:
-                continue
-            '''
-            if txt_len / duration < min_output_input_ratio:
-                t_filelist.remove(f)
-                continue
-            if  txt_len / duration > max_output_input_ratio:
-                t_filelist.remove(f)
+            if not self.filter_sample(duration, f["txt"], filter_conf):
                 continue
-            '''
             f["duration"] = duration
             t_filelist.append(f)
 
         return t_filelist
 
+    def load_index(self, index_file):
+        """ Merge num_frames/sample_rate/channels from the sidecar index
+            written by tools/make_data_index.py, so nothing is probed.
+        """
+        if not os.path.exists(index_file):
+            return
+        index = {}
+        with open(index_file, 'r', encoding='utf8') as fin:
+            for line in fin:
+                try:
+                    info = json.loads(line)
+                except ValueError:
+                    continue
+                index[info["key"]] = info
+        for f in self.files:
+            info = index.get(f["key"])
+            if info is not None:
+                for k in ["num_frames", "sample_rate", "channels"]:
+                    f.setdefault(k, info[k])
+
+    def get_duration(self, f, probe=True):
+        """ Utterance length(10ms) of one data.list entry,
+            None if it is unknown and probe is False.
+        """
+        if "duration" in f:
+            return f["duration"]
+        if "start" in f and "end" in f:
+            # sample['wav'] is torch.Tensor, we have 100 frames every second
+            return (f["end"] - f["start"]) * 100  # 10 ms
+        if "num_frames" in f and "sample_rate" in f:
+            return f["num_frames"] / f["sample_rate"] * 100
+        if not probe:
+            return None
+        wav_info = torchaudio.info(f["wav"])
+        return wav_info.num_frames / wav_info.sample_rate * 100
+
+    def deterministic(self):
+        """ True if every epoch yields the same features, i.e. no augment and no dither.
+        """
+        augment = self.conf.get("augment", {})
+        for k in ["speed_perturb", "wav_distortion", "add_noise", "add_reverb", "spec_aug", "spec_sub", "spec_trim"]:
+            if augment.get(k, False):
+                return False
+        feat_type = self.conf.get("feat_type")
+        if feat_type not in ["fbank", "mfcc"]:
+            return False
+        return self.conf.get("{}_conf".format(feat_type), {}).get("dither", 0.0) == 0.0
+
+    def init_feat_store(self, feat_store_conf):
+        """ Serve features from a FeatureStore, computing it first if needed.
+
+            Only used for deterministic configs (dev/test sets, training
+            without augment). The store is written by rank 0 through a
+            DataLoader over this dataset, the other ranks wait for it on a
+            gloo barrier (feat_store_conf.build_timeout seconds). Large sets
+            are better built offline with tools/compute_fbank_feats.py.
+        """
+        if not self.deterministic():
+            logging.info("{}: augment or dither is on, feature store not used".format(self.filelist))
+            return
+        prefix = self.filelist
+        if feat_store_conf.get("store_dir", None) is not None:
+            prefix = os.path.join(feat_store_conf["store_dir"], os.path.basename(self.filelist))
+        store = FeatureStore(prefix, self.conf)
+
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed:
+            # the other ranks wait for the whole build: gloo, with a timeout far beyond the nccl watchdog
+            group = dist.new_group(backend="gloo", timeout=datetime.timedelta(
+                seconds=feat_store_conf.get("build_timeout", 24 * 3600)))
+        if not store.exists() and (not distributed or dist.get_rank() == 0):
+            logging.info("computing feature store {} (large sets: build it offline with "
+                         "tools/compute_fbank_feats.py)".format(store.data_path))
+            loader = DataLoader(self, batch_size=None, num_workers=self.conf.get("num_workers", 0))
+            store.write(((key, feat) for key, feat, _ in loader), feat_store_conf.get("dtype", "float16"))
+        if distributed:
+            dist.barrier(group=group)
+            dist.destroy_process_group(group)
+
+        m = self.manifest
+        found = store.load([m.key(i) for i in range(len(m))])
+        logging.info("{}: {}/{} utterances in feature store {}".format(self.filelist, found, len(m), store.data_path))
+        self.feat_store = store
+
+    def recordings(self):
+        """ Recording index of every utterance, segments of one wav share it.
+        """
+        m = self.manifest
+        _, ids = np.unique([m.wav(i) for i in range(len(m))], return_inverse=True)
+        return ids
+
+    def durations(self):
+        """ Lengths(10ms) of all utterances as a float32 array,
+            filled in by `filter`/the index or probed here.
+        """
+        durations = self.manifest.durations
+        for i in np.flatnonzero(np.isnan(durations)):
+            durations[i] = self.get_duration(self.manifest.row(i))
+        return durations
+
+    def filter_sample(self, duration, txt, filter_conf):
+        """ Check one utterance against filter_conf, see `filter`.
+
+            Args:
+                duration: utterance length(10ms)
+                txt: transcription
+
+            Returns:
+                bool: True to keep, False to filter
+        """
+        max_length = filter_conf.get("max_length", '4000')
+        min_length = filter_conf.get('min_length', 10)
+        token_max_length = filter_conf.get('token_max_length', 200)
+        token_min_length = filter_conf.get('token_min_length', 1)
+
+        if duration < min_length:
+            return False
+        if duration > max_length:
+            return False
+
+        txt_len = len(txt)
+        if txt_len < token_min_length:
+            return False
+        if txt_len > token_max_length:
+            return False
+        '''
+        if txt_len / duration < min_output_input_ratio:
+            return False
+        if  txt_len / duration > max_output_input_ratio:
+            return False
+        '''
+        return True
+
     def sortD(self, reverse=False):
 
         '''
@@ -658,28 +763,65 @@ class Dataload:
 
     def __getitem__(self, index):
 
-        f = self.files[index]
+        m = self.manifest
+        if self.feat_store is not None:
+            with self.timer.stage("feat_store"):
+                feat = self.feat_store.get(index)
+            if feat is not None:
+                label = m.label(index)
+                return m.key(index), feat, label if label is not None else torch.zeros(1)
 
-        if "start" in f.keys():
-            waveform, orig_sr = self.readwav(f["wav"], f["start"], f["end"])
-        else:
-            waveform, orig_sr = self.readwav(f["wav"])
+        start = m.start[index]
+
+        with self.timer.stage("readwav"):
+            cached = self.wave_cache.get(index) if self.wave_cache is not None else None
+            if cached is not None:
+                waveform, orig_sr = cached
+            else:
+                if not math.isnan(start):
+                    waveform, orig_sr = self.readwav(m.wav(index), float(start), float(m.end[index]))
+                else:
+                    waveform, orig_sr = self.readwav(m.wav(index))
+                if self.wave_cache is not None:
+                    self.wave_cache.put(index, waveform, orig_sr)
+
+        return self.process(m.key(index), waveform, orig_sr, m.txt(index), m.label(index))
+
+    def process(self, key, waveform, orig_sr, txt, label=None):
+        """ Run the resample/augment/feature/spec-aug chain on one utterance.
+
+            Args:
+                key: utterance id
+                waveform: torch.FloatTensor, (1, t)
+                orig_sr: sample rate of waveform
+                txt: transcription
+                label: optional pre-tokenized txt, torch.IntTensor
+
+            Returns:
+                key, feat, label
+        """
 
         if orig_sr == self.conf.get("sample_rate", 16000):
             pass
         else:
-            waveform = torchaudio.transforms.Resample(
-                orig_freq=orig_sr, new_freq=self.conf.get("sample_rate", 16000))(waveform)
+            with self.timer.stage("resample"):
+                waveform = torchaudio.transforms.Resample(
+                    orig_freq=orig_sr, new_freq=self.conf.get("sample_rate", 16000))(waveform)
+
+        # noise/reverb/speed perturb are left to BatchWavAugment with batch_augment
+        batch_augment = self.conf["augment"].get("batch_augment", False)
 
         # add noise
-        if self.conf["augment"]["add_noise"]:
-            waveform = self.add_noise(waveform, self.conf["augment"]["add_noise_conf"], self.conf["sample_rate"])
+        if self.conf["augment"]["add_noise"] and not batch_augment:
+            with self.timer.stage("add_noise"):
+                waveform = self.add_noise(waveform, self.conf["augment"]["add_noise_conf"], self.conf["sample_rate"])
             # logging.info("add_noise, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(waveform.isinf()), torch.sum(waveform.isnan())))
             # logging.info("add_noise_after:{}".format(waveform.shape))
         # add reverb
-        if self.conf["augment"]["add_reverb"]:
-            waveform = self.add_reverb(waveform, self.conf["augment"]["add_reverb_conf"],
-                                       self.conf.get("sample_rate", 16000))
+        if self.conf["augment"]["add_reverb"] and not batch_augment:
+            with self.timer.stage("add_reverb"):
+                waveform = self.add_reverb(waveform, self.conf["augment"]["add_reverb_conf"],
+                                           self.conf.get("sample_rate", 16000))
             # logging.info("add_reverb, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(waveform.isinf()), torch.sum(waveform.isnan())))
             # logging.info("add_reverb_after:{}".format(waveform.shape))
 
@@ -687,46 +829,188 @@ class Dataload:
             # logging.info("input_waveform type:{}".format(type(waveform)))
             # waveform = self.wav_distortion(waveform, self.conf["augment"]["wav_distortion_conf"],
             #                                self.conf.get("sample_rate", 16000))
-            waveform = self.wav_distortion(waveform, self.conf["augment"]["wav_distortion_conf"])
+            with self.timer.stage("wav_distortion"):
+                waveform = self.wav_distortion(waveform, self.conf["augment"]["wav_distortion_conf"])
             # logging.info("wav_distortion, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(waveform.isinf()),
             # torch.sum(waveform.isnan()))) logging.info("add_distortion_after:{}".format(waveform.shape))
 
-        if self.conf["augment"].get("speed_perturb"):
-            waveform = self.speed_perturb(waveform, self.conf.get("sample_rate", 16000))
+        if self.conf["augment"].get("speed_perturb") and not batch_augment:
+            with self.timer.stage("speed_perturb"):
+                waveform = self.speed_perturb(waveform, self.conf.get("sample_rate", 16000))
             # logging.info("speed_perturb, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(waveform.isinf()),
             # torch.sum(waveform.isnan())))
-        feat = self.compute_feat(waveform).squeeze(0)
+        with self.timer.stage("compute_feat"):
+            feat = self.compute_feat(waveform).squeeze(0)
         # print("feat.shape:{} feat_data:{}".format(feat.shape, feat)) logging.info("compute_feat, case1 isinf:{}\t
         # case2 isnan:{}".format(torch.sum(feat.isinf()), torch.sum(feat.isnan())))
 
         # spec_augment
         if self.conf["augment"]["spec_aug"]:
-            feat = self.spec_aug(feat, self.conf["augment"]["spec_aug_conf"])
+            with self.timer.stage("spec_aug"):
+                feat = self.spec_aug(feat, self.conf["augment"]["spec_aug_conf"])
             # logging.info("spec_aug, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(feat.isinf()), torch.sum(
             # feat.isnan())))
 
         # spec_sub
         if self.conf["augment"]["spec_sub"]:
-            feat = self.spec_sub(feat, self.conf["augment"]["spec_sub_conf"])
+            with self.timer.stage("spec_sub"):
+                feat = self.spec_sub(feat, self.conf["augment"]["spec_sub_conf"])
             # logging.info("spec_sub, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(feat.isinf()), torch.sum(
             # feat.isnan()))) logging.info("spec_sub_after:{}".format(feat.shape))
 
         # spec_trim
         if self.conf["augment"]["spec_trim"]:
-            feat = self.spec_trim(feat, self.conf["augment"]["spec_trim_conf"])
+            with self.timer.stage("spec_trim"):
+                feat = self.spec_trim(feat, self.conf["augment"]["spec_trim_conf"])
             # logging.info("spec_trim, case1 isinf:{}\t case2 isnan:{}".format(torch.sum(feat.isinf()), torch.sum(
             # feat.isnan()))) logging.info("spec_trim_after:{}".format(feat.shape))
 
-        if self.tokenizer:
-            label = self.tokenizer.tokens2ids(f["txt"])
-            label = torch.tensor(label, dtype=torch.int32)
+        if label is not None:
+            pass
+        elif self.tokenizer:
+            with self.timer.stage("tokenize"):
+                label = self.tokenizer.tokens2ids(txt)
+                label = torch.tensor(label, dtype=torch.int32)
         else:
             label = torch.zeros(1)
 
-        return f["key"], feat, label
+        return key, feat, label
 
     def __len__(self):
-        return len(self.files)
+        return len(self.manifest)
+
+
+class ShardDataload(Dataload, IterableDataset):
+    """ Streaming dataset over the tar shards written by tools/make_shard_list.py
+
+        Every shard holds `key.txt`/`key.wav` pairs. Shards are read
+        sequentially and split over DDP ranks and DataLoader workers, samples
+        go through a bounded shuffle buffer and then the same
+        augment/feature/spec-aug chain as `Dataload`.
+    """
+
+    def __init__(
+            self,
+            filelist,
+            conf=None,
+            tokenizer=None,
+            seed=777,
+            partition=True,
+    ):
+
+        self.filelist = filelist
+        self.shards = [line.strip() for line in open(filelist, 'r').readlines() if line.strip()]
+
+        self.tokenizer = tokenizer
+        self.conf = conf
+        self.seed = seed
+        self.partition = partition
+        self.epoch = 0
+        self.timer = StageTimer()
+        self.init_banks()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def split_shards(self, epoch):
+        """ Shuffle the shard list for this epoch and keep the part
+            belonging to the current rank and worker.
+        """
+        if dist.is_available() and dist.is_initialized():
+            rank = dist.get_rank()
+            world_size = dist.get_world_size()
+        else:
+            rank = int(os.environ.get('RANK', 0))
+            world_size = int(os.environ.get('WORLD_SIZE', 1))
+
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        shards = list(self.shards)
+        if self.conf.get("shuffle", False):
+            # same seed on every rank, so the split stays disjoint
+            random.Random(self.seed + epoch).shuffle(shards)
+        if self.partition:
+            shards = shards[rank::world_size]
+        return shards[worker_id::num_workers]
+
+    def read_shard(self, shard):
+        """ Yield {key, txt, wav} groups from one tar, wav is raw bytes.
+        """
+        with open(shard, 'rb') as fin, tarfile.open(fileobj=fin, mode="r|*") as stream:
+            prev_prefix = None
+            example = {}
+            for tarinfo in stream:
+                name = tarinfo.name
+                pos = name.rfind('.')
+                assert pos > 0
+                prefix, postfix = name[:pos], name[pos + 1:]
+                if prev_prefix is not None and prefix != prev_prefix:
+                    if "txt" in example and "wav" in example:
+                        yield example
+                    example = {}
+                with stream.extractfile(tarinfo) as file_obj:
+                    try:
+                        if postfix == "txt":
+                            example["txt"] = file_obj.read().decode('utf8').strip()
+                        elif postfix in AUDIO_FORMAT_SETS:
+                            example["wav"] = file_obj.read()
+                    except Exception as ex:
+                        logging.warning('error to parse {} in {}: {}'.format(name, shard, ex))
+                example["key"] = prefix
+                prev_prefix = prefix
+            if "txt" in example and "wav" in example:
+                yield example
+
+    def shuffle_buffer(self, examples, rng):
+        """ Bounded shuffle, keeps at most `shuffle_size` examples in memory.
+        """
+        shuffle_size = self.conf.get("shuffle_conf", {}).get("shuffle_size", 1000)
+        buf = []
+        for example in examples:
+            buf.append(example)
+            if len(buf) >= shuffle_size:
+                rng.shuffle(buf)
+                for x in buf:
+                    yield x
+                buf = []
+        rng.shuffle(buf)
+        for x in buf:
+            yield x
+
+    def __iter__(self):
+        # persistent workers keep their own copy of the dataset,
+        # so every new pass counts the epoch up locally
+        epoch = self.epoch
+        self.epoch += 1
+
+        shards = self.split_shards(epoch)
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = random.Random(self.seed + epoch * 1000 + worker_id)
+
+        examples = (e for shard in shards for e in self.read_shard(shard))
+        if self.conf.get("shuffle", False):
+            examples = self.shuffle_buffer(examples, rng)
+
+        for example in examples:
+            try:
+                with self.timer.stage("readwav"):
+                    waveform, orig_sr = torchaudio.load(io.BytesIO(example["wav"]))
+            except Exception as ex:
+                logging.warning('failed to load {}: {}'.format(example["key"], ex))
+                continue
+            if self.conf.get("filter", False):
+                duration = waveform.size(1) / orig_sr * 100  # 10 ms
+                if not self.filter_sample(duration, example["txt"], self.conf["filter_conf"]):
+                    continue
+            yield self.process(example["key"], waveform, orig_sr, example["txt"])
+
+    def __len__(self):
+        raise TypeError("ShardDataload is a streaming dataset and has no length")
 
 
 def collate_fn(data):
@@ -754,9 +1038,27 @@ def collate_fn(data):
         padding_value=-1
     )
 
+    # float16 feature store views, converted once per batch
+    if padded_x.dtype == torch.float16:
+        padded_x = padded_x.float()
+
     return keys, padded_x, padded_x_lens, padded_y, padded_y_lens
 
 
+def pack_collate_fn(data):
+    """ collate_fn for `DeviceLoader`: utterances concatenated, not padded.
+
+        Returns:
+            keys, feats (sum(x_lens), ...), x_lens, targets (sum(y_lens),), y_lens
+    """
+    keys = [key for key, _, _ in data]
+    feats = [feat for _, feat, _ in data]
+    targets = [target for _, _, target in data]
+    x_lens = torch.tensor([feat.shape[0] for feat in feats], dtype=torch.int32)
+    y_lens = torch.tensor([targ.shape[0] for targ in targets], dtype=torch.int32)
+    return keys, torch.cat(feats, dim=0), x_lens, torch.cat(targets, dim=0), y_lens
+
+
 def init_dataset_and_dataloader(args, config, tokenizer=None, seed=4233):
     generator = torch.Generator()
     generator.manual_seed(seed)
@@ -774,51 +1076,130 @@ def init_dataset_and_dataloader(args, config, tokenizer=None, seed=4233):
     dev_conf["augment"]['spec_sub'] = False
     dev_conf["augment"]['spec_trim'] = False
     dev_conf["filter"] = False
+    # dev is read once per epoch, it only takes /dev/shm from the train list if asked to
+    if not dev_conf.get("shm_cache_conf", {}).get("dev", False):
+        dev_conf["shm_cache"] = False
+    # deterministic dev features, so they can be served from the feature store
+    if dev_conf.get("feat_store", False) and dev_conf.get("feat_type") in ["fbank", "mfcc"]:
+        dev_conf["{}_conf".format(dev_conf["feat_type"])]["dither"] = 0.0
     world_size = int(os.environ.get('WORLD_SIZE', 1))
     rank = int(os.environ.get('RANK', 0))
 
-    train_set = Dataload(args.train_data, data_conf, tokenizer=tokenizer)
-    dev_set = Dataload(args.dev_data, dev_conf, tokenizer=tokenizer)
-
     '''
-    
-    shuffle=True
-        随机性和重复性：
-        可以选择是否在每个epoch内对数据进行重新排序或随机化。
+    data_type:
+        raw: data.list 每行一个json, 按文件随机读取
+        shard: 每行一个tar文件路径(tools/make_shard_list.py), 按shard顺序读取
+    '''
+    data_type = data_conf.get("data_type", "raw")
+    if data_type == "shard":
+        train_set = ShardDataload(args.train_data, data_conf, tokenizer=tokenizer, seed=seed)
+        # dev shards are split by rank as well, evaluate() all-reduces the sums
+        dev_set = ShardDataload(args.dev_data, dev_conf, tokenizer=tokenizer, seed=seed, partition=True)
+        if len(dev_set.shards) < world_size:
+            # a rank without dev batches has nothing to run the FSDP collectives with,
+            # every rank scores the whole set instead, the reduced means are the same
+            logging.warning("{} dev shards for {} ranks, every rank evaluates all of them".format(
+                len(dev_set.shards), world_size))
+            dev_set.partition = False
+        # shards are already split by rank inside the dataset
+        train_sampler = None
+        dev_sampler = None
+    else:
+        train_set = Dataload(args.train_data, data_conf, tokenizer=tokenizer)
+        dev_set = Dataload(args.dev_data, dev_conf, tokenizer=tokenizer)
+        # every dev utterance is scored once, on one rank
+        dev_sampler = ShardedEvalSampler(dev_set, num_replicas=world_size, rank=rank)
 
+        '''
+        shuffle=True
+            随机性和重复性：
+            可以选择是否在每个epoch内对数据进行重新排序或随机化。
+        '''
+        if data_conf.get("reader_conf", {}).get("group_segments", False):
+            # segments of one recording end up in the same batch
+            train_sampler = RecordingGroupedSampler(train_set.recordings(), shuffle=data_conf.get("shuffle"),
+                                                    num_replicas=world_size, rank=rank, seed=seed)
+        else:
+            # stateful, train() resumes it in the middle of an epoch
+            train_sampler = ResumableDistributedSampler(train_set, num_replicas=world_size,
+                                                        shuffle=data_conf.get("shuffle"), rank=rank, seed=seed)
+
+    '''
+    batch_type:
+        static: 固定batch_size
+        dynamic: 按时长分桶, 每个batch的帧数不超过max_frames_in_batch, 仅支持raw模式
     '''
-    train_sampler = DistributedSampler(train_set, num_replicas=world_size, shuffle=data_conf.get("shuffle"), rank=rank)
+    batch_conf = data_conf.get("batch_conf", {})
+    batch_sampler = None
+    # DeviceLoader pads on the training device, the workers only concatenate
+    # and copies into its own pinned buffers, the DataLoader pin thread is not needed
+    device_loader = data_conf.get("device_loader", False)
+    batch_collate_fn = pack_collate_fn if device_loader else collate_fn
+    pin_memory = data_conf.get("pin_memory", False) and not device_loader
+    if batch_conf.get("batch_type", "static") == "dynamic":
+        assert data_type != "shard", "dynamic batch only supports data_type raw"
+        batch_sampler = DynamicBucketBatchSampler(train_set.durations(),
+                                                  max_frames_in_batch=batch_conf.get("max_frames_in_batch", 12000),
+                                                  budget_type=batch_conf.get("budget_type", "padded"),
+                                                  num_buckets=batch_conf.get("num_buckets", 30),
+                                                  max_batch_size=batch_conf.get("max_batch_size", 512),
+                                                  shuffle=data_conf.get("shuffle", True),
+                                                  num_replicas=world_size,
+                                                  rank=rank,
+                                                  seed=seed)
+        train_sampler = batch_sampler
 
     '''
     prefetch_factor:
         参数指定了预取的批次数量。
         例如，如果设置为2，则DataLoader会提前加载两个批次的数据到内存中。
         这对于I/O密集型操作（如从磁盘读取数据）特别有效，因为它可以利用CPU和GPU并行处理的能力，从而减少数据加载造成的训练延迟.
-
-
+        每个worker只预取少量batch, 更深的预取由AdaptivePrefetcher按字节预算(prefetch_conf.max_mb)和消费速度自动调整.
     '''
-    train_loader = DataLoader(train_set,
-                              batch_size=data_conf.get("batch_size", 1),
-                              pin_memory=data_conf.get("pin_memory", False),
-                              num_workers=data_conf.get("num_workers", 0),
-                              persistent_workers=True,
-                              generator=generator,
-                              sampler=train_sampler,
-                              collate_fn=collate_fn,
-                              # shuffle=train_conf.get("shuffle"),
-                              prefetch_factor=data_conf.get("prefetch", 500)
-                              )
+    if batch_sampler is not None:
+        train_loader = DataLoader(train_set,
+                                  batch_sampler=batch_sampler,
+                                  pin_memory=pin_memory,
+                                  num_workers=data_conf.get("num_workers", 0),
+                                  persistent_workers=True,
+                                  generator=generator,
+                                  collate_fn=batch_collate_fn,
+                                  prefetch_factor=data_conf.get("prefetch", 2)
+                                  )
+    else:
+        train_loader = DataLoader(train_set,
+                                  batch_size=data_conf.get("batch_size", 1),
+                                  pin_memory=pin_memory,
+                                  num_workers=data_conf.get("num_workers", 0),
+                                  persistent_workers=True,
+                                  generator=generator,
+                                  sampler=train_sampler,
+                                  collate_fn=batch_collate_fn,
+                                  # shuffle=train_conf.get("shuffle"),
+                                  prefetch_factor=data_conf.get("prefetch", 2)
+                                  )
 
     dev_loader = DataLoader(dev_set,
                             batch_size=dev_conf.get("batch_size", 1),
-                            pin_memory=dev_conf.get("pin_memory", False),
+                            pin_memory=pin_memory,
                             num_workers=dev_conf.get("num_workers", 1),
                             persistent_workers=True,
                             generator=generator,
-                            collate_fn=collate_fn,
-                            shuffle=dev_conf.get("shuffle"),
-                            prefetch_factor=data_conf.get("prefetch", 500)
+                            collate_fn=batch_collate_fn,
+                            sampler=dev_sampler,
+                            prefetch_factor=data_conf.get("prefetch", 2)
                             )
 
+    prefetch_conf = data_conf.get("prefetch_conf", {})
+    if prefetch_conf.get("enable", True):
+        train_loader = AdaptivePrefetcher(train_loader,
+                                          max_mb=prefetch_conf.get("max_mb", 1024),
+                                          min_depth=prefetch_conf.get("min_depth", 2),
+                                          max_depth=prefetch_conf.get("max_depth", 64))
+        dev_loader = AdaptivePrefetcher(dev_loader,
+                                        max_mb=prefetch_conf.get("max_mb", 1024),
+                                        min_depth=prefetch_conf.get("min_depth", 2),
+                                        max_depth=prefetch_conf.get("max_depth", 64))
+
     return train_set, train_loader, train_sampler, dev_set, dev_loader
 
@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+import torch
+
+
+class Manifest:
+    """ Columnar, fork-friendly storage of a data.list.
+
+        A list of dicts is touched by refcounting on every access, so each
+        forked DataLoader worker ends up with its own copy of it. Here
+        everything lives in a handful of numpy arrays instead:
+
+            blob/offsets: key, wav and txt of row i are the utf8 bytes
+                blob[offsets[3i + j]:offsets[3i + j + 1]] for j = 0, 1, 2
+            start/end: segment times in seconds, nan for whole files
+            sample_rate: int32, 0 if unknown
+            durations: float32 length(10ms), nan if unknown
+            labels/label_offsets: token ids pre-computed once with the tokenizer
+
+        Args:
+            files: list of data.list dicts, may be dropped afterwards
+            tokenizer: optional Tokenizers, used once per utterance here
+    """
+
+    def __init__(self, files, tokenizer=None):
+        n = len(files)
+        fields = []
+        for f in files:
+            fields.append(f["key"].encode('utf8'))
+            fields.append(f["wav"].encode('utf8'))
+            fields.append(f["txt"].encode('utf8'))
+        self.offsets = np.zeros(3 * n + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in fields], out=self.offsets[1:])
+        self.blob = np.frombuffer(b"".join(fields), dtype=np.uint8)
+        del fields
+
+        self.start = np.array([f.get("start", math.nan) for f in files], dtype=np.float64)
+        self.end = np.array([f.get("end", math.nan) for f in files], dtype=np.float64)
+        self.sample_rate = np.array([f.get("sample_rate", 0) for f in files], dtype=np.int32)
+        self.durations = np.array([f.get("duration", math.nan) for f in files], dtype=np.float32)
+
+        self.labels = None
+        self.label_offsets = None
+        if tokenizer is not None:
+            ids = [tokenizer.tokens2ids(f["txt"]) for f in files]
+            self.label_offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum([len(x) for x in ids], out=self.label_offsets[1:])
+            self.labels = np.fromiter((i for x in ids for i in x), dtype=np.int32,
+                                      count=int(self.label_offsets[-1]))
+
+    def __len__(self):
+        return len(self.durations)
+
+    def field(self, index, j):
+        return self.blob[self.offsets[3 * index + j]:self.offsets[3 * index + j + 1]].tobytes().decode('utf8')
+
+    def key(self, index):
+        return self.field(index, 0)
+
+    def wav(self, index):
+        return self.field(index, 1)
+
+    def txt(self, index):
+        return self.field(index, 2)
+
+    def label(self, index):
+        """ Returns: torch.IntTensor view of the token ids, None without tokenizer
+        """
+        if self.labels is None:
+            return None
+        return torch.from_numpy(self.labels[self.label_offsets[index]:self.label_offsets[index + 1]])
+
+    def row(self, index):
+        """ The data.list dict of row `index`, for the rare non hot-path users.
+        """
+        f = dict(key=self.key(index), wav=self.wav(index), txt=self.txt(index))
+        if not math.isnan(self.start[index]):
+            f["start"] = float(self.start[index])
+            f["end"] = float(self.end[index])
+        if self.sample_rate[index] > 0:
+            f["sample_rate"] = int(self.sample_rate[index])
+        if not math.isnan(self.durations[index]):
+            f["duration"] = float(self.durations[index])
+        return f
@@ -0,0 +1,173 @@
+import math
+import time
+import logging
+import threading
+
+from collections import deque
+
+import torch
+
+
+def batch_nbytes(batch):
+    """ Bytes held by all tensors in a (nested) batch.
+    """
+    if torch.is_tensor(batch):
+        return batch.numel() * batch.element_size()
+    if isinstance(batch, (list, tuple)):
+        return sum(batch_nbytes(x) for x in batch)
+    if isinstance(batch, dict):
+        return sum(batch_nbytes(x) for x in batch.values())
+    return 0
+
+
+class AdaptivePrefetcher:
+    """ Byte-bounded, self-sizing read-ahead on top of a DataLoader.
+
+        The DataLoader only keeps a small, fixed `prefetch_factor` per worker.
+        A background thread pulls further batches into a queue whose depth
+        follows the measured rates: every `window` steps the target depth is
+        set to cover the slowest producer gap of the window at the mean
+        consumer step time,
+
+            depth = ceil(max producer interval / mean consumer interval) + 1
+
+        clamped to [min_depth, max_depth]. Independently of the depth, the
+        queued batches never hold more than `max_mb` (one batch is always
+        allowed, so an oversized batch can't deadlock).
+
+        All other attributes (dataset, sampler, batch_sampler, ...) are
+        forwarded to the wrapped loader.
+
+        Args:
+            loader: torch DataLoader
+            max_mb: byte budget of the queued batches
+            min_depth / max_depth: bounds of the adaptive queue depth
+            window: steps between two depth updates
+    """
+
+    def __init__(self, loader, max_mb=1024, min_depth=2, max_depth=64, window=20):
+        self.loader = loader
+        self.max_bytes = max_mb * (1 << 20)
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.window = window
+        self.depth = min_depth
+        self.reset_metrics()
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the prefetcher
+        return getattr(self.__dict__["loader"], name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_metrics(self):
+        self.steps = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.occupancy_sum = 0
+        self.bytes_sum = 0
+        self.peak_bytes = 0
+
+    def metrics(self):
+        """ Queue statistics since the last call, then reset.
+
+            Returns:
+                depth: current target depth
+                occupancy: mean queued batches seen by the consumer
+                mean_mb/peak_mb: queued bytes
+                stalls: steps where the consumer found the queue empty
+                stall_s: total time the consumer waited for data
+        """
+        steps = max(self.steps, 1)
+        metrics = {
+            "depth": self.depth,
+            "occupancy": self.occupancy_sum / steps,
+            "mean_mb": self.bytes_sum / steps / (1 << 20),
+            "peak_mb": self.peak_bytes / (1 << 20),
+            "stalls": self.stalls,
+            "stall_s": self.stall_time,
+        }
+        self.reset_metrics()
+        return metrics
+
+    def produce(self, it, queue, state, cond):
+        try:
+            last = None
+            for batch in it:
+                now = time.perf_counter()
+                nbytes = batch_nbytes(batch)
+                with cond:
+                    # the first batch also waits for the workers to start
+                    if last is not None:
+                        state["producer_intervals"].append(now - last)
+                    while not state["stop"] and queue and (
+                            len(queue) >= self.depth or state["bytes"] + nbytes > self.max_bytes):
+                        cond.wait()
+                    if state["stop"]:
+                        return
+                    queue.append((batch, nbytes))
+                    state["bytes"] += nbytes
+                    cond.notify_all()
+                last = time.perf_counter()
+        except Exception as ex:
+            state["error"] = ex
+        finally:
+            with cond:
+                state["done"] = True
+                cond.notify_all()
+
+    def update_depth(self, state):
+        producer, consumer = state["producer_intervals"], state["consumer_intervals"]
+        if not producer or not consumer:
+            return
+        mean_consumer = max(sum(consumer) / len(consumer), 1e-6)
+        depth = math.ceil(max(producer) / mean_consumer) + 1
+        self.depth = min(max(depth, self.min_depth), self.max_depth)
+        producer.clear()
+        consumer.clear()
+
+    def __iter__(self):
+        queue = deque()
+        cond = threading.Condition()
+        state = {"stop": False, "done": False, "error": None, "bytes": 0,
+                 "producer_intervals": [], "consumer_intervals": []}
+        thread = threading.Thread(target=self.produce, args=(iter(self.loader), queue, state, cond), daemon=True)
+        thread.start()
+        last = None
+        try:
+            while True:
+                start = time.perf_counter()
+                with cond:
+                    stalled = not queue and not state["done"]
+                    while not queue and not state["done"]:
+                        cond.wait()
+                    if not queue:
+                        break
+                    self.stalls += int(stalled)
+                    self.occupancy_sum += len(queue)
+                    self.bytes_sum += state["bytes"]
+                    self.peak_bytes = max(self.peak_bytes, state["bytes"])
+                    batch, nbytes = queue.popleft()
+                    state["bytes"] -= nbytes
+                    now = time.perf_counter()
+                    self.stall_time += now - start
+                    # consumer step time, excluding the wait for data
+                    if last is not None:
+                        state["consumer_intervals"].append(start - last)
+                    self.steps += 1
+                    if self.steps % self.window == 0:
+                        self.update_depth(state)
+                    cond.notify_all()
+                last = now
+                yield batch
+            if state["error"] is not None:
+                raise state["error"]
+        finally:
+            # early break (e.g. uneven shards): stop the producer before the
+            # next epoch asks the DataLoader for a new iterator
+            with cond:
+                state["stop"] = True
+                cond.notify_all()
+            thread.join()
+            logging.debug("prefetcher stopped, depth {}".format(self.depth))
@@ -0,0 +1,256 @@
+import math
+import random
+import logging
+
+from typing import List
+
+from torch.utils.data import Sampler, DistributedSampler
+
+
+class StatefulSampler:
+    """ Mid-epoch resume for the samplers below.
+
+        The training loop calls `advance` once per consumed batch, so the
+        cursor counts what reached the model, not what the DataLoader has
+        already prefetched. `state_dict` records the permutation (seed,
+        epoch) and that cursor; after `load_state_dict` the next `__iter__`
+        starts behind the consumed part of the same permutation, skipped
+        entries are dropped by index and never read from disk.
+        `set_epoch` starts the cursor over.
+    """
+
+    # entries of one batch counted by `advance`: 1 for batch samplers, the utterances otherwise
+    batch_unit = False
+
+    def reset_cursor(self, start=0):
+        self.start = start
+        self.cursor = start
+
+    def advance(self, num_utts):
+        self.cursor += 1 if self.batch_unit else num_utts
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "seed": self.seed, "cursor": self.cursor}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.set_epoch(state["epoch"])
+        self.reset_cursor(state["cursor"])
+
+
+class DynamicBucketBatchSampler(StatefulSampler, Sampler):
+    """ Group utterances of similar duration into batches capped by a frame budget.
+
+        Utterances are put into duration buckets, shuffled inside the bucket,
+        cut into batches that fit `max_frames_in_batch`, then the batches of
+        all buckets are shuffled together. The permutation only depends on
+        `seed + epoch`, so every rank builds the same batch list and takes
+        its own slice of it.
+
+        Args:
+            durations: utterance lengths(10ms), e.g. `Dataload.durations()`
+            max_frames_in_batch: frame budget of one batch
+            budget_type:
+                padded: max_len * batch_size <= max_frames_in_batch
+                total: sum(len) <= max_frames_in_batch
+            num_buckets: number of equal-count duration buckets
+            max_batch_size: hard limit on utterances per batch
+            shuffle: shuffle buckets and batches every epoch
+            num_replicas: world size
+            rank: rank of this process
+            seed: must be the same on all ranks
+    """
+
+    batch_unit = True
+
+    def __init__(
+            self,
+            durations: List[float],
+            max_frames_in_batch: int = 12000,
+            budget_type: str = "padded",
+            num_buckets: int = 30,
+            max_batch_size: int = 512,
+            shuffle: bool = True,
+            num_replicas: int = 1,
+            rank: int = 0,
+            seed: int = 777
+    ):
+        assert budget_type in ["padded", "total"]
+        self.durations = durations
+        self.max_frames_in_batch = max_frames_in_batch
+        self.budget_type = budget_type
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.reset_cursor()
+
+        self.buckets = self.make_buckets(num_buckets)
+        self.batches = self.make_batches()
+
+    def make_buckets(self, num_buckets):
+        """ Split utterance indices into `num_buckets` equal-count buckets by duration.
+        """
+        order = sorted(range(len(self.durations)), key=lambda i: self.durations[i])
+        num_buckets = max(1, min(num_buckets, len(order)))
+        bucket_size = math.ceil(len(order) / num_buckets)
+        return [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+    def make_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            bucket = list(bucket)
+            if self.shuffle:
+                rng.shuffle(bucket)
+            batch, max_len, total = [], 0.0, 0.0
+            for idx in bucket:
+                dur = self.durations[idx]
+                new_max = max(max_len, dur)
+                if self.budget_type == "padded":
+                    cost = new_max * (len(batch) + 1)
+                else:
+                    cost = total + dur
+                if batch and (cost > self.max_frames_in_batch or len(batch) >= self.max_batch_size):
+                    batches.append(batch)
+                    batch, new_max, total = [], dur, 0.0
+                batch.append(idx)
+                max_len = new_max
+                total += dur
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        # every rank needs the same number of steps, pad by wrapping around
+        num_batches = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+        # cyclic, so fewer batches than ranks still fill every rank
+        batches = (batches * math.ceil(num_batches / len(batches)))[:num_batches]
+        return batches[self.rank::self.num_replicas]
+
+    def padding_ratio(self):
+        """ Fraction of zeros in the padded feature tensors of this epoch.
+        """
+        real, padded = 0.0, 0.0
+        for batch in self.batches:
+            lens = [self.durations[i] for i in batch]
+            real += sum(lens)
+            padded += max(lens) * len(lens)
+        return 1.0 - real / padded if padded > 0 else 0.0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.reset_cursor()
+        self.batches = self.make_batches()
+        logging.info("[Rank {}] epoch {}: {} batches, padding ratio {:.4f}".format(
+            self.rank, epoch, len(self.batches), self.padding_ratio()))
+
+    def __iter__(self):
+        for batch in self.batches[self.start:]:
+            yield batch
+
+    def __len__(self):
+        return len(self.batches) - self.start
+
+
+class RecordingGroupedSampler(StatefulSampler, Sampler):
+    """ Shuffle whole recordings instead of single segments.
+
+        Segments of one recording stay next to each other (shuffled among
+        themselves), so a batch is mostly cut from one or two recordings and
+        the worker that builds it decodes each of them once through the
+        `SegmentReader` LRU. The reuse stops at the batch: the DataLoader
+        deals consecutive batches to the workers round robin, a recording
+        spanning several batches is decoded again by every worker that gets
+        one of them. Like DistributedSampler, the order only depends
+        on `seed + epoch`, the list is padded by wrapping around and every
+        rank takes one contiguous slice of the same length.
+
+        Args:
+            recording_ids: recording index of every utterance, e.g. `Dataload.recordings()`
+            shuffle: shuffle recordings and segments every epoch
+            num_replicas: world size
+            rank: rank of this process
+            seed: must be the same on all ranks
+    """
+
+    def __init__(self, recording_ids, shuffle=True, num_replicas=1, rank=0, seed=777):
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.reset_cursor()
+
+        groups = {}
+        for idx, rec in enumerate(recording_ids):
+            groups.setdefault(int(rec), []).append(idx)
+        self.groups = list(groups.values())
+        self.num_samples = math.ceil(len(recording_ids) / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.reset_cursor()
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        groups = [list(g) for g in self.groups]
+        if self.shuffle:
+            rng.shuffle(groups)
+            for g in groups:
+                rng.shuffle(g)
+        indices = [idx for g in groups for idx in g]
+        total = self.num_samples * self.num_replicas
+        indices += indices[:total - len(indices)]
+        start = self.rank * self.num_samples
+        return iter(indices[start + self.start:start + self.num_samples])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class ResumableDistributedSampler(StatefulSampler, DistributedSampler):
+    """ DistributedSampler that can resume in the middle of an epoch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_cursor()
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.reset_cursor()
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class ShardedEvalSampler(Sampler):
+    """ Split an evaluation set across ranks without padding.
+
+        Rank r takes every num_replicas-th utterance starting at r, so every
+        utterance is scored exactly once; ranks may end up with one batch
+        less than others, see `evaluate` in fqdd/bin/asr/train.py.
+
+        Args:
+            data_source: dataset, only its length is used
+            num_replicas: world size
+            rank: rank of this process
+    """
+
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self.num_samples_total = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_samples_total, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples_total, self.num_replicas))
@@ -0,0 +1,266 @@
+import os
+import fcntl
+import atexit
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+from multiprocessing import shared_memory, resource_tracker
+
+# table columns of one utterance
+START, NUM_SAMPLES, SAMPLE_RATE, CHANNELS, SEQ = range(5)
+TABLE_COLUMNS = 5
+# header: [write head in samples, oldest ring slot, ring length]
+HEAD, RING_START, RING_LEN = range(3)
+HEADER_SIZE = 3 * 8
+# ring slot: (utterance index, start) in arena order
+RING_COLUMNS = 2
+# smallest arena worth creating when /dev/shm is short
+MIN_MB = 64
+
+
+class SharedWaveCache:
+    """ Node-local int16 waveform cache in POSIX shared memory.
+
+        One block under /dev/shm per data list, shared by every DDP rank and
+        DataLoader worker of the node:
+
+            header: write head of the arena, start/length of the ring
+            table: (num_utts, 5) int64, start/num_samples/sample_rate/
+                channels/seq per utterance index, all zero = not cached
+            ring: (index, start) of the entries in arena order, oldest first
+            arena: int16 samples of the cached utterances
+
+        The first process that reads an utterance decodes it and `put`s it,
+        all others get it from `get`, which copies the int16 samples out of
+        the arena as float like `torchaudio.load`. The arena is a ring, a new
+        entry evicts the oldest ones it overlaps, popped from the front of
+        the ring, so the block never grows past `max_mb`. Entries that are
+        read while they sit in the oldest quarter of the arena are written
+        again at the head, frequently used audio stays (an LRU approximation
+        that keeps every entry contiguous).
+
+        The arena is clamped to the free space of /dev/shm and allocated
+        up front, a full /dev/shm disables the cache with a warning instead
+        of a SIGBUS on the first write.
+
+        Writers serialize on a flock, readers take no lock: `seq` is odd
+        while an entry is written or evicted, a reader retries as a miss
+        if it changed during the copy.
+
+        Args:
+            filelist: data list, its path, mtime and size name the block together with the sizes below
+            num_utts: utterances in the (filtered) list, index space of the table
+            max_mb: size of the arena, at most the free space of /dev/shm
+            persist: keep the block after the job, next runs start warm
+    """
+
+    def __init__(self, filelist, num_utts, max_mb=2048, persist=False):
+        self.num_utts = num_utts
+        self.capacity = max_mb * (1 << 20) // 2
+        # a refreshed entry leaves its old slot behind until it is popped
+        self.ring_size = 2 * num_utts + 1
+        # a regenerated list (new mtime or size) gets a new block, a persisted one never serves stale audio
+        stat = os.stat(filelist)
+        digest = hashlib.md5("v2 {} {} {} {} {}".format(os.path.abspath(filelist), stat.st_mtime_ns, stat.st_size,
+                                                     num_utts, max_mb).encode('utf8'))
+        self.name = "fqdd_wav_{}".format(digest.hexdigest()[:12])
+        self.lock_path = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else "/tmp", self.name + ".lock")
+        self.persist = persist
+        self.disabled = False
+        self._shm = None
+
+    def __getstate__(self):
+        # spawned workers attach again
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+    def open(self):
+        """ Create the block, or attach to the one another process created.
+
+            Returns: False if /dev/shm has no room for the cache
+        """
+        if self._shm is not None or self.disabled:
+            return not self.disabled
+        fixed_bytes = HEADER_SIZE + self.num_utts * TABLE_COLUMNS * 8 + self.ring_size * RING_COLUMNS * 8
+        created = False
+        with self.locked():
+            try:
+                self._shm = shared_memory.SharedMemory(self.name)
+            except FileNotFoundError:
+                self._shm = self.create(fixed_bytes)
+                created = self._shm is not None
+        if self._shm is None:
+            self.disabled = True
+            return False
+        # lifetime is managed here, not by the resource tracker of whichever process exits first
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        # the creator may have clamped the arena
+        self.capacity = (self._shm.size - fixed_bytes) // 2
+        buf = self._shm.buf
+        self.header = np.ndarray((3,), dtype=np.int64, buffer=buf)
+        self.table = np.ndarray((self.num_utts, TABLE_COLUMNS), dtype=np.int64, buffer=buf, offset=HEADER_SIZE)
+        offset = HEADER_SIZE + self.num_utts * TABLE_COLUMNS * 8
+        self.ring = np.ndarray((self.ring_size, RING_COLUMNS), dtype=np.int64, buffer=buf, offset=offset)
+        self.arena = np.ndarray((self.capacity,), dtype=np.int16, buffer=buf, offset=fixed_bytes)
+        if created and not self.persist:
+            atexit.register(self.unlink)
+        return True
+
+    def create(self, fixed_bytes):
+        """ Create the block, clamped to the free space of /dev/shm, with all pages allocated.
+        """
+        capacity = self.capacity
+        stat = os.statvfs(os.path.dirname(self.lock_path))
+        # leave a quarter of the free space to everyone else on the node
+        free = stat.f_bavail * stat.f_frsize * 3 // 4
+        if fixed_bytes + capacity * 2 > free:
+            capacity = max(free - fixed_bytes, 0) // 2
+            if capacity * 2 < MIN_MB * (1 << 20):
+                logging.warning("shared wave cache {}: only {:.0f}MB free in /dev/shm, cache disabled".format(
+                    self.name, stat.f_bavail * stat.f_frsize / (1 << 20)))
+                return None
+            logging.warning("shared wave cache {}: max_mb clamped to {:.0f}MB, the free space of /dev/shm".format(
+                self.name, capacity * 2 / (1 << 20)))
+        size = fixed_bytes + capacity * 2
+        shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        try:
+            # touch every page now, a short /dev/shm fails here and not with a SIGBUS in a worker
+            os.posix_fallocate(shm._fd, 0, size)
+        except OSError as e:
+            logging.warning("shared wave cache {}: cannot allocate {:.0f}MB in /dev/shm ({}), cache disabled".format(
+                self.name, size / (1 << 20), e))
+            shm.close()
+            shm.unlink()
+            return None
+        logging.info("shared wave cache {}: {:.0f}MB for {} utterances".format(
+            self.name, size / (1 << 20), self.num_utts))
+        return shm
+
+    def unlink(self):
+        try:
+            shared_memory.SharedMemory(self.name).unlink()
+            os.remove(self.lock_path)
+        except (FileNotFoundError, OSError):
+            pass
+
+    def locked(self):
+        return _FileLock(self.lock_path)
+
+    def get(self, index):
+        """ Returns: (waveform (C, t) float tensor, sample_rate) or None on a miss
+        """
+        if not self.open():
+            return None
+        row = self.table[index]
+        seq = int(row[SEQ])
+        num_samples = int(row[NUM_SAMPLES])
+        if num_samples == 0 or seq % 2 == 1:
+            return None
+        start, sample_rate, channels = int(row[START]), int(row[SAMPLE_RATE]), int(row[CHANNELS])
+        # .float() copies, the arena can be overwritten once the seq check passed
+        view = torch.from_numpy(self.arena[start:start + num_samples])
+        waveform = view.view(channels, -1).float() / (1 << 15)
+        if int(row[SEQ]) != seq:
+            # evicted while copying
+            return None
+        distance = (start - int(self.header[HEAD])) % self.capacity
+        if distance < self.capacity // 4:
+            self.put(index, waveform, sample_rate, refresh=True)
+        return waveform, sample_rate
+
+    def put(self, index, waveform, sample_rate, refresh=False):
+        """ Cache a decoded (C, t) float waveform of utterance `index`.
+        """
+        if not self.open():
+            return
+        num_samples = waveform.numel()
+        if num_samples == 0 or num_samples > self.capacity:
+            return
+        data = (waveform * (1 << 15)).round().clamp(-(1 << 15), (1 << 15) - 1).to(torch.int16)
+        with self.locked():
+            row = self.table[index]
+            if not refresh and row[NUM_SAMPLES] > 0:
+                # another process was faster
+                return
+            head = int(self.header[HEAD])
+            start = head
+            if start + num_samples > self.capacity:
+                # the tail [head, capacity) is dropped with the wrap
+                start = 0
+            end = start + num_samples
+            row[SEQ] += 1
+            row[NUM_SAMPLES] = 0
+            self.evict(start, end, dropped=head if start < head else self.capacity)
+            self.arena[start:end] = data.reshape(-1).numpy()
+            row[START] = start
+            row[SAMPLE_RATE] = sample_rate
+            row[CHANNELS] = waveform.size(0)
+            row[NUM_SAMPLES] = num_samples
+            row[SEQ] += 1
+            self.push(index, start)
+            self.header[HEAD] = end
+
+    def evict(self, start, end, dropped):
+        """ Pop the oldest entries of the ring while they overlap [start, end) or start at `dropped` or later.
+
+            The ring is in arena order starting at the write head,
+            so the entries a new one overwrites are always a prefix of it.
+            Caller holds the lock.
+        """
+        header, ring, table = self.header, self.ring, self.table
+        while header[RING_LEN] > 0:
+            index, entry_start = ring[header[RING_START]]
+            row = table[index]
+            # a slot left behind by a refresh or an eviction is just dropped
+            if row[NUM_SAMPLES] > 0 and row[START] == entry_start:
+                overlaps = entry_start < end and entry_start + row[NUM_SAMPLES] > start
+                if not overlaps and entry_start < dropped:
+                    break
+                self.invalidate(row)
+            self.pop()
+
+    def push(self, index, start):
+        header = self.header
+        if header[RING_LEN] == self.ring_size:
+            # only stale slots can fill it, drop the oldest
+            oldest, entry_start = self.ring[header[RING_START]]
+            row = self.table[oldest]
+            if row[NUM_SAMPLES] > 0 and row[START] == entry_start:
+                self.invalidate(row)
+            self.pop()
+        ring_end = (header[RING_START] + header[RING_LEN]) % self.ring_size
+        self.ring[ring_end] = (index, start)
+        header[RING_LEN] += 1
+
+    @staticmethod
+    def invalidate(row):
+        row[SEQ] += 1
+        row[NUM_SAMPLES] = 0
+        row[SEQ] += 1
+
+    def pop(self):
+        header = self.header
+        header[RING_START] = (header[RING_START] + 1) % self.ring_size
+        header[RING_LEN] -= 1
+
+
+class _FileLock:
+    """ Exclusive flock, works across the unrelated processes of all ranks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
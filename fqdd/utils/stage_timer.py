@@ -0,0 +1,39 @@
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimer:
+    """ Wall-clock time per named stage, e.g. the steps of `Dataload.process`.
+
+        Disabled by default, then `stage` is a shared no-op context. Each
+        DataLoader worker holds its own copy, `drain` hands the collected
+        timings out (see fqdd/bin/benchmark_data.py, which sends them along
+        with every batch) and starts over.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = defaultdict(list)
+        self._null = nullcontext()
+
+    def stage(self, name):
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name].append(time.perf_counter() - start)
+
+    def drain(self):
+        """ Returns: {stage: [seconds, ...]} since the last drain
+        """
+        times = dict(self.times)
+        self.times = defaultdict(list)
+        return times
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import logging
+import statistics
+
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.distributed as dist
+
+# timed stages of one training step, in order
+STEP_STAGES = ["forward", "backward", "optimizer"]
+
+
+class StepTelemetry:
+    """ Step-time breakdown and throughput of the training loop, per rank.
+
+        Per step: the host time spent waiting for the next batch
+        (`data_ready`), and the forward/backward/optimizer `stage`s, timed
+        with cuda events on the compute stream (perf_counter on cpu). Frames
+        (x_lens units) and tokens are summed on the device, grad norms are
+        kept as device tensors. Nothing syncs with the host during the
+        interval: `log`, every log_interval steps, waits for the last event
+        once, reads everything back, adds the peak memory and gathers the
+        stats of all ranks to rank 0, which
+
+            - appends one record to {model_dir}/telemetry.jsonl
+            - logs a summary line with the slowest rank and
+              straggler = slowest step time / median step time
+            - plots the rank means on visdom (telemetry_conf.visual)
+
+        telemetry_conf.profile records a torch.profiler trace of
+        profile_conf.num_steps steps from profile_conf.start_step (steps of
+        this run) on profile_conf.rank, exported as Chrome trace to
+        {model_dir}/trace_rank{rank}_step{start_step}.json.
+
+        Disabled, every method is a no-op and `stage` a shared null context.
+    """
+
+    def __init__(self, device, model_dir, enabled=False, visual_conf=None, profile_conf=None):
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.rank = int(os.environ.get('RANK', 0))
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        self.jsonl_path = os.path.join(model_dir, "telemetry.jsonl")
+        self.model_dir = model_dir
+        self._null = nullcontext()
+        self.visual = None
+        if enabled and visual_conf is not None and self.rank == 0:
+            from fqdd.utils.train_visual import TrainVisual
+            self.visual = TrainVisual(**visual_conf)
+        self.profile_conf = profile_conf
+        self.profiler = None
+        self.num_steps = 0
+        self.reset()
+
+    def reset(self):
+        self.interval_start = time.perf_counter()
+        self.step_end_time = self.interval_start
+        self.steps = 0
+        self.data_wait = 0.0
+        self.stage_times = {name: 0.0 for name in STEP_STAGES}
+        self.events = []
+        self.counts = torch.zeros(2, dtype=torch.float64, device=self.device)
+        self.grad_norms = []
+        if self.enabled and self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def data_ready(self):
+        """ Call when the batch of this step is there.
+        """
+        if self.enabled:
+            self.data_wait += time.perf_counter() - self.step_end_time
+
+    def stage(self, name):
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        if self.cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self.events.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.stage_times[name] += time.perf_counter() - start
+
+    def grad_norm(self, grad_norm):
+        if self.enabled:
+            self.grad_norms.append(grad_norm.detach().float())
+
+    def step_end(self, x_lens, y_lens):
+        """ Call at the end of every step with the lengths of its batch.
+        """
+        if not self.enabled:
+            return
+        self.counts += torch.stack([x_lens.sum(), y_lens.sum()]).to(self.counts)
+        self.steps += 1
+        self.num_steps += 1
+        self.step_profiler()
+        self.step_end_time = time.perf_counter()
+
+    def step_profiler(self):
+        if self.profile_conf is None or self.rank != self.profile_conf.get("rank", 0):
+            return
+        start_step = self.profile_conf.get("start_step", 100)
+        num_steps = self.profile_conf.get("num_steps", 5)
+        if self.num_steps == start_step:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.start()
+        elif self.profiler is not None and self.num_steps == start_step + num_steps:
+            self.profiler.stop()
+            path = os.path.join(self.model_dir, "trace_rank{}_step{}.json".format(self.rank, start_step))
+            self.profiler.export_chrome_trace(path)
+            logging.info("telemetry: profiler trace of {} steps saved to {}".format(num_steps, path))
+            self.profiler = None
+
+    def rank_stats(self):
+        if self.cuda and self.events:
+            self.events[-1][2].synchronize()
+            for name, start, end in self.events:
+                self.stage_times[name] += start.elapsed_time(end) / 1000
+        elapsed = max(time.perf_counter() - self.interval_start, 1e-9)
+        steps = max(self.steps, 1)
+        frames, tokens = self.counts.tolist()
+        grad_norms = torch.stack(self.grad_norms).tolist() if self.grad_norms else []
+        stats = {
+            "rank": self.rank,
+            "steps": self.steps,
+            "step_s": elapsed / steps,
+            "data_wait_s": self.data_wait / steps,
+            **{"{}_s".format(name): t / steps for name, t in self.stage_times.items()},
+            "frames_per_s": frames / elapsed,
+            "tokens_per_s": tokens / elapsed,
+            "peak_mem_mb": torch.cuda.max_memory_allocated(self.device) / (1 << 20) if self.cuda else 0.0,
+            "grad_norm": grad_norms,
+        }
+        return stats
+
+    def log(self, epoch, step, logger=None):
+        """ Gather and write the stats since the last call, call on every rank.
+        """
+        if not self.enabled:
+            return
+        stats = self.rank_stats()
+        all_stats = [stats]
+        if self.world_size > 1 and dist.is_initialized():
+            all_stats = [None] * self.world_size
+            dist.all_gather_object(all_stats, stats)
+        if self.rank == 0:
+            self.write(epoch, step, all_stats, logger)
+        self.reset()
+
+    def write(self, epoch, step, all_stats, logger):
+        step_times = [s["step_s"] for s in all_stats]
+        slowest = max(all_stats, key=lambda s: s["step_s"])
+        straggler = slowest["step_s"] / max(statistics.median(step_times), 1e-9)
+        record = {"epoch": epoch, "step": step, "time": time.time(),
+                  "slowest_rank": slowest["rank"], "straggler": straggler, "ranks": all_stats}
+        with open(self.jsonl_path, "a") as fout:
+            fout.write(json.dumps(record) + "\n")
+
+        names = ["step_s", "data_wait_s"] + ["{}_s".format(name) for name in STEP_STAGES] + \
+            ["frames_per_s", "tokens_per_s", "peak_mem_mb"]
+        means = {name: statistics.mean(s[name] for s in all_stats) for name in names}
+        grad_norms = [g for s in all_stats for g in s["grad_norm"]]
+        if logger is not None:
+            logger.info("telemetry:\tstep_s:{step_s:.3f}\tdata_wait_s:{data_wait_s:.3f}\tforward_s:{forward_s:.3f}"
+                        "\tbackward_s:{backward_s:.3f}\toptimizer_s:{optimizer_s:.3f}\tframes/s:{frames_per_s:.0f}"
+                        "\ttokens/s:{tokens_per_s:.0f}\tpeak_mem_mb:{peak_mem_mb:.0f}".format(**means) +
+                        "\tslowest_rank:{}\tstraggler:{:.2f}".format(slowest["rank"], straggler))
+        if self.visual is not None:
+            if grad_norms:
+                means["grad_norm"] = statistics.mean(grad_norms)
+            means["straggler"] = straggler
+            try:
+                self.visual.plot(step, means)
+            except Exception as ex:
+                # a gone visdom server doesn't stop the training
+                logging.warning("telemetry: visdom plot failed: {}".format(ex))
+
+
+def init_telemetry(configs, device):
+    """ StepTelemetry from configs["telemetry_conf"], a no-op unless configs["telemetry"] is set.
+    """
+    telemetry_conf = configs.get("telemetry_conf", {})
+    return StepTelemetry(device, configs["model_dir"],
+                         enabled=configs.get("telemetry", False),
+                         visual_conf=telemetry_conf.get("visual_conf", {}) if telemetry_conf.get("visual") else None,
+                         profile_conf=telemetry_conf.get("profile_conf", {}) if telemetry_conf.get("profile") else None)
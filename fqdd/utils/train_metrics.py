@@ -0,0 +1,66 @@
+import torch
+import torch.distributed as dist
+
+
+class DeviceMetrics:
+    """ Running weighted sums of scalar model outputs, kept on the training device.
+
+        `update` only adds the detached values to a device tensor, no
+        `.item()`, so the training step never waits for the GPU. The host
+        sees the numbers at `interval` (rank 0, every log_interval steps,
+        one copy) and `reduce` (all ranks, end of an epoch, one all-reduce).
+
+        Every value is weighted, 1 per batch by default. With the number of
+        utterances for the losses and of tokens for the accuracy, the
+        reduced means are exact over all utterances of all ranks.
+
+        Args:
+            names: keys of the model output dict, e.g. ["loss", "ctc_loss", ...]
+            device: training device
+    """
+
+    def __init__(self, names, device):
+        self.names = list(names)
+        self.device = device
+        # sums and weights side by side, one all-reduce
+        self.sums = torch.zeros(2 * len(self.names), dtype=torch.float64, device=device)
+        self.mark = self.sums.clone()
+        # python weights are multiplied into these, never copied to the device
+        self.ones = torch.ones(len(self.names), dtype=torch.float64, device=device)
+
+    def update(self, batch_infos, weights=None):
+        """ weights: {name: python number or 0-dim device tensor}, 1 for missing names
+
+            No host<->device copy and no sync: python numbers are kernel
+            arguments, tensors are expected on the device already.
+        """
+        weights = weights or {}
+        values, ws = [], []
+        for i, name in enumerate(self.names):
+            w = weights.get(name, 1.0)
+            if torch.is_tensor(w):
+                w = w.detach().to(self.sums)
+            else:
+                w = self.ones[i] * w
+            values.append(batch_infos[name].detach().to(self.sums) * w)
+            ws.append(w)
+        self.sums += torch.stack(values + ws)
+
+    def means(self, sums):
+        n = len(self.names)
+        return dict(zip(self.names, (sums[:n] / sums[n:].clamp(min=1e-12)).tolist()))
+
+    def interval(self):
+        """ Means since the last `interval` call of this process.
+        """
+        means = self.means(self.sums - self.mark)
+        self.mark = self.sums.clone()
+        return means
+
+    def reduce(self):
+        """ Means over all batches of all ranks, a collective when distributed.
+        """
+        totals = self.sums.clone()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        return self.means(totals)
@@ -4,7 +4,13 @@ import copy
 import torch
 import torch.distributed as dist
 import torch.optim as optim
+from functools import partial
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.fsdp import FullyShardedDataParallel, MixedPrecision, ShardingStrategy
+from torch.distributed.fsdp.wrap import lambda_auto_wrap_policy
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
 from fqdd.utils.optimizers import adam_optimizer, sgd_optimizer, scheduler, WarmupLR
+from fqdd.modules.model_utils import LayerDropModuleList
 
 def init_distributed(args):
     world_size = int(os.environ.get('WORLD_SIZE', 1))
@@ -27,6 +33,128 @@ def init_distributed(args):
     return world_size, local_rank, rank
 
 
+def fqdd_join(group_join, idx):
+    """ Detect uneven workload across ranks, e.g. shard mode where every rank
+        reads a different number of samples. Returns True once any rank has
+        run out of data, so all ranks leave the epoch together.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    if idx == 0 or world_size == 1:
+        return False
+    try:
+        # NOTE: monitored_barrier is only supported by the gloo backend
+        dist.monitored_barrier(group=group_join, timeout=group_join.options._timeout)
+    except RuntimeError as e:
+        logging.info("Detected uneven workload distribution: {}\n".format(e) +
+                     "Break current worker to manually join all workers, " +
+                     "rank {}, world_size {}".format(rank, world_size))
+        return True
+    return False
+
+
+# layers FSDP shards one by one, matched by class name (every model package has its own DecoderLayer)
+FSDP_WRAP_LAYERS = ["ConformerEncoderLayer", "EBranchformerEncoderLayer", "DecoderLayer"]
+
+FSDP_DTYPES = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+def fsdp_wrap_layer(module, layer_names, min_num_params):
+    return type(module).__name__ in layer_names and \
+        sum(p.numel() for p in module.parameters()) >= min_num_params
+
+
+def uses_layer_drop(model):
+    return any(isinstance(m, LayerDropModuleList) and max(m.p, default=0) > 0 for m in model.modules())
+
+
+def wrap_model(args, model, configs):
+    """ Move the model to args.device and wrap it for configs["dist_conf"]["train_engine"].
+
+        torch_ddp: DistributedDataParallel, ddp_conf sets bucket_cap_mb,
+            gradient_as_bucket_view and static_graph, find_unused_parameters
+            comes from dist_conf and is forced on when layers can be dropped
+        torch_fsdp: FullyShardedDataParallel, every encoder/decoder layer
+            with at least fsdp_conf.min_num_params parameters is its own
+            FSDP unit, parameters/gradients are cast to model.dtype (fp16/bf16)
+
+        Must run before `init_optimizer_and_scheduler`, FSDP replaces the parameters.
+    """
+    dist_conf = configs["dist_conf"]
+    train_engine = dist_conf.get("train_engine", "torch_ddp")
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    on_cuda = "cuda" in args.device
+    device_ids = [local_rank] if on_cuda else None
+    if train_engine == "torch_ddp":
+        model.to(args.device)
+        ddp_conf = dist_conf.get("ddp_conf", {})
+        static_graph = ddp_conf.get("static_graph", False)
+        find_unused_parameters = dist_conf.get("find_unused_parameters", False)
+        if uses_layer_drop(model):
+            # dropped layers get no gradient, the same ones on every rank
+            if static_graph or not find_unused_parameters:
+                logging.info("layer drop: find_unused_parameters on, static_graph off")
+            static_graph, find_unused_parameters = False, True
+        model = DistributedDataParallel(model,
+                                        device_ids=device_ids,
+                                        bucket_cap_mb=ddp_conf.get("bucket_cap_mb", 25),
+                                        gradient_as_bucket_view=ddp_conf.get("gradient_as_bucket_view", True),
+                                        static_graph=static_graph,
+                                        find_unused_parameters=find_unused_parameters)
+    elif train_engine == "torch_fsdp":
+        fsdp_conf = dist_conf.get("fsdp_conf", {})
+        dtype = FSDP_DTYPES.get(configs["model"].get("dtype", "fp32"))
+        mixed_precision = None
+        if dtype is not None:
+            # buffers (e.g. cmvn) stay fp32
+            mixed_precision = MixedPrecision(param_dtype=dtype, reduce_dtype=dtype, buffer_dtype=torch.float32)
+        wrap_policy = partial(lambda_auto_wrap_policy,
+                              lambda_fn=partial(fsdp_wrap_layer,
+                                                layer_names=fsdp_conf.get("wrap_layers", FSDP_WRAP_LAYERS),
+                                                min_num_params=fsdp_conf.get("min_num_params", 100000)))
+        model = FullyShardedDataParallel(
+            model,
+            auto_wrap_policy=wrap_policy,
+            mixed_precision=mixed_precision,
+            sharding_strategy=ShardingStrategy[fsdp_conf.get("sharding_strategy", "shard_grad_op").upper()],
+            device_id=local_rank if on_cuda else None,
+            sync_module_states=True,
+            use_orig_params=True,
+        )
+    else:
+        raise ValueError("unknown train_engine: " + train_engine)
+    return model
+
+
+def init_amp(configs, model, device):
+    """ Autocast context and GradScaler for configs["model"]["dtype"].
+
+        fp32: both disabled, no-ops
+        bf16: autocast only, no loss scaling needed
+        fp16: autocast and dynamic loss scaling (ShardedGradScaler for FSDP)
+
+        Returns:
+            autocast: callable returning the autocast context of one forward
+            scaler: GradScaler, `enabled` False unless fp16
+    """
+    dtype = configs["model"].get("dtype", "fp32")
+    device_type = torch.device(device).type
+    amp_dtype = FSDP_DTYPES.get(dtype)
+    if amp_dtype is not None and device_type == "cpu" and amp_dtype != torch.bfloat16:
+        logging.warning("cpu autocast only supports bf16, training {} model in fp32".format(dtype))
+        amp_dtype = None
+    use_scaler = amp_dtype == torch.float16
+    if isinstance(model, FullyShardedDataParallel):
+        scaler = ShardedGradScaler(enabled=use_scaler)
+    else:
+        scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+    autocast = partial(torch.autocast, device_type, dtype=amp_dtype, enabled=amp_dtype is not None)
+    return autocast, scaler
+
+
 def init_optimizer_and_scheduler(configs, model):
    
     params = model.parameters()
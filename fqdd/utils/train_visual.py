@@ -3,14 +3,34 @@ import time
 import numpy as np
 
 
-viz = Visdom(env='demo', server='0.0.0.0', port=6007, use_incoming_socket=False)
-x, y = 0, 0
-for i in range(50):
-    x = i
-    y = i * i
-    viz.line(
-        X=np.array([x]),
-        Y=np.array([y]),
-        win='window',
-        update='append')
-    time.sleep(5)
+class TrainVisual:
+    """ Append scalar curves to a visdom server, one window per metric.
+
+        Args:
+            env: visdom environment
+            server / port: visdom server
+    """
+
+    def __init__(self, env='demo', server='0.0.0.0', port=6007):
+        self.viz = Visdom(env=env, server=server, port=port, use_incoming_socket=False)
+
+    def plot(self, step, scalars):
+        """ scalars: {window name: value} at x = step
+        """
+        for name, value in scalars.items():
+            self.viz.line(
+                X=np.array([step]),
+                Y=np.array([value]),
+                win=name,
+                opts={"title": name},
+                update='append')
+
+
+if __name__ == "__main__":
+    visual = TrainVisual()
+    x, y = 0, 0
+    for i in range(50):
+        x = i
+        y = i * i
+        visual.plot(x, {'window': y})
+        time.sleep(5)
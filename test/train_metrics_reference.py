@@ -0,0 +1,78 @@
+import sys
+
+import torch
+
+sys.path.insert(0, "./")
+
+from fqdd.utils.train_metrics import DeviceMetrics
+
+NAMES = ["loss", "ctc_loss", "att_loss", "th_acc"]
+
+
+def make_batches(device, num_batches=20, seed=777):
+    g = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(num_batches):
+        values = (torch.rand(len(NAMES), generator=g) * 10).tolist()
+        num_utts = int(torch.randint(1, 16, (1,), generator=g))
+        num_tokens = int(torch.randint(10, 200, (1,), generator=g))
+        batch_infos = {name: torch.tensor(v, device=device) for name, v in zip(NAMES, values)}
+        batches.append((batch_infos, num_utts, num_tokens))
+    return batches
+
+
+def check_means(device):
+    """ Weighted means against a float64 host computation, python and tensor weights mixed.
+    """
+    batches = make_batches(device)
+    metrics = DeviceMetrics(NAMES, device)
+    for batch_infos, num_utts, num_tokens in batches:
+        # utterance weights as python numbers, token weights as device tensors, like evaluate()
+        metrics.update(batch_infos, {"loss": num_utts, "ctc_loss": num_utts, "att_loss": num_utts,
+                                     "th_acc": torch.tensor(num_tokens, device=device)})
+    means = metrics.reduce()
+    for name in NAMES:
+        key = "th_acc" if name == "th_acc" else "utts"
+        num = sum(b[0][name].item() * (b[2] if key == "th_acc" else b[1]) for b in batches)
+        den = sum(b[2] if key == "th_acc" else b[1] for b in batches)
+        assert abs(means[name] - num / den) < 1e-6, (name, means[name], num / den)
+
+    metrics = DeviceMetrics(NAMES, device)
+    for batch_infos, _, _ in batches:
+        metrics.update(batch_infos)
+    means = metrics.interval()
+    for name in NAMES:
+        expected = sum(b[0][name].item() for b in batches) / len(batches)
+        assert abs(means[name] - expected) < 1e-6, (name, means[name], expected)
+    print("{}: weighted means ok".format(device))
+
+
+def check_no_sync(device):
+    """ update() with python and device tensor weights must not synchronize with the host.
+    """
+    batches = make_batches(device)
+    metrics = DeviceMetrics(NAMES, device)
+    torch.cuda.synchronize(device)
+    torch.cuda.set_sync_debug_mode("error")
+    try:
+        for batch_infos, num_utts, num_tokens in batches:
+            metrics.update(batch_infos)
+            metrics.update(batch_infos, {"loss": num_utts * 0.5, "ctc_loss": num_utts, "att_loss": num_utts,
+                                         "th_acc": batch_infos["th_acc"] * num_tokens})
+    finally:
+        torch.cuda.set_sync_debug_mode("default")
+    print("{}: update without sync ok".format(device))
+
+
+def main():
+    check_means(torch.device("cpu"))
+    if torch.cuda.is_available():
+        device = torch.device("cuda:0")
+        check_means(device)
+        check_no_sync(device)
+    else:
+        print("no cuda device, sync check skipped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import sys
+import math
+import random
+
+import torch
+
+sys.path.insert(0, "./")
+
+from fqdd.utils.load_data import Dataload
+
+DISTORT_CONF = {
+    "rate": 0.5,
+    "gain_db": {"db": -30},
+    "max_distortion": {"max_db": -30},
+    "jag_distortion": {"mask_number": 4},
+    "fence_distortion": {"mask_number": 1, "max_db": -30},
+    "poly_distortion": {"a": 4, "m": 2, "n": 2},
+    "quad_distortion": {"a": 1, "m": 1, "n": 1},
+}
+
+
+def scalar_wav_distortion(waveform, distort_conf, distort_types=None):
+    """ The per sample point implementation the vectorized Dataload.wav_distortion replaced.
+
+        Same closures, applied with a python loop. The distorted points are
+        picked with torch.rand like the new path, so at one seed both draw
+        the same random numbers.
+    """
+
+    def db2amp(db):
+        return pow(10, db / 20)
+
+    def amp2db(amp):
+        return 20 * math.log10(amp)
+
+    def make_poly_distortion(conf):
+        a = conf['a']
+        m = conf['m']
+        n = conf['n']
+
+        def poly_distortion(x):
+            abs_x = abs(x)
+            if abs_x < 0.000001:
+                x = x
+            else:
+                db_norm = amp2db(abs_x) / 100 + 1
+                if db_norm < 0:
+                    db_norm = 0
+                db_norm = a * pow(db_norm, m) * pow((1 - db_norm), n) + db_norm
+                if db_norm > 1:
+                    db_norm = 1
+                db = (db_norm - 1) * 100
+                amp = db2amp(db)
+                if amp >= 0.9997:
+                    amp = 0.9997
+                if x > 0:
+                    x = amp
+                else:
+                    x = -amp
+            return x
+
+        return poly_distortion
+
+    def make_quad_distortion(conf):
+        return make_poly_distortion({"a": conf.get("a", 1), "m": conf.get("m", 1), "n": conf.get("n", 1)})
+
+    def make_max_distortion(conf):
+        max_db = conf['max_db']
+        if max_db:
+            max_amp = db2amp(max_db)
+        else:
+            max_amp = 0.997
+
+        def max_distortion(x):
+            if x > 0:
+                x = max_amp
+            elif x < 0:
+                x = -max_amp
+            else:
+                x = 0.0
+            return x
+
+        return max_distortion
+
+    def make_amp_mask(db_mask=None):
+        if db_mask is None:
+            db_mask = [(-110, -95), (-90, -80), (-65, -60), (-50, -30), (-15, 0)]
+        amp_mask = [(db2amp(db[0]), db2amp(db[1])) for db in db_mask]
+        return amp_mask
+
+    default_mask = make_amp_mask()
+
+    def generate_amp_mask(mask_num):
+        a = [0] * 2 * mask_num
+        a[0] = 0
+        m = []
+        for i in range(1, 2 * mask_num):
+            a[i] = a[i - 1] + random.uniform(0.5, 1)
+        max_val = a[2 * mask_num - 1]
+        for i in range(0, mask_num):
+            l = ((a[2 * i] - max_val) / max_val) * 100
+            r = ((a[2 * i + 1] - max_val) / max_val) * 100
+            m.append((l, r))
+        return make_amp_mask(m)
+
+    def make_fence_distortion(conf):
+        mask_number = conf['mask_number']
+        max_db = conf['max_db']
+        max_amp = db2amp(max_db)
+        if mask_number <= 0:
+            positive_mask = default_mask
+            negative_mask = make_amp_mask([(-50, 0)])
+        else:
+            positive_mask = generate_amp_mask(mask_number)
+            negative_mask = generate_amp_mask(mask_number)
+
+        def fence_distortion(x):
+            if x > 0:
+                for mask in positive_mask:
+                    if mask[0] <= x <= mask[1]:
+                        return max_amp
+                return 0.0
+            elif x < 0:
+                for mask in negative_mask:
+                    if mask[0] <= abs(x) <= mask[1]:
+                        return max_amp
+                return 0.0
+            return x
+
+        return fence_distortion
+
+    def make_jag_distortion(conf):
+        mask_number = conf['mask_number']
+        if mask_number <= 0:
+            positive_mask = default_mask
+            negative_mask = make_amp_mask([(-50, 0)])
+        else:
+            positive_mask = generate_amp_mask(mask_number)
+            negative_mask = generate_amp_mask(mask_number)
+
+        def jag_distortion(x):
+            if x > 0:
+                for mask in positive_mask:
+                    if mask[0] <= x <= mask[1]:
+                        return x
+                return 0.0
+            elif x < 0:
+                for mask in negative_mask:
+                    if mask[0] <= abs(x) <= mask[1]:
+                        return x
+                return 0.0
+            return x
+
+        return jag_distortion
+
+    def make_gain_db(conf):
+        db = conf['db']
+
+        def gain_db(x):
+            return min(0.997, x * pow(10, db / 20))
+
+        return gain_db
+
+    def distort(x, func, rate=0.8):
+        mask = torch.rand(x.shape[1]) < rate
+        for i in range(0, x.shape[1]):
+            if mask[i]:
+                x[0][i] = func(float(x[0][i]))
+        return x
+
+    waveform = waveform.detach().clone()
+    rate = distort_conf["rate"]
+    if distort_types is None:
+        distort_types = ['gain_db', 'max_distortion', 'fence_distortion', 'jag_distortion', 'poly_distortion',
+                         'quad_distortion', 'none_distortion']
+    distort_type = random.choice(distort_types)
+
+    if distort_type == 'gain_db':
+        waveform = distort(waveform, make_gain_db(distort_conf["gain_db"]))
+    elif distort_type == 'max_distortion':
+        waveform = distort(waveform, make_max_distortion(distort_conf["max_distortion"]), rate=rate)
+    elif distort_type == 'fence_distortion':
+        waveform = distort(waveform, make_fence_distortion(distort_conf["fence_distortion"]), rate=rate)
+    elif distort_type == 'jag_distortion':
+        waveform = distort(waveform, make_jag_distortion(distort_conf["jag_distortion"]), rate=rate)
+    elif distort_type == 'poly_distortion':
+        waveform = distort(waveform, make_poly_distortion(distort_conf["poly_distortion"]), rate=rate)
+    elif distort_type == 'quad_distortion':
+        waveform = distort(waveform, make_quad_distortion(distort_conf["quad_distortion"]), rate=rate)
+    return waveform
+
+
+def make_waveform(num_samples, seed):
+    """ (1, t) float waveform with magnitudes spread over [-120db, 0db], both signs and exact zeros.
+    """
+    g = torch.Generator().manual_seed(seed)
+    db = torch.rand(num_samples, generator=g) * -120
+    sign = torch.randint(0, 2, (num_samples,), generator=g) * 2 - 1
+    waveform = sign * torch.pow(10, db / 20)
+    waveform[torch.rand(num_samples, generator=g) < 0.05] = 0.0
+    return waveform.unsqueeze(0)
+
+
+def check(distort_type, distort_conf, seed, num_samples=8000):
+    waveform = make_waveform(num_samples, seed)
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+    expected = scalar_wav_distortion(waveform, distort_conf, [distort_type])
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+    # wav_distortion doesn't use the instance, skip the data loading setup
+    result = Dataload.wav_distortion(Dataload.__new__(Dataload), waveform, distort_conf, [distort_type])
+
+    assert result.shape == expected.shape and result.dtype == expected.dtype
+    assert not torch.equal(result, waveform) or distort_type == 'none_distortion'
+    max_diff = (result - expected).abs().max().item()
+    assert torch.allclose(result, expected, rtol=1e-6, atol=1e-7), \
+        "{} {}: max abs diff {}".format(distort_type, distort_conf.get(distort_type), max_diff)
+    print("{:<18} seed {}: ok, max abs diff {:.3g}".format(distort_type, seed, max_diff))
+
+
+def main():
+    seed = 777
+    distort_types = ['gain_db', 'max_distortion', 'fence_distortion', 'jag_distortion', 'poly_distortion',
+                     'quad_distortion', 'none_distortion']
+    for distort_type in distort_types:
+        check(distort_type, DISTORT_CONF, seed)
+    # default masks instead of random ones, and the max_db 0 fallback of max_distortion
+    default_masks = dict(DISTORT_CONF,
+                         jag_distortion={"mask_number": 0},
+                         fence_distortion={"mask_number": 0, "max_db": -30},
+                         max_distortion={"max_db": 0})
+    for distort_type in ['max_distortion', 'fence_distortion', 'jag_distortion']:
+        check(distort_type, default_masks, seed)
+
+
+if __name__ == '__main__':
+    main()
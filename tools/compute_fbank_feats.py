@@ -14,11 +14,14 @@
 
 import argparse
 import logging
+import sys
 
 import torchaudio
 import torchaudio.compliance.kaldi as kaldi
 
-import wenet.dataset.kaldi_io as kaldi_io
+sys.path.insert(0, "./")
+
+from fqdd.utils.feature_store import FeatureStore
 
 
 def parse_opts():
@@ -36,14 +39,26 @@ def parse_opts():
                         default=10,
                         help='Frame shift in milliseconds')
     parser.add_argument('--dither',
-                        type=int,
+                        type=float,
                         default=0.0,
                         help='Dithering constant (0.0 means no dither)')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=16000,
+                        help='resample to data_conf.sample_rate first')
+    parser.add_argument('--dtype',
+                        default='float16',
+                        choices=['float16', 'float32'],
+                        help='dtype of the stored features')
     parser.add_argument('--segments', default=None, help='segments file')
     parser.add_argument('wav_scp', help='wav scp file')
-    parser.add_argument('out_ark', help='output ark file')
-    parser.add_argument('out_scp', help='output scp file')
+    parser.add_argument('outputs', nargs='+',
+                        help='out_prefix: feature store prefix, use the data.list path '
+                             'so that Dataload finds it (data_conf.feat_store); '
+                             'or out_ark out_scp: kaldi ark/scp files as before')
     args = parser.parse_args()
+    if len(args.outputs) > 2:
+        parser.error('expected out_prefix or out_ark out_scp')
     return args
 
 
@@ -85,6 +100,56 @@ def load_wav_segments(wav_scp_file, segments_file):
     return audio_list
 
 
+def compute_feats(audio_list, args):
+    resamplers = {}
+    count = 0
+    for item in audio_list:
+        if len(item) == 2:
+            key, wav_path = item
+            waveform, sample_rate = torchaudio.load(wav_path)
+        else:
+            assert len(item) == 4
+            key, wav_path, start, end = item
+            sample_rate = torchaudio.info(wav_path).sample_rate
+            frame_offset = int(start * sample_rate)
+            num_frames = int((end - start) * sample_rate)
+            waveform, sample_rate = torchaudio.load(
+                wav_path, frame_offset, num_frames)
+        if sample_rate != args.sample_rate:
+            if sample_rate not in resamplers:
+                resamplers[sample_rate] = torchaudio.transforms.Resample(
+                    orig_freq=sample_rate, new_freq=args.sample_rate)
+            waveform = resamplers[sample_rate](waveform)
+
+        # same call and scaling as Dataload.compute_feat
+        mat = kaldi.fbank(waveform * (1 << 15),
+                          num_mel_bins=args.num_mel_bins,
+                          frame_length=args.frame_length,
+                          frame_shift=args.frame_shift,
+                          dither=args.dither,
+                          energy_floor=0.0,
+                          sample_frequency=args.sample_rate)
+        yield key, mat
+        count += 1
+        if count % 10000 == 0:
+            logging.info('Progress {}/{}'.format(count, len(audio_list)))
+
+
+def write_ark_scp(feats, out_ark, out_scp):
+    """ Kaldi binary ark and its scp, the output format of the old out_ark/out_scp usage.
+    """
+    try:
+        import kaldi_io
+    except ImportError:
+        raise ImportError("Could not import kaldi_io. Install it to write ark/scp.")
+
+    with open(out_ark, 'wb') as ark_fout, open(out_scp, 'w', encoding='utf8') as scp_fout:
+        for key, mat in feats:
+            ark_fout.write((key + ' ').encode('utf8'))
+            scp_fout.write('{} {}:{}\n'.format(key, out_ark, ark_fout.tell()))
+            kaldi_io.write_mat(ark_fout, mat.detach().numpy())
+
+
 if __name__ == '__main__':
     args = parse_opts()
     logging.basicConfig(level=logging.DEBUG,
@@ -94,31 +159,19 @@ if __name__ == '__main__':
     else:
         audio_list = load_wav_segments(args.wav_scp, args.segments)
 
-    count = 0
-    with open(args.out_ark, 'wb') as ark_fout, \
-         open(args.out_scp, 'w', encoding='utf8') as scp_fout:
-        for item in audio_list:
-            if len(item) == 2:
-                key, wav_path = item
-                waveform, sample_rate = torchaudio.load(wav_path)
-            else:
-                assert len(item) == 4
-                key, wav_path, start, end = item
-                sample_rate = torchaudio.info(wav_path).sample_rate
-                frame_offset = int(start * sample_rate)
-                num_frames = int((end - start) * sample_rate)
-                waveform, sample_rate = torchaudio.load(
-                    wav_path, frame_offset, num_frames)
-
-            mat = kaldi.fbank(waveform,
-                              num_mel_bins=args.num_mel_bins,
-                              frame_length=args.frame_length,
-                              frame_shift=args.frame_shift,
-                              dither=args.dither,
-                              energy_floor=0.0,
-                              sample_frequency=sample_rate)
-            mat = mat.detach().numpy()
-            kaldi_io.write_ark_scp(key, mat, ark_fout, scp_fout)
-            count += 1
-            if count % 10000 == 0:
-                logging.info('Progress {}/{}'.format(count, len(audio_list)))
+    # hashed like the data_conf of the training config
+    data_conf = {
+        "feat_type": "fbank",
+        "sample_rate": args.sample_rate,
+        "fbank_conf": {
+            "num_mel_bins": args.num_mel_bins,
+            "frame_length": args.frame_length,
+            "frame_shift": args.frame_shift,
+            "dither": args.dither,
+        }
+    }
+    if len(args.outputs) == 1:
+        store = FeatureStore(args.outputs[0], data_conf)
+        store.write(compute_feats(audio_list, args), args.dtype)
+    else:
+        write_ark_scp(compute_feats(audio_list, args), *args.outputs)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""Probe every wav of a data.list once and write a sidecar index.
+
+Each line of the index is a json {"key", "num_frames", "sample_rate", "channels"}.
+Dataload picks up `<data.list>.index` automatically (or data_conf.index_file)
+and never calls torchaudio.info at startup. Probing runs in a process pool,
+results are appended as they arrive, so an interrupted run resumes where it
+stopped.
+
+    python tools/make_data_index.py --num_workers 32 data/train/data.list
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+
+import torchaudio
+
+
+def probe(item):
+    key, wav = item
+    try:
+        info = torchaudio.info(wav)
+    except Exception as ex:
+        logging.warning('failed to probe {} {}: {}'.format(key, wav, ex))
+        return None
+    return dict(key=key,
+                num_frames=info.num_frames,
+                sample_rate=info.sample_rate,
+                channels=info.num_channels)
+
+
+def read_index(index_file):
+    index = {}
+    try:
+        with open(index_file, 'r', encoding='utf8') as fin:
+            for line in fin:
+                try:
+                    info = json.loads(line)
+                except ValueError:
+                    # partial last line of an interrupted run
+                    continue
+                index[info["key"]] = info
+    except FileNotFoundError:
+        pass
+    return index
+
+
+def probe_all(items, num_workers=1, chunksize=64):
+    """ Yields probe results in any order, None for unreadable files.
+    """
+    if num_workers <= 1:
+        for item in items:
+            yield probe(item)
+    else:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            for info in pool.imap_unordered(probe, items, chunksize=chunksize):
+                yield info
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=8,
+                        help='num of processes probing audio files')
+    parser.add_argument('--index_file',
+                        default=None,
+                        help='output index, default <data_list>.index')
+    parser.add_argument('data_list', help='data.list made by make_raw_list.py')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    index_file = args.index_file or args.data_list + '.index'
+    done = read_index(index_file)
+
+    items = []
+    with open(args.data_list, 'r', encoding='utf8') as fin:
+        for line in fin:
+            obj = json.loads(line)
+            if obj["key"] not in done:
+                items.append((obj["key"], obj["wav"]))
+    logging.info('{} already indexed, {} to probe'.format(len(done), len(items)))
+
+    count = 0
+    with open(index_file, 'a', encoding='utf8') as fout:
+        for info in probe_all(items, args.num_workers):
+            count += 1
+            if info is not None:
+                fout.write(json.dumps(info, ensure_ascii=False) + '\n')
+            if count % 10000 == 0:
+                fout.flush()
+                logging.info('Progress {}/{}'.format(count, len(items)))
+    logging.info('done, index written to {}'.format(index_file))
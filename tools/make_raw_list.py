@@ -16,10 +16,19 @@
 
 import argparse
 import json
+import os
+import sys
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--segments', default=None, help='segments file')
+    parser.add_argument('--wav_info',
+                        action='store_true',
+                        help='record num_frames, sample_rate and channels')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=8,
+                        help='num of processes probing audio files')
     parser.add_argument('wav_file', help='wav file')
     parser.add_argument('text_file', help='text file')
     parser.add_argument('output_file', help='output list file')
@@ -40,6 +49,15 @@ if __name__ == '__main__':
                 assert len(arr) == 4
                 segments_table[arr[0]] = (arr[1], float(arr[2]), float(arr[3]))
 
+    wav_infos = {}
+    if args.wav_info:
+        # run as a script (run.sh stage 3), make_data_index.py is next to it
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from make_data_index import probe_all
+        for info in probe_all(list(wav_table.items()), args.num_workers):
+            if info is not None:
+                wav_infos[info.pop("key")] = info
+
     with open(args.text_file, 'r', encoding='utf8') as fin, \
          open(args.output_file, 'w', encoding='utf8') as fout:
         for line in fin:
@@ -50,10 +68,12 @@ if __name__ == '__main__':
                 assert key in wav_table
                 wav = wav_table[key]
                 line = dict(key=key, wav=wav, txt=txt)
+                line.update(wav_infos.get(key, {}))
             else:
                 assert key in segments_table
                 wav_key, start, end = segments_table[key]
                 wav = wav_table[wav_key]
                 line = dict(key=key, wav=wav, txt=txt, start=start, end=end)
+                line.update(wav_infos.get(wav_key, {}))
             json_line = json.dumps(line, ensure_ascii=False)
             fout.write(json_line + '\n')
@@ -159,6 +159,11 @@ if __name__ == '__main__':
                 wav = wav_table[wav_key]
                 data.append((key, txt, wav, start, end))
 
+    if not no_segments:
+        # keep the segments of one recording in the same shard, next to
+        # each other, so write_tar_file decodes every recording once
+        data.sort(key=lambda x: (x[2], x[3]))
+
     num = args.num_utts_per_shard
     chunks = [data[i:i + num] for i in range(0, len(data), num)]
     os.makedirs(args.shards_dir, exist_ok=True)